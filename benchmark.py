@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""Benchmark suite for the text co-writer.
+
+Measures prompt assembly, character/element parsing at scale, reference
+extraction on synthetic TXT/DOCX/PDF corpora, and end-to-end request latency
+against the bundled mock model server for every provider wire format.
+Results are written as JSON so runs can be compared over time:
+
+    python benchmark.py                       # full suite
+    python benchmark.py --quick               # smaller sizes, for a fast check
+    python benchmark.py --compare bench_results/benchmark-20261019-120000.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import text_co_writer as writer
+from mock_model_server import start_mock_server
+
+def summarize(samples):
+    """Latency statistics in milliseconds for a list of durations in seconds"""
+    ordered = sorted(samples)
+    return {
+        "runs": len(ordered),
+        "mean_ms": round(statistics.mean(ordered) * 1000, 3),
+        "p50_ms": round(ordered[len(ordered) // 2] * 1000, 3),
+        "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        "min_ms": round(ordered[0] * 1000, 3)
+    }
+
+def time_calls(function, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+# Synthetic inputs
+
+def synthetic_characters(count):
+    lines = ["# Synthetic characters for benchmarking"]
+    for index in range(count):
+        lines += [
+            f"[writer_{index}]",
+            f"name: Writer {index}",
+            f"personality: A restless observer number {index} who maps rivers, machines and weather.",
+            f"interests: Field recording, tidal data, speculative botany and archive {index}.",
+            "style: Lyrical and precise, moving between lab notes and folk tale.",
+            "influences: Ursula K. Le Guin, Anna Tsing, and the sea.",
+            ""
+        ]
+    return "\n".join(lines)
+
+def synthetic_elements(count):
+    lines = ["# Synthetic custom elements for benchmarking"]
+    for index in range(count):
+        lines.append(f"element_{index}: A strange phenomenon number {index} where light, lichen and memory trade places.")
+    return "\n".join(lines)
+
+def synthetic_paragraph(index):
+    return (f"Paragraph {index}. The archive hummed softly while the lichen rewrote the margins of every map, "
+            "and the researchers took notes in a language that kept changing its grammar with the tide.")
+
+def write_synthetic_pdf(path, paragraphs):
+    """Write a small but valid PDF with one page of text per 40 paragraphs (no PDF library needed)"""
+    def escape(text):
+        return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    pages = [paragraphs[i:i + 40] for i in range(0, len(paragraphs), 40)] or [[]]
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for page_lines in pages:
+        text = "BT /F1 8 Tf 11 TL 40 800 Td " + " ".join(f"({escape(line[:110])}) Tj T*" for line in page_lines) + " ET"
+        objects.append(f"<< /Length {len(text)} >>\nstream\n{text}\nendstream")
+        content_id = len(objects)
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] /Resources << /Font << /F1 3 0 R >> >> /Contents {content_id} 0 R >>")
+        page_ids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{page_id} 0 R' for page_id in page_ids)}] /Count {len(page_ids)} >>"
+
+    output = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += f"{number} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref_offset = len(output)
+    output += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("latin-1")
+    output += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode("latin-1")
+    output += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode("latin-1")
+    with open(path, "wb") as file:
+        file.write(output)
+
+def build_reference_corpus(folder, files_per_format, paragraphs_per_file):
+    """Create TXT, DOCX and PDF files; returns the formats that could be generated"""
+    formats = ["txt", "pdf"]
+    try:
+        from docx import Document
+        formats.append("docx")
+    except ImportError:
+        Document = None
+
+    for index in range(files_per_format):
+        paragraphs = [synthetic_paragraph(number) for number in range(paragraphs_per_file)]
+        with open(os.path.join(folder, f"reference_{index}.txt"), "w", encoding="utf-8") as file:
+            file.write("\n".join(paragraphs))
+        write_synthetic_pdf(os.path.join(folder, f"reference_{index}.pdf"), paragraphs)
+        if Document:
+            document = Document()
+            for paragraph in paragraphs:
+                document.add_paragraph(paragraph)
+            document.save(os.path.join(folder, f"reference_{index}.docx"))
+    return formats
+
+# Benchmarks
+
+def bench_prompt_assembly(iterations):
+    references = [{"filename": f"reference_{index}.txt", "content": synthetic_paragraph(index) * 10} for index in range(5)]
+    character = next(iter(writer.WRITER_CHARACTERS), None)
+    elements = list(writer.CUSTOM_ELEMENTS)[:3]
+
+    def assemble():
+        writer.build_prompt("The river remembered every stone it had carried.", "sci-fi", elements, character, references)
+
+    samples = time_calls(assemble, iterations)
+    result = summarize(samples)
+    result["prompts_per_second"] = round(len(samples) / sum(samples), 1)
+    result["prompt_chars"] = len(writer.build_prompt("The river remembered every stone it had carried.", "sci-fi", elements, character, references))
+    return result
+
+def bench_config_parsing(character_count, element_count, repeat):
+    characters_content = synthetic_characters(character_count)
+    elements_content = synthetic_elements(element_count)
+    characters = summarize(time_calls(lambda: writer.parse_characters_file(characters_content), repeat))
+    characters["entries"] = character_count
+    elements = summarize(time_calls(lambda: writer.parse_elements_file(elements_content), repeat))
+    elements["entries"] = element_count
+
+    # Startup path: the first load compiles the cache, later ones only check it
+    folder = tempfile.mkdtemp(prefix="cowriter-bench-library-")
+    original_cache_dir = writer.LIBRARY_CACHE_DIR
+    try:
+        writer.LIBRARY_CACHE_DIR = folder
+        for result, kind, content, parse in ((characters, "characters", characters_content, writer.parse_characters_file),
+                                             (elements, "elements", elements_content, writer.parse_elements_file)):
+            source_path = os.path.join(folder, f"{kind}.txt")
+            with open(source_path, "w", encoding="utf-8") as file:
+                file.write(content)
+            result["compile_ms"] = round(time_calls(lambda: writer.load_library(source_path, kind, parse), 1)[0] * 1000, 3)
+            result["cached"] = summarize(time_calls(lambda: writer.load_library(source_path, kind, parse), repeat))
+    finally:
+        writer.LIBRARY_CACHE_DIR = original_cache_dir
+        shutil.rmtree(folder, ignore_errors=True)
+    return {"characters": characters, "elements": elements}
+
+def bench_reference_extraction(files_per_format, paragraphs_per_file, repeat):
+    folder = tempfile.mkdtemp(prefix="cowriter-bench-refs-")
+    original_folder = writer.REFERENCE_FOLDER
+    original_store_dir = writer.REFERENCE_STORE_DIR
+    try:
+        formats = build_reference_corpus(folder, files_per_format, paragraphs_per_file)
+        writer.REFERENCE_FOLDER = folder
+        loaded = []
+
+        def load(fresh_store):
+            # A fresh corpus store forces extraction; reusing it measures a warm start
+            if fresh_store:
+                writer.REFERENCE_STORE_DIR = tempfile.mkdtemp(prefix="store-", dir=folder)
+                writer._reference_store = None
+            loaded[:] = writer.load_reference_materials()
+
+        result = summarize(time_calls(lambda: load(True), repeat))
+        result["cached"] = summarize(time_calls(lambda: load(False), repeat))
+        result.update({"formats": formats, "files": files_per_format * len(formats), "loaded": len(loaded)})
+        return result
+    finally:
+        writer.REFERENCE_FOLDER = original_folder
+        writer.REFERENCE_STORE_DIR = original_store_dir
+        writer._reference_store = None
+        shutil.rmtree(folder, ignore_errors=True)
+
+def configure_for_mock(server):
+    """Point every provider at the mock server"""
+    writer.HTTP_TRANSPORT_MODE = "passthrough"
+    writer.OLLAMA_ROUTER = writer.OllamaRouter([server.base_url])
+    writer.OPENAI_BASE_URL = f"{server.base_url}/v1"
+    writer.update_engine_state(openai_api_key="sk-mock")
+    writer.HUGGINGFACE_BASE_URL = server.base_url
+    writer.LOCAL_OPENAI_BASE_URL = f"{server.base_url}/v1"
+
+def bench_end_to_end(requests_per_case, tokens_per_second, first_token_latency, max_tokens):
+    server = start_mock_server(tokens_per_second=tokens_per_second, first_token_latency=first_token_latency,
+                               max_output_tokens=max_tokens, parallel=8)
+    configure_for_mock(server)
+    cases = {"ollama": "neural-chat", "openai-chat": "gpt-4", "openai-completions": "gpt-3.5-turbo-instruct",
+             "huggingface": "microsoft/DialoGPT-medium"}
+    character = next(iter(writer.WRITER_CHARACTERS), None)
+    results = {}
+    try:
+        for case, model_name in cases.items():
+            for streaming in (True, False):
+                totals = []
+                first_tokens = []
+                for _ in range(requests_per_case):
+                    start = time.perf_counter()
+                    first_token = []
+
+                    def on_token(delta):
+                        if not first_token:
+                            first_token.append(time.perf_counter() - start)
+
+                    writer.co_write("The river remembered every stone.", "sci-fi", None, character, model_name,
+                                    on_token=on_token if streaming else None, max_tokens=max_tokens)
+                    totals.append(time.perf_counter() - start)
+                    if first_token:
+                        first_tokens.append(first_token[0])
+                result = summarize(totals)
+                if first_tokens:
+                    result["time_to_first_token"] = summarize(first_tokens)
+                results[f"{case}/{'stream' if streaming else 'blocking'}"] = result
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+def flatten(results, prefix=""):
+    """Yield (metric path, value) pairs for every mean_ms in a result tree"""
+    for key, value in results.items():
+        path = f"{prefix}/{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from flatten(value, path)
+        elif key == "mean_ms":
+            yield path, value
+
+def compare(current, previous_path):
+    with open(previous_path, "r", encoding="utf-8") as file:
+        previous = dict(flatten(json.load(file)["results"]))
+    print(f"\nComparison with {previous_path} (mean latency, lower is better):")
+    for path, value in flatten(current):
+        if path in previous and previous[path]:
+            change = (value - previous[path]) / previous[path] * 100
+            print(f"  {path:60s} {previous[path]:10.3f} -> {value:10.3f} ms ({change:+.1f}%)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the text co-writer")
+    parser.add_argument("--quick", action="store_true", help="Use small sizes for a fast smoke run")
+    parser.add_argument("--only", choices=["prompt", "parsing", "references", "end_to_end"], action="append",
+                        help="Run only the named benchmark (may be repeated)")
+    parser.add_argument("--output", help="JSON results file (default: bench_results/benchmark-<timestamp>.json)")
+    parser.add_argument("--compare", help="Previous results file to compare against")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="Mock server generation speed")
+    parser.add_argument("--first-token-latency", type=float, default=0.05, help="Mock server time to first token")
+    args = parser.parse_args()
+
+    selected = set(args.only or ["prompt", "parsing", "references", "end_to_end"])
+    scale = 0.1 if args.quick else 1.0
+    results = {}
+
+    print("\n⏱  Running benchmarks...")
+    if "prompt" in selected:
+        results["prompt_assembly"] = bench_prompt_assembly(int(20000 * scale))
+        print(f"Prompt assembly: {results['prompt_assembly']['prompts_per_second']:,} prompts/s")
+    if "parsing" in selected:
+        results["config_parsing"] = bench_config_parsing(int(5000 * scale), int(20000 * scale), 5)
+        print(f"Parsing: characters {results['config_parsing']['characters']['mean_ms']} ms, "
+              f"elements {results['config_parsing']['elements']['mean_ms']} ms "
+              f"({results['config_parsing']['characters']['cached']['mean_ms']} / "
+              f"{results['config_parsing']['elements']['cached']['mean_ms']} ms from the compiled cache)")
+    if "references" in selected:
+        results["reference_extraction"] = bench_reference_extraction(max(2, int(20 * scale)), 200, 3)
+        print(f"Reference extraction: {results['reference_extraction']['mean_ms']} ms "
+              f"for {results['reference_extraction']['files']} files "
+              f"({results['reference_extraction']['cached']['mean_ms']} ms from the corpus store)")
+    if "end_to_end" in selected:
+        results["end_to_end"] = bench_end_to_end(max(3, int(20 * scale)), args.tokens_per_second, args.first_token_latency,
+                                                 max_tokens=int(300 * scale) or 30)
+        for case, result in results["end_to_end"].items():
+            print(f"End to end {case}: mean {result['mean_ms']} ms, p95 {result['p95_ms']} ms")
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "results": results
+    }
+    output_path = args.output or os.path.join("bench_results", f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"\n✅ Results written to {output_path}")
+
+    if args.compare:
+        compare(results, args.compare)
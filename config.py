@@ -5,8 +5,32 @@
 OPENAI_API_KEY = ""  # Get from https://platform.openai.com/api-keys
 HUGGINGFACE_API_KEY = "your-huggingface-api-key-here"  # Get from https://huggingface.co/settings/tokens
 
+# OpenAI endpoint (uncomment to use a proxy or compatible gateway)
+# OPENAI_BASE_URL = "https://api.openai.com/v1"
+
+# Hugging Face endpoint ({model} is replaced by the model name)
+# HUGGINGFACE_BASE_URL = "http://localhost:8080"  # Self-hosted text-generation-inference server
+
+# Local OpenAI-compatible server (llama.cpp server, vLLM, LocalAI); its models are discovered via /v1/models
+# LOCAL_OPENAI_BASE_URL = "http://localhost:8080/v1"
+# LOCAL_OPENAI_API_KEY = ""  # Only if the server was started with --api-key
+# LOCAL_OPENAI_CHAT = True  # False sends raw prompts to /v1/completions
+# LOCAL_OPENAI_MAX_CONCURRENCY = 0  # Requests in flight at once; 0 = server's slot count (llama.cpp) or 4
+
 # Ollama Configuration
 OLLAMA_BASE_URL = "http://localhost:11434"
+# Spread requests over several Ollama servers (uncomment and list them all)
+# OLLAMA_HOSTS = ["http://localhost:11434", "http://cpu-node-2:11434", "http://cpu-node-3:11434"]
+
+# Ollama runtime options (uncomment to tune)
+# OLLAMA_DEFAULT_OPTIONS = {"top_p": 0.9, "repeat_penalty": 1.1}
+# OLLAMA_MODEL_PROFILES = {
+#     "mistral": {"num_batch": 256, "repeat_penalty": 1.15},
+#     "llama2": {"num_ctx": 4096},  # A fixed num_ctx turns off automatic sizing for this model
+# }
+# OLLAMA_AUTO_CONTEXT = True  # num_ctx = prompt tokens + num_predict, rounded up to a bucket
+# OLLAMA_CONTEXT_BUCKETS = [2048, 4096, 8192, 16384, 32768]
+# OLLAMA_HOST_THREADS = {"http://localhost:11434": 8, "http://cpu-node-2:11434": 16}  # Physical cores per host
 
 # Default settings
 DEFAULT_MODEL = "neural-chat"  # Options: neural-chat, mistral, llama2, gpt-3.5-turbo-instruct
@@ -15,3 +39,66 @@ DEFAULT_CHARACTER = "cyra"
 
 # Model preferences (uncomment to set defaults)
 # PREFERRED_MODELS = ["neural-chat", "mistral", "llama2"]  # Order of preference for local models
+
+# Request retries (uncomment to override the defaults)
+# REQUEST_DEADLINE = 180  # Total seconds allowed per generation, retries included
+# RETRY_MAX_ATTEMPTS = 4  # Attempts before giving up on transient or rate-limit errors
+# HUGGINGFACE_WAIT_FOR_MODEL = True  # After a 503 for a cold Hugging Face model, hold the retry until it loads
+
+# Adaptive timeouts (uncomment to override the defaults)
+# ADAPTIVE_TIMEOUTS = True  # Derive timeouts from each model's measured speed on each host
+# ADAPTIVE_TIMEOUT_FACTOR = 3.0  # Give up after this many times the expected wait
+# ADAPTIVE_MIN_TIMEOUT = 10  # Seconds
+# LATENCY_TARGET = 10  # Aim for answers within 10 seconds by shortening them on slow models
+
+# Share one model call between identical deterministic requests (fixed seed or temperature 0) in flight together
+# SINGLE_FLIGHT = True
+
+# Early stopping (uncomment to override the defaults)
+# EARLY_STOP = True  # Stop generating when output turns into meta text or repetition loops
+# STOP_SEQUENCES = ["USER'S NARRATIVE TO CONTINUE:", "FINAL INSTRUCTION:"]
+# REPETITION_NGRAM_SIZE = 6  # Words per phrase checked for loops
+# REPETITION_MAX_REPEATS = 3  # Stop once the same phrase appears this many times
+
+# Best-of-N sampling: generate several samples in parallel and keep the best (1 = off)
+# BEST_OF_N = 1
+
+# Session journal for 'python text_co_writer.py --resume'
+# SESSION_JOURNAL_FILE = "session_journal.jsonl"
+# JOURNAL_FSYNC_INTERVAL = 1.0  # Seconds between disk syncs
+
+# Speculative prefetch: prepare the next 'continue' in the background while you read
+# SPECULATIVE_PREFETCH = False
+# SPECULATIVE_MAX_WASTED_TOKENS = 3000  # Pause speculation after this many unused tokens per session
+
+# Record/replay of model API traffic for offline runs, regression checks and benchmarks
+# HTTP_TRANSPORT_MODE = "passthrough"  # "record" saves live traffic, "replay" serves it without a network
+# CASSETTE_FILE = "cassette.jsonl"
+# REPLAY_TIME_SCALE = 0.0  # 1.0 reproduces the recorded streaming speed, 0 replays instantly
+
+# Profiling reports ('--profile' or 'profile on/off'): where they go and how much they list
+# PROFILE_REPORT_DIR = "profiles"
+# PROFILE_TOP_FUNCTIONS = 25
+# PROFILE_TOP_ALLOCATIONS = 15
+
+# Automatic reload when characters.txt, custom_elements.txt or reference_materials/ change
+# FILE_WATCH = True
+# FILE_WATCH_BACKEND = "auto"  # "inotify" (Linux), "poll", or "auto" to pick inotify when available
+# FILE_WATCH_DEBOUNCE = 0.5  # Quiet seconds before a burst of changes is reloaded
+
+# Semantic retrieval of reference passages (needs numpy: pip install numpy)
+# SEMANTIC_RETRIEVAL = False
+# EMBEDDING_BACKEND = "ollama"  # "ollama" or "hash" (model-free stand-in for tests)
+# EMBEDDING_MODEL = "nomic-embed-text"  # Install with: ollama pull nomic-embed-text
+# RETRIEVAL_TOP_K = 4
+# VECTOR_CACHE_DIR = ".reference_cache"
+# REFERENCE_STORE_DIR = ".reference_cache"  # Extracted reference text (safe to delete; rebuilt on start)
+
+# Near-duplicate reference passages (drafts, versions) are sent only once
+# DEDUP_REFERENCES = True
+# DEDUP_SIMILARITY = 0.75  # Estimated share of shared 4-word sequences needed to count as a duplicate
+
+# Large characters/elements files: compiled cache and paged selection menus
+# LIBRARY_CACHE = True  # Reuse the parsed files until their content changes
+# LIBRARY_CACHE_DIR = ".reference_cache"  # Safe to delete; rebuilt on start
+# MENU_PAGE_SIZE = 20  # Entries per menu page ('more' pages on, '/text' searches)
@@ -101,7 +101,7 @@ fi
 print_status "Installing Python dependencies in virtual environment..."
 source venv/bin/activate
 pip install --upgrade pip
-pip install openai requests PyPDF2 python-docx
+pip install requests PyPDF2 python-docx
 
 print_success "Python dependencies installed in virtual environment!"
 
@@ -349,7 +349,6 @@ This project uses a virtual environment to avoid conflicts with system Python pa
 
 ## Dependencies
 
-- **openai**: OpenAI API client
 - **requests**: HTTP library
 - **PyPDF2**: PDF text extraction
 - **python-docx**: Word document text extraction
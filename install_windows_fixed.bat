@@ -181,10 +181,10 @@ if %errorlevel% neq 0 (
 
 REM Install required Python packages
 echo [INFO] Installing Python dependencies...
-pip install openai requests PyPDF2 python-docx
+pip install requests PyPDF2 python-docx
 if %errorlevel% neq 0 (
     echo [WARNING] Failed to install packages globally. Trying with --user flag...
-    pip install --user openai requests PyPDF2 python-docx
+    pip install --user requests PyPDF2 python-docx
     if %errorlevel% neq 0 (
         echo [ERROR] Failed to install packages.
         echo.
@@ -195,7 +195,6 @@ if %errorlevel% neq 0 (
         echo 2. Try running as Administrator
         echo 3. Try updating pip: python -m pip install --upgrade pip
         echo 4. Try installing packages one by one:
-        echo    pip install openai
         echo    pip install requests
         echo    pip install PyPDF2
         echo    pip install python-docx
@@ -491,7 +490,6 @@ echo - Internet connection ^(for cloud models^)
 echo.
 echo ## Dependencies
 echo.
-echo - **openai**: OpenAI API client
 echo - **requests**: HTTP library
 echo - **PyPDF2**: PDF text extraction
 echo - **python-docx**: Word document text extraction
@@ -586,7 +584,6 @@ echo    ```
 echo.
 echo 2. **Install packages one by one:**
 echo    ```cmd
-echo    pip install openai
 echo    pip install requests
 echo    pip install PyPDF2
 echo    pip install python-docx
@@ -594,7 +591,7 @@ echo    ```
 echo.
 echo 3. **Try with --user flag:**
 echo    ```cmd
-echo    pip install --user openai requests PyPDF2 python-docx
+echo    pip install --user requests PyPDF2 python-docx
 echo    ```
 echo.
 echo 4. **Check internet connection**
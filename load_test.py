@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""Load test: how many simultaneous writers can one deployment serve?
+
+Simulates concurrent writer sessions that drive the co-writer engine
+in-process (co_write) against local mock model servers. Each session waits a
+randomised think time, sends a prompt of randomised length, and now and then
+switches style, character or model. Concurrency ramps up step by step and
+each step reports throughput (requests and estimated tokens per second),
+p50/p99 latency, time to first token and error rate:
+
+    python load_test.py --levels 1,2,4,8,16 --step-seconds 20
+    python load_test.py --hosts 3 --parallel 2   # three Ollama nodes behind the router
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+
+import text_co_writer as writer
+from benchmark import configure_for_mock
+from mock_model_server import MOCK_TEXT, start_mock_server
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+class WriterSession(threading.Thread):
+    """One simulated writer: think, prompt, read the answer, sometimes change settings"""
+
+    def __init__(self, number, stop_event, results, lock, settings):
+        super().__init__(daemon=True)
+        self.random = random.Random(number)
+        self.stop_event = stop_event
+        self.results = results
+        self.lock = lock
+        self.settings = settings
+        self.style = self.random.choice(list(writer.STYLES))
+        self.character = self.random.choice(list(writer.WRITER_CHARACTERS))
+        self.model = self.pick_model()
+
+    def pick_model(self):
+        models, weights = zip(*self.settings["model_mix"].items())
+        return self.random.choices(models, weights)[0]
+
+    def think(self):
+        # Log-normal think times: mostly short pauses, occasionally a long read
+        mean = self.settings["think_time"]
+        if mean > 0:
+            self.stop_event.wait(self.random.lognormvariate(0, 0.75) * mean / 1.32)
+
+    def make_prompt(self):
+        length = max(3, int(self.random.lognormvariate(3.0, 0.8)))  # Median of about 20 words
+        return " ".join(self.random.choice(MOCK_TEXT) for _ in range(length))
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.think()
+            if self.stop_event.is_set():
+                break
+
+            switch = self.random.random()
+            if switch < self.settings["switch_rate"]:
+                self.style = self.random.choice(list(writer.STYLES))
+            elif switch < self.settings["switch_rate"] * 2:
+                self.character = self.random.choice(list(writer.WRITER_CHARACTERS))
+            elif switch < self.settings["switch_rate"] * 3:
+                self.model = self.pick_model()
+
+            start = time.perf_counter()
+            first_token = []
+
+            def on_token(delta):
+                if not first_token:
+                    first_token.append(time.perf_counter() - start)
+
+            record = {"model": self.model, "finished": None, "latency": None, "ttft": None, "error": None}
+            try:
+                continuation = writer.co_write(self.make_prompt(), self.style, None, self.character, self.model,
+                                               on_token=on_token, max_tokens=self.settings["max_tokens"],
+                                               deadline=time.monotonic() + self.settings["deadline"])
+                record["latency"] = time.perf_counter() - start
+                record["ttft"] = first_token[0] if first_token else record["latency"]
+                record["est_tokens"] = writer.count_reply_tokens(continuation)
+            except Exception as e:
+                record["error"] = str(e)
+            record["finished"] = time.perf_counter()
+            with self.lock:
+                self.results.append(record)
+
+def run_step(concurrency, seconds, settings):
+    """Run `concurrency` sessions for `seconds` and summarise the requests that finished"""
+    stop_event = threading.Event()
+    results = []
+    lock = threading.Lock()
+    sessions = [WriterSession(number, stop_event, results, lock, settings) for number in range(concurrency)]
+    coalesced = writer.SINGLE_FLIGHT_GROUP.coalesced
+    start = time.perf_counter()
+    for session in sessions:
+        session.start()
+    time.sleep(seconds)
+    stop_event.set()
+    for session in sessions:
+        session.join(settings["deadline"] + 5)
+    elapsed = time.perf_counter() - start
+
+    completed = [record for record in results if not record["error"]]
+    latencies = [record["latency"] for record in completed]
+    first_tokens = [record["ttft"] for record in completed]
+
+    def ms(value):
+        return round(value * 1000, 1) if value is not None else None
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "throughput_rps": round(len(completed) / elapsed, 3),
+        "est_tokens_per_second": round(sum(record.get("est_tokens", 0) for record in completed) / elapsed, 1),
+        "latency_p50_ms": ms(percentile(latencies, 0.50)),
+        "latency_p99_ms": ms(percentile(latencies, 0.99)),
+        "ttft_p50_ms": ms(percentile(first_tokens, 0.50)),
+        "ttft_p99_ms": ms(percentile(first_tokens, 0.99)),
+        "error_rate": round(1 - len(completed) / len(results), 3) if results else 0.0,
+        "coalesced": writer.SINGLE_FLIGHT_GROUP.coalesced - coalesced,
+        "errors": sorted({record["error"] for record in results if record["error"]})[:5]
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the co-writer engine against mock model servers")
+    parser.add_argument("--levels", default="1,2,4,8,16", help="Comma-separated concurrency levels to ramp through")
+    parser.add_argument("--step-seconds", type=float, default=20, help="Duration of each concurrency level")
+    parser.add_argument("--think-time", type=float, default=2.0, help="Mean seconds a writer pauses between prompts")
+    parser.add_argument("--switch-rate", type=float, default=0.1, help="Chance per prompt of changing style, character or model")
+    parser.add_argument("--max-tokens", type=int, default=150)
+    parser.add_argument("--deadline", type=float, default=60, help="Per-request deadline in seconds")
+    parser.add_argument("--hosts", type=int, default=1, help="Number of mock Ollama hosts behind the router")
+    parser.add_argument("--parallel", type=int, default=4, help="Concurrent generations per mock host")
+    parser.add_argument("--tokens-per-second", type=float, default=30.0, help="Mock generation speed per request")
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--model-mix", default="neural-chat=6,mistral=2,gpt-4=1,microsoft/DialoGPT-medium=1",
+                        help="Weighted models the sessions choose from")
+    parser.add_argument("--output", help="Write the per-step results to this JSON file")
+    args = parser.parse_args()
+
+    servers = [start_mock_server(tokens_per_second=args.tokens_per_second, first_token_latency=args.first_token_latency,
+                                 parallel=args.parallel) for _ in range(args.hosts)]
+    configure_for_mock(servers[0])
+    writer.OLLAMA_ROUTER = writer.OllamaRouter([server.base_url for server in servers])
+
+    settings = {
+        "think_time": args.think_time,
+        "switch_rate": args.switch_rate,
+        "max_tokens": args.max_tokens,
+        "deadline": args.deadline,
+        "model_mix": {name: float(weight) for name, weight in (item.rsplit("=", 1) for item in args.model_mix.split(","))}
+    }
+
+    print(f"\n🏋️  Load test: {args.hosts} mock host(s), {args.parallel} parallel generations each, "
+          f"{args.tokens_per_second:g} tokens/s per request")
+    print(f"{'sessions':>8} {'req':>6} {'req/s':>7} {'~tok/s':>8} {'p50 ms':>9} {'p99 ms':>9} {'ttft p50':>9} {'ttft p99':>9} {'errors':>7} {'shared':>7}")
+    steps = []
+    for level in [int(level) for level in args.levels.split(",")]:
+        step = run_step(level, args.step_seconds, settings)
+        steps.append(step)
+        print(f"{step['concurrency']:>8} {step['requests']:>6} {step['throughput_rps']:>7} {step['est_tokens_per_second']:>8} "
+              f"{step['latency_p50_ms']!s:>9} {step['latency_p99_ms']!s:>9} {step['ttft_p50_ms']!s:>9} {step['ttft_p99_ms']!s:>9} "
+              f"{step['error_rate']:>7.1%} {step['coalesced']:>7}")
+        for error in step["errors"]:
+            print(f"         ❌ {error}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump({"settings": vars(args), "steps": steps}, file, indent=2)
+        print(f"\n✅ Results written to {args.output}")
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""Local stand-in for the model servers used by text_co_writer.py.
+
+Speaks enough of the Ollama, OpenAI and Hugging Face (text-generation-inference)
+wire formats for benchmarks, load tests and offline development. Output is
+generated word by word at a configurable token rate, after a configurable
+time-to-first-token, and at most `parallel` requests generate at once so the
+server saturates like a real CPU inference node.
+
+Run standalone:
+    python mock_model_server.py --port 11435 --tokens-per-second 40
+
+then point OLLAMA_HOSTS, OPENAI_BASE_URL or LOCAL_OPENAI_BASE_URL
+("http://127.0.0.1:11435/v1") or HUGGINGFACE_BASE_URL ("http://127.0.0.1:11435") at it.
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MOCK_MODELS = ["neural-chat", "mistral", "llama2", "codellama", "gpt-3.5-turbo-instruct", "gpt-4"]
+
+MOCK_TEXT = (
+    "The river remembered every stone it had ever carried, and in the blue hour the stones "
+    "remembered back. Moss climbed the old antennas like a slow green rumor, translating "
+    "static into spores. Somewhere beneath the glacier a seed was counting its own heartbeats, "
+    "patient as arithmetic, waiting for the thaw to finish its long sentence. The bees that were "
+    "not quite bees hummed in a key no one had written down, and the city listened."
+).split()
+
+class MockModelServer(ThreadingHTTPServer):
+    """HTTP server holding the simulated model settings and request statistics"""
+
+    daemon_threads = True
+
+    def __init__(self, address, tokens_per_second=40.0, first_token_latency=0.2, max_output_tokens=300,
+                 parallel=4, models=None, embedding_size=64):
+        super().__init__(address, MockModelHandler)
+        self.tokens_per_second = tokens_per_second
+        self.first_token_latency = first_token_latency
+        self.max_output_tokens = max_output_tokens
+        self.embedding_size = embedding_size
+        self.models = list(models or MOCK_MODELS)
+        self.loaded_models = set()
+        self.parallel = parallel
+        self.slots = threading.Semaphore(parallel)
+        self.stats_lock = threading.Lock()
+        self.requests_served = 0
+        self.tokens_generated = 0
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def generate_words(self, prompt, max_tokens, seed=None):
+        """Deterministic pseudo-text for a prompt: the same request always gets the same words"""
+        if seed is None:
+            seed = int(hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8], 16)
+        generator = random.Random(seed)
+        count = min(max_tokens or self.max_output_tokens, self.max_output_tokens)
+        return [("" if index == 0 else " ") + generator.choice(MOCK_TEXT) for index in range(count)]
+
+class MockModelHandler(BaseHTTPRequestHandler):
+    server_version = "MockModelServer/1.0"
+
+    def log_message(self, format, *args):
+        pass
+
+    # Helpers
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def start_stream(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+    def write_chunk(self, text):
+        self.wfile.write(text.encode("utf-8"))
+        self.wfile.flush()
+
+    def generate(self, model, prompt, max_tokens, seed, write_token):
+        """Produce words at the configured rate, holding one of the server's generation slots"""
+        server = self.server
+        words = server.generate_words(prompt, max_tokens, seed)
+        with server.slots:
+            server.loaded_models.add(model)
+            time.sleep(server.first_token_latency)
+            delay = 1.0 / server.tokens_per_second if server.tokens_per_second > 0 else 0
+            produced = 0
+            try:
+                for word in words:
+                    write_token(word)
+                    produced += 1
+                    if delay:
+                        time.sleep(delay)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # Client cancelled; stop generating like a real server would
+            finally:
+                with server.stats_lock:
+                    server.requests_served += 1
+                    server.tokens_generated += produced
+        return words
+
+    # Routing
+
+    def do_GET(self):
+        server = self.server
+        if self.path == "/api/tags":
+            self.send_json({"models": [{"name": f"{model}:latest", "model": f"{model}:latest"} for model in server.models]})
+        elif self.path == "/api/ps":
+            self.send_json({"models": [{"name": f"{model}:latest", "model": f"{model}:latest"} for model in sorted(server.loaded_models)]})
+        elif self.path == "/v1/models":
+            self.send_json({"object": "list", "data": [{"id": model, "object": "model", "owned_by": "mock"} for model in server.models]})
+        elif self.path == "/props":
+            # llama.cpp server reports how many sequences it decodes together
+            self.send_json({"total_slots": server.parallel})
+        elif self.path in ("/health", "/"):
+            self.send_json({"status": "ok"})
+        else:
+            self.send_json({"error": f"not found: {self.path}"}, status=404)
+
+    def do_POST(self):
+        try:
+            payload = self.read_json()
+        except ValueError:
+            self.send_json({"error": "invalid JSON"}, status=400)
+            return
+
+        if self.path == "/api/generate":
+            self.ollama_generate(payload)
+        elif self.path in ("/api/embeddings", "/api/embed"):
+            self.ollama_embeddings(payload)
+        elif self.path in ("/v1/completions", "/v1/chat/completions"):
+            self.openai_completion(payload, chat=self.path.endswith("chat/completions"))
+        elif self.path in ("/", "/generate", "/generate_stream") or self.path.startswith("/models/"):
+            self.huggingface_generate(payload)
+        else:
+            self.send_json({"error": f"not found: {self.path}"}, status=404)
+
+    # Ollama
+
+    def ollama_generate(self, payload):
+        model = payload.get("model", "")
+        options = payload.get("options") or {}
+        max_tokens = options.get("num_predict")
+        prompt = payload.get("prompt", "")
+
+        if payload.get("stream", True):
+            self.start_stream("application/x-ndjson")
+
+            def write_token(word):
+                self.write_chunk(json.dumps({"model": model, "response": word, "done": False}) + "\n")
+
+            words = self.generate(model, prompt, max_tokens, options.get("seed"), write_token)
+            try:
+                self.write_chunk(json.dumps({"model": model, "response": "", "done": True, "eval_count": len(words)}) + "\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        else:
+            words = self.generate(model, prompt, max_tokens, options.get("seed"), lambda word: None)
+            self.send_json({"model": model, "response": "".join(words), "done": True, "eval_count": len(words)})
+
+    def ollama_embeddings(self, payload):
+        text = payload.get("prompt") or payload.get("input") or ""
+        if isinstance(text, list):
+            self.send_json({"embeddings": [self.embed(item) for item in text]})
+        else:
+            self.send_json({"embedding": self.embed(text)})
+
+    def embed(self, text):
+        # Hashed bag of words: similar texts get similar vectors
+        vector = [0.0] * self.server.embedding_size
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            vector[digest[0] % len(vector)] += 1.0 if digest[1] % 2 else -1.0
+        return vector
+
+    # OpenAI
+
+    def openai_completion(self, payload, chat):
+        model = payload.get("model", "")
+        if chat:
+            prompt = "\n".join(message.get("content", "") for message in payload.get("messages", []))
+        else:
+            prompt = payload.get("prompt", "")
+        max_tokens = payload.get("max_tokens")
+        seed = payload.get("seed")
+        object_name = "chat.completion" if chat else "text_completion"
+
+        if payload.get("stream"):
+            self.start_stream("text/event-stream")
+
+            def write_token(word):
+                choice = {"index": 0, "finish_reason": None}
+                if chat:
+                    choice["delta"] = {"content": word}
+                else:
+                    choice["text"] = word
+                event = {"id": "mock", "object": f"{object_name}.chunk" if chat else object_name,
+                         "created": int(time.time()), "model": model, "choices": [choice]}
+                self.write_chunk(f"data: {json.dumps(event)}\n\n")
+
+            words = self.generate(model, prompt, max_tokens, seed, write_token)
+            try:
+                if (payload.get("stream_options") or {}).get("include_usage"):
+                    self.write_chunk(f"data: {json.dumps({'id': 'mock', 'model': model, 'choices': [], 'usage': {'completion_tokens': len(words)}})}\n\n")
+                self.write_chunk("data: [DONE]\n\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        else:
+            words = self.generate(model, prompt, max_tokens, seed, lambda word: None)
+            text = "".join(words)
+            choice = {"index": 0, "finish_reason": "length"}
+            if chat:
+                choice["message"] = {"role": "assistant", "content": text}
+            else:
+                choice["text"] = text
+            self.send_json({"id": "mock", "object": object_name, "created": int(time.time()), "model": model,
+                            "choices": [choice], "usage": {"completion_tokens": len(words)}})
+
+    # Hugging Face / text-generation-inference
+
+    def huggingface_generate(self, payload):
+        model = self.path[len("/models/"):] if self.path.startswith("/models/") else "tgi"
+        parameters = payload.get("parameters") or {}
+        prompt = payload.get("inputs", "")
+        max_tokens = parameters.get("max_new_tokens")
+        seed = parameters.get("seed")
+
+        if payload.get("stream") or self.path == "/generate_stream":
+            self.start_stream("text/event-stream")
+
+            def write_token(word):
+                event = {"token": {"id": 0, "text": word, "logprob": 0.0, "special": False}, "generated_text": None, "details": None}
+                self.write_chunk(f"data:{json.dumps(event)}\n\n")
+
+            words = self.generate(model, prompt, max_tokens, seed, write_token)
+            # text-generation-inference ends the stream with the totals
+            event = {"token": {"id": 0, "text": "", "logprob": 0.0, "special": True}, "generated_text": "".join(words),
+                     "details": {"finish_reason": "length", "generated_tokens": len(words)}}
+            try:
+                self.write_chunk(f"data:{json.dumps(event)}\n\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        else:
+            words = self.generate(model, prompt, max_tokens, seed, lambda word: None)
+            text = "".join(words)
+            if parameters.get("return_full_text", True):
+                text = prompt + text
+            # TGI answers with an object, the hosted Inference API with a list
+            if self.path.startswith("/models/"):
+                self.send_json([{"generated_text": text}])
+            else:
+                self.send_json({"generated_text": text})
+
+def start_mock_server(host="127.0.0.1", port=0, **settings):
+    """Start a MockModelServer in a background thread and return it (port 0 picks a free port)"""
+    server = MockModelServer((host, port), **settings)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Ollama / OpenAI / Hugging Face server for benchmarks and offline runs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--tokens-per-second", type=float, default=40.0, help="Generation speed per request")
+    parser.add_argument("--first-token-latency", type=float, default=0.2, help="Seconds before the first token")
+    parser.add_argument("--max-output-tokens", type=int, default=300, help="Upper bound on tokens per response")
+    parser.add_argument("--parallel", type=int, default=4, help="Requests generating at the same time; others queue")
+    args = parser.parse_args()
+
+    server = MockModelServer((args.host, args.port), tokens_per_second=args.tokens_per_second,
+                             first_token_latency=args.first_token_latency,
+                             max_output_tokens=args.max_output_tokens, parallel=args.parallel)
+    print(f"🧪 Mock model server listening on {server.base_url}")
+    print(f"   Ollama: {server.base_url}  OpenAI: {server.base_url}/v1  Hugging Face: {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nStopped.")
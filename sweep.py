@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Grid sweep: the same prompts across styles, writer characters and models.
+
+Every prompt x style x character x model combination is one cell. Cells with
+the same model, style and prompt share everything in the compiled prompt up to
+the character description, so they form a lane that runs back to back on one
+Ollama host, where the server can reuse the cached prefix. Up to --concurrency
+lanes run at once. Each cell's latency, time to first token, estimated token
+count (about four characters a token, the same for every provider so cells
+compare) and text go to a CSV table:
+
+    python sweep.py --prompt "The river remembered every stone" --models neural-chat,mistral
+    python sweep.py --prompts-file prompts.txt --styles sci-fi,poetry --concurrency 4
+    python sweep.py --prompt "Test" --mock-hosts 2   # against local mock servers
+"""
+
+import argparse
+import csv
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import text_co_writer as writer
+
+RESULT_FIELDS = ["model", "style", "character", "prompt_index", "host", "latency_ms", "ttft_ms", "est_tokens", "words",
+                 "stop_reason", "error", "text"]
+
+def expand_grid(prompts, styles, characters, models):
+    return [{"prompt_index": index, "prompt": prompt, "style": style, "character": character, "model": model}
+            for model in models for index, prompt in enumerate(prompts) for style in styles for character in characters]
+
+def get_model_hosts(model_name):
+    """Ollama hosts that have the model installed ([None] lets the router or another provider decide)"""
+    if writer.get_model_provider(model_name) != "ollama":
+        return [None]
+    router = writer.OLLAMA_ROUTER
+    router.probe_all()
+    return [host for host, state in router.hosts.items() if model_name in state["installed"]] or [None]
+
+def plan_lanes(cells, reference_materials):
+    """Group cells into lanes that share a prompt prefix and pin each lane to a host.
+
+    Cells are sorted by model and compiled prompt so neighbours share the
+    longest prefixes; lanes of a model are spread round-robin over the hosts
+    that have it installed.
+    """
+    state = writer.ENGINE_STATE
+    for cell in cells:
+        cell["full_prompt"] = writer.build_prompt(cell["prompt"], cell["style"], None, cell["character"],
+                                                  reference_materials, state)
+    cells.sort(key=lambda cell: (cell["model"], cell["full_prompt"]))
+
+    lanes = {}
+    for cell in cells:
+        lanes.setdefault((cell["model"], cell["style"], cell["prompt"]), []).append(cell)
+
+    model_hosts = {}
+    lanes_per_model = {}
+    for (model_name, _, _), lane in lanes.items():
+        hosts = model_hosts.setdefault(model_name, get_model_hosts(model_name))
+        index = lanes_per_model.get(model_name, 0)
+        lanes_per_model[model_name] = index + 1
+        for cell in lane:
+            cell["host"] = hosts[index % len(hosts)]
+    return list(lanes.values())
+
+def run_cell(cell, reference_materials, settings):
+    start = time.perf_counter()
+    first_token = []
+
+    def on_token(delta):
+        if not first_token:
+            first_token.append(time.perf_counter() - start)
+
+    try:
+        text = writer.co_write(cell["prompt"], cell["style"], None, cell["character"], cell["model"], reference_materials,
+                               deadline=time.monotonic() + settings["deadline"], on_token=on_token,
+                               max_tokens=settings["max_tokens"], seed=settings["seed"], preferred_host=cell["host"])
+        cell.update(text=str(text), est_tokens=writer.count_reply_tokens(text), words=len(text.split()),
+                    stop_reason=text.stop_reason or "", error="")
+    except Exception as e:
+        cell.update(text="", est_tokens=0, words=0, stop_reason="", error=str(e))
+    latency = time.perf_counter() - start
+    cell["latency_ms"] = round(latency * 1000, 1)
+    cell["ttft_ms"] = round((first_token[0] if first_token else latency) * 1000, 1)
+
+def run_sweep(lanes, reference_materials, settings, concurrency):
+    """Run lanes on up to `concurrency` threads, each lane's cells one after another"""
+    done = [0]
+    total = sum(len(lane) for lane in lanes)
+    lock = threading.Lock()
+
+    def run_lane(lane):
+        for cell in lane:
+            run_cell(cell, reference_materials, settings)
+            with lock:
+                done[0] += 1
+                status = f"❌ {cell['error'][:60]}" if cell["error"] else f"{cell['latency_ms']:.0f} ms, ~{cell['est_tokens']} tokens"
+                print(f"[{done[0]:>4}/{total}] {cell['model']} / {cell['style']} / {cell['character']} "
+                      f"(prompt {cell['prompt_index'] + 1}): {status}")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(run_lane, lane) for lane in lanes]:
+            future.result()
+
+def print_summary(cells):
+    """Mean latency and estimated tokens per model and style"""
+    groups = {}
+    for cell in cells:
+        groups.setdefault((cell["model"], cell["style"]), []).append(cell)
+    print(f"\n{'model':<28} {'style':<14} {'cells':>5} {'mean ms':>9} {'mean ~tok':>10} {'errors':>6}")
+    for (model_name, style), group in sorted(groups.items()):
+        completed = [cell for cell in group if not cell["error"]]
+        mean_latency = sum(cell["latency_ms"] for cell in completed) / len(completed) if completed else 0
+        mean_tokens = sum(cell["est_tokens"] for cell in completed) / len(completed) if completed else 0
+        print(f"{model_name:<28} {style:<14} {len(group):>5} {mean_latency:>9.0f} {mean_tokens:>10.0f} "
+              f"{len(group) - len(completed):>6}")
+
+def split_list(value, available):
+    """Comma-separated names, or every available one for 'all'"""
+    if value == "all":
+        return list(available)
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise SystemExit(f"Unknown: {', '.join(unknown)} (choose from {', '.join(available)})")
+    return names
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the same prompts across styles, writer characters and models")
+    parser.add_argument("--prompt", action="append", default=[], help="A prompt to sweep (repeatable)")
+    parser.add_argument("--prompts-file", help="File with one prompt per line")
+    parser.add_argument("--styles", default="all", help="Comma-separated styles, or 'all'")
+    parser.add_argument("--characters", default="all", help="Comma-separated writer characters, or 'all'")
+    parser.add_argument("--models", default=writer.DEFAULT_MODEL, help="Comma-separated models")
+    parser.add_argument("--concurrency", type=int, default=2, help="Lanes running at the same time")
+    parser.add_argument("--max-tokens", type=int, default=300)
+    parser.add_argument("--seed", type=int, help="Fixed seed so runs can be compared")
+    parser.add_argument("--deadline", type=float, default=writer.REQUEST_DEADLINE, help="Per-cell deadline in seconds")
+    parser.add_argument("--no-references", action="store_true", help="Leave reference materials out of the prompts")
+    parser.add_argument("--mock-hosts", type=int, default=0, help="Run against this many local mock servers instead")
+    parser.add_argument("--output", help="CSV results file (default: sweep_results/sweep-<timestamp>.csv)")
+    args = parser.parse_args()
+
+    prompts = list(args.prompt)
+    if args.prompts_file:
+        with open(args.prompts_file, "r", encoding="utf-8") as file:
+            prompts += [line.strip() for line in file if line.strip()]
+    if not prompts:
+        parser.error("give at least one --prompt or a --prompts-file")
+
+    if args.mock_hosts:
+        from benchmark import configure_for_mock
+        from mock_model_server import start_mock_server
+        servers = [start_mock_server(parallel=4) for _ in range(args.mock_hosts)]
+        configure_for_mock(servers[0])
+        writer.OLLAMA_ROUTER = writer.OllamaRouter([server.base_url for server in servers])
+
+    styles = split_list(args.styles, writer.STYLES)
+    characters = split_list(args.characters, writer.WRITER_CHARACTERS)
+    models = [name.strip() for name in args.models.split(",") if name.strip()]
+    reference_materials = [] if args.no_references else writer.load_reference_materials()
+
+    cells = expand_grid(prompts, styles, characters, models)
+    lanes = plan_lanes(cells, reference_materials)
+    print(f"\n🧮 Sweep: {len(prompts)} prompt(s) x {len(styles)} style(s) x {len(characters)} character(s) x "
+          f"{len(models)} model(s) = {len(cells)} cells in {len(lanes)} lanes, {args.concurrency} at a time")
+    settings = {"max_tokens": args.max_tokens, "seed": args.seed, "deadline": args.deadline}
+    start = time.perf_counter()
+    run_sweep(lanes, reference_materials, settings, max(1, args.concurrency))
+    print_summary(cells)
+
+    output_path = args.output or os.path.join("sweep_results", f"sweep-{time.strftime('%Y%m%d-%H%M%S')}.csv")
+    if os.path.dirname(output_path):
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w", encoding="utf-8", newline="") as file:
+        table = csv.DictWriter(file, fieldnames=RESULT_FIELDS, extrasaction="ignore")
+        table.writeheader()
+        for cell in sorted(cells, key=lambda cell: (cell["model"], cell["prompt_index"], cell["style"], cell["character"])):
+            table.writerow({**cell, "host": cell["host"] or ""})
+    print(f"\n✅ {len(cells)} cells in {time.perf_counter() - start:.1f}s; results written to {output_path}")
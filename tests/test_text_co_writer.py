@@ -0,0 +1,233 @@
+import threading
+import time
+
+import pytest
+
+import text_co_writer as writer
+from benchmark import configure_for_mock
+from mock_model_server import start_mock_server
+
+@pytest.fixture
+def mock_server():
+    server = start_mock_server(tokens_per_second=500, first_token_latency=0.3, parallel=4)
+    configure_for_mock(server)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def run_concurrently(count, **settings):
+    results = [None] * count
+    
+    def run(index):
+        results[index] = writer.co_write("The river remembered every stone", "sci-fi", model_name="neural-chat",
+                                         max_tokens=20, **settings)
+    
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    return results
+
+def test_unseeded_sampling_calls_are_not_coalesced(mock_server):
+    coalesced = writer.SINGLE_FLIGHT_GROUP.coalesced
+    results = run_concurrently(2, temperature=0.8, seed=None)
+    assert all(results)
+    assert mock_server.requests_served == 2
+    assert writer.SINGLE_FLIGHT_GROUP.coalesced == coalesced
+
+def test_seeded_calls_share_one_model_call(mock_server):
+    results = run_concurrently(2, temperature=0.8, seed=7)
+    assert results[0] == results[1]
+    assert mock_server.requests_served == 1
+
+def feed_words(monitor, words, separator):
+    for word in words:
+        monitor.feed(word + separator)
+    return monitor.stop_reason
+
+def test_tab_separated_words_are_counted_once():
+    words = [f"word{index}" for index in range(40)]
+    assert feed_words(writer.OutputMonitor(ngram_size=3, max_repeats=2), words, "\t") is None
+
+def test_tab_separated_repetition_is_still_caught():
+    words = ["the", "river", "remembered"] * 3
+    assert "repetition" in feed_words(writer.OutputMonitor(ngram_size=3, max_repeats=2), words, "\t")
+
+def feed_until_stop(monitor, deltas):
+    shown = ""
+    for delta in deltas:
+        shown += monitor.feed(delta)
+        if monitor.stop_reason:
+            return shown
+    return shown + monitor.flush()
+
+def test_text_shown_before_a_banned_pattern_is_kept():
+    monitor = writer.OutputMonitor(banned_patterns=writer.BANNED_OUTPUT_PATTERNS)
+    shown = feed_until_stop(monitor, ["The river ran. ", "And then, as ", "an AI, I cannot"])
+    assert monitor.stop_reason
+    assert shown == monitor.text == "The river ran. And then, "
+
+def test_text_shown_before_a_repetition_loop_is_kept():
+    monitor = writer.OutputMonitor(ngram_size=3, max_repeats=2)
+    shown = feed_until_stop(monitor, [word + " " for word in ["the", "river", "remembered"] * 3])
+    assert "repetition" in monitor.stop_reason
+    assert shown == monitor.text == "the river remembered "
+
+@pytest.fixture
+def two_hosts(monkeypatch):
+    monkeypatch.setattr(writer, "HTTP_TRANSPORT_MODE", "passthrough")
+    servers = [start_mock_server(first_token_latency=0) for _ in range(2)]
+    yield servers
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def make_router(servers):
+    router = writer.OllamaRouter([server.base_url for server in servers], probe_interval=3600,
+                                 failure_threshold=2, ejection_seconds=60)
+    router.probe_all()
+    return router
+
+def test_router_picks_the_host_with_fewest_requests_in_flight(two_hosts):
+    router = make_router(two_hosts)
+    first = router.acquire("mistral")
+    second = router.acquire("mistral")
+    assert first != second
+    router.release(first)
+    assert router.acquire("mistral") == first
+
+def test_router_prefers_hosts_with_the_model_loaded(two_hosts):
+    two_hosts[1].loaded_models.add("mistral")
+    router = make_router(two_hosts)
+    warm = two_hosts[1].base_url
+    assert router.acquire("mistral") == warm
+    # One request in flight still beats loading the model elsewhere
+    assert router.acquire("mistral") == warm
+    assert router.acquire("mistral", preferred_host=two_hosts[0].base_url) == two_hosts[0].base_url
+
+def test_router_ejects_a_failing_host_until_a_probe_succeeds(two_hosts):
+    router = make_router(two_hosts)
+    down, up = two_hosts
+    port = down.server_address[1]
+    down.shutdown()
+    down.server_close()
+    for _ in range(router.failure_threshold):
+        assert not router.probe(down.base_url)
+    assert {router.acquire("mistral") for _ in range(3)} == {up.base_url}
+    
+    two_hosts[0] = start_mock_server(port=port, first_token_latency=0)
+    assert router.probe(down.base_url)
+    assert router.acquire("mistral") == down.base_url
+
+def test_cassette_replays_what_it_recorded(mock_server, monkeypatch, tmp_path):
+    monkeypatch.setattr(writer, "_cassette", writer.Cassette(str(tmp_path / "cassette.jsonl")))
+    monkeypatch.setattr(writer, "HTTP_TRANSPORT_MODE", "record")
+    streamed = writer.co_write("The river remembered", "sci-fi", model_name="neural-chat", max_tokens=20,
+                               on_token=lambda delta: None, seed=3)
+    complete = writer.co_write("The river forgot", "sci-fi", model_name="neural-chat", max_tokens=20, seed=3)
+    # A streamed response closed before anyone read it is still recorded
+    with writer.http_request("POST", f"{mock_server.base_url}/api/generate", stream=True,
+                             json_body={"model": "neural-chat", "prompt": "unread", "stream": True}):
+        pass
+    
+    # Replays are matched without the host, so nothing reaches a server
+    monkeypatch.setattr(writer, "OLLAMA_ROUTER", writer.OllamaRouter(["http://replay.invalid"]))
+    monkeypatch.setattr(writer, "_cassette", writer.Cassette(str(tmp_path / "cassette.jsonl")))
+    monkeypatch.setattr(writer, "HTTP_TRANSPORT_MODE", "replay")
+    assert writer.co_write("The river remembered", "sci-fi", model_name="neural-chat", max_tokens=20,
+                           on_token=lambda delta: None, seed=3) == streamed
+    assert writer.co_write("The river forgot", "sci-fi", model_name="neural-chat", max_tokens=20, seed=3) == complete
+    with writer.http_request("POST", "http://replay.invalid/api/generate", stream=True,
+                             json_body={"model": "neural-chat", "prompt": "unread", "stream": True}) as response:
+        assert response.status_code == 200
+
+REFERENCES = [
+    {"filename": "river.txt", "content": "The river carried stones and water past the mill every spring."},
+    {"filename": "stars.txt", "content": "Telescopes follow distant stars and comets across the night sky."},
+    {"filename": "bread.txt", "content": "The baker kneads dough and bakes bread before the town wakes."}
+]
+
+def test_retriever_ranks_the_closest_passage_first(mock_server, tmp_path):
+    retriever = writer.ReferenceRetriever("ollama", str(tmp_path))
+    selected = retriever.select("stones in the river water", REFERENCES, k=2)
+    assert [filename for filename, _ in selected][0] == "river.txt"
+    assert len(selected) == 2
+    # Passage vectors are cached on disk and reused by the next retriever
+    reloaded = writer.ReferenceRetriever("ollama", str(tmp_path))
+    assert len(reloaded.cache.rows) == len(REFERENCES)
+    assert reloaded.select("comets and stars", REFERENCES, k=1)[0][0] == "stars.txt"
+
+def test_failed_retrieval_is_disabled_until_references_reload(mock_server, monkeypatch, tmp_path):
+    retriever = writer.ReferenceRetriever("ollama", str(tmp_path))
+    monkeypatch.setattr(writer, "_reference_retriever", retriever)
+    monkeypatch.setattr(writer, "_semantic_retrieval_failed", False)
+    monkeypatch.setattr(writer, "SEMANTIC_RETRIEVAL", True)
+    calls = []
+    
+    def failing_embed(texts):
+        calls.append(texts)
+        raise writer.ProviderError("embedding model not installed")
+    
+    working_embed = retriever.embed
+    retriever.embed = failing_embed
+    assert writer.select_reference_passages("river", REFERENCES) is None
+    assert writer.select_reference_passages("river", REFERENCES) is None
+    assert len(calls) == 1
+    
+    retriever.embed = working_embed
+    writer.index_reference_materials(REFERENCES)
+    assert writer.select_reference_passages("river water", REFERENCES)[0][0] == "river.txt"
+
+def test_references_issued_before_compaction_still_read_their_text(monkeypatch, tmp_path):
+    store = writer.CorpusStore(str(tmp_path / "store"), chunk_chars=40)
+    monkeypatch.setattr(writer, "_reference_store", store)
+    sources = {}
+    for name, text in [("old.txt", "Drafts nobody needs any more. " * 20),
+                       ("kept.txt", "The river remembered every stone it had carried. " * 10)]:
+        sources[name] = tmp_path / name
+        sources[name].write_text(text, encoding="utf-8")
+    store.add(str(sources["old.txt"]), sources["old.txt"].read_text(encoding="utf-8"))
+    kept = store.add(str(sources["kept.txt"]), sources["kept.txt"].read_text(encoding="utf-8"))
+    passages = [store.read_reference(kept, offset, length) for offset, length, _ in store.passage_records(kept)]
+    signatures = store.passage_signatures(kept)
+    
+    store.prune({"kept.txt"}, min_waste=0)
+    assert store.generation == 1
+    assert writer.reference_text(kept) == sources["kept.txt"].read_text(encoding="utf-8").strip()
+    assert [store.read_reference(kept, offset, length) for offset, length, _ in store.passage_records(kept)] == passages
+    assert store.passage_signatures(kept) == signatures
+    
+    fresh = store.lookup(str(sources["kept.txt"]))
+    assert [store.read_reference(fresh, offset, length) for offset, length, _ in store.passage_records(fresh)] == passages
+
+def test_shared_failure_gives_each_caller_its_own_exception():
+    group = writer.SingleFlight()
+    started = threading.Event()
+    errors = [None] * 2
+    
+    def generate(emit):
+        started.wait(5)
+        raise writer.ProviderError("model unavailable", writer.ERROR_TRANSIENT, retry_after=2.0)
+    
+    def run(index):
+        try:
+            group.run("key", generate)
+        except writer.ProviderError as e:
+            errors[index] = e
+    
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(2)]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + 5
+    while group.coalesced < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    started.set()
+    for thread in threads:
+        thread.join(5)
+    assert errors[0] is not errors[1]
+    assert [(str(e), e.kind, e.retry_after) for e in errors] == [("model unavailable", writer.ERROR_TRANSIENT, 2.0)] * 2
+
+def test_every_engine_state_snapshot_has_a_new_version():
+    state = writer.ENGINE_STATE
+    assert state.replace().version != state.version
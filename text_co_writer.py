@@ -1,10 +1,162 @@
-import openai
 import requests
+import argparse
+import codecs
+import ctypes
+import ctypes.util
+import cProfile
+import copy
+import io
+import itertools
 import json
+import mmap
 import os
+import random
+import re
+import select
+import struct
+import threading
+import zlib
+import time
+import tracemalloc
+import pstats
+from bisect import bisect_left
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 from typing import Optional
 import glob
+import hashlib
 from pathlib import Path
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+# Default configuration (config.py may override any of these)
+OPENAI_API_KEY = ""
+HUGGINGFACE_API_KEY = ""  # Add your Hugging Face API key here
+OLLAMA_BASE_URL = "http://localhost:11434"  # Default Ollama URL
+OLLAMA_HOSTS = []  # Several Ollama servers to spread requests over; defaults to [OLLAMA_BASE_URL]
+OLLAMA_PROBE_INTERVAL = 15  # Seconds between health and loaded-model checks of each host
+OLLAMA_FAILURE_THRESHOLD = 3  # Consecutive failures before a host is taken out of rotation
+OLLAMA_EJECTION_SECONDS = 30  # How long an ejected host stays out of rotation
+OLLAMA_DEFAULT_OPTIONS = {"top_p": 0.9, "repeat_penalty": 1.1}  # Runtime options sent with every Ollama request
+OLLAMA_MODEL_PROFILES = {}  # Per-model option overrides, e.g. {"mistral": {"num_batch": 256, "repeat_penalty": 1.15}}
+OLLAMA_AUTO_CONTEXT = True  # Size num_ctx to the prompt plus num_predict unless a profile fixes it
+OLLAMA_CONTEXT_BUCKETS = [2048, 4096, 8192, 16384, 32768]  # num_ctx sizes; few sizes mean few model reloads
+OLLAMA_HOST_THREADS = {}  # CPU threads per host, e.g. {"http://cpu-node-2:11434": 16}; others use the server default
+DEFAULT_MODEL = "neural-chat"
+DEFAULT_STYLE = "sci-fi"
+DEFAULT_CHARACTER = "cyra"
+
+# Retry settings for model API calls
+REQUEST_TIMEOUT = 60  # Seconds allowed for a single HTTP attempt
+REQUEST_DEADLINE = 180  # Total seconds per generation, retries included
+RETRY_MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY = 1.0  # Seconds, doubled after every failed attempt
+RETRY_MAX_DELAY = 30.0
+HUGGINGFACE_WAIT_FOR_MODEL = True  # After a 503 for a cold model, let Hugging Face hold the retry while it loads
+
+# Timeouts derived from the measured speed of each model on each host
+ADAPTIVE_TIMEOUTS = True  # REQUEST_TIMEOUT is only used until a model has been measured
+ADAPTIVE_TIMEOUT_FACTOR = 3.0  # Give up after this many times the expected wait
+ADAPTIVE_MIN_TIMEOUT = 10  # Seconds; never wait less than this for data
+LATENCY_TARGET = None  # Seconds an answer should take; shrinks max_tokens on slow models ('latency' command)
+LATENCY_TARGET_MIN_TOKENS = 40  # Never shrink max_tokens below this
+
+# Print continuations as they are generated (Ctrl-C stops the current generation)
+STREAM_RESPONSES = True
+
+# Speculative prefetch: after each continuation, generate the next one in the
+# background so the 'continue' command answers instantly ('speculate on/off')
+SPECULATIVE_PREFETCH = False
+SPECULATIVE_MAX_WASTED_TOKENS = 3000  # Stop speculating after this many discarded tokens per session
+CONTINUE_TAIL_CHARS = 1500  # How much of the previous output 'continue' sends as the prompt
+
+# Identical deterministic requests (fixed seed or temperature 0) in flight at the same time share one model call
+SINGLE_FLIGHT = True
+
+# Long-form mode ('long form' command): tokens requested per chunk and default output file
+LONG_FORM_CHUNK_TOKENS = 600
+LONG_FORM_OUTPUT_FILE = "long_form.txt"
+
+# Number of samples generated in parallel per prompt; the best one is shown ('best of N' command)
+BEST_OF_N = 1
+
+# Session journal: settings and outputs are logged so '--resume' restores the last session
+SESSION_JOURNAL_FILE = "session_journal.jsonl"  # The previous session's journal is kept as <file>.1
+JOURNAL_FSYNC_INTERVAL = 1.0  # Seconds between disk syncs; records in between share one fsync
+
+# Early stopping: end a generation as soon as it goes off the rails
+EARLY_STOP = True
+STOP_SEQUENCES = ["USER'S NARRATIVE TO CONTINUE:", "FINAL INSTRUCTION:"]  # Sent to the provider too
+REPETITION_NGRAM_SIZE = 6  # Words per phrase checked for loops
+REPETITION_MAX_REPEATS = 3  # Stop once the same phrase appears this many times
+BANNED_OUTPUT_PATTERNS = [  # Regular expressions for meta text the prompt forbids
+    r"^\W*As (?:an? |the )?(?:[\w-]+ )?(?:philosopher|scientist|writer|thinker|posthumanist|nomad|guardian|visionary|observer|dreamer|character|AI|language model)\b",
+    r"^\W*The philosopher-scientist\b",
+    r"(?im)^\W*(?:title|chapter \d+|continuation|note)\s*:",
+    r"(?i)\bas an AI\b",
+    r"(?i)\bhere(?: is|'s) (?:a|the|my) continuation\b"
+]
+
+# OpenAI API endpoint
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+
+# Local OpenAI-compatible server (llama.cpp server, vLLM, LocalAI), e.g. "http://localhost:8080/v1".
+# Its models are discovered through /v1/models and listed under LOCAL MODELS.
+LOCAL_OPENAI_BASE_URL = ""
+LOCAL_OPENAI_API_KEY = ""  # Only if the server was started with an API key
+LOCAL_OPENAI_CHAT = True  # Use /chat/completions; False sends raw prompts to /completions
+LOCAL_OPENAI_MAX_CONCURRENCY = 0  # Requests sent at once; 0 asks the server (llama.cpp /props) or uses 4
+
+# HTTP transport for model APIs: "passthrough" (live), "record" (live, saved to the
+# cassette) or "replay" (served from the cassette, no network needed)
+HTTP_TRANSPORT_MODE = "passthrough"
+CASSETTE_FILE = "cassette.jsonl"
+REPLAY_TIME_SCALE = 0.0  # 1.0 replays streamed chunks with their recorded timing, 0 as fast as possible
+
+# Hugging Face endpoint; {model} is replaced by the model name.
+# Point this at a text-generation-inference server (e.g. "http://localhost:8080") to self-host.
+HUGGINGFACE_BASE_URL = "https://api-inference.huggingface.co/models/{model}"
+
+# Profiling ('--profile' or the 'profile on/off' command): reports are written to this folder
+PROFILE_REPORT_DIR = "profiles"
+PROFILE_TOP_FUNCTIONS = 25  # Functions listed by cumulative time
+PROFILE_TOP_ALLOCATIONS = 15  # Allocation sites listed by size
+PROFILE_TRACEMALLOC_FRAMES = 5  # Stack depth recorded per allocation
+
+# Watch characters.txt, custom_elements.txt and reference_materials/ and reload them on change.
+# Backend "auto" uses inotify on Linux and falls back to polling file modification times.
+FILE_WATCH = True
+FILE_WATCH_BACKEND = "auto"  # "auto", "inotify" or "poll"
+FILE_WATCH_DEBOUNCE = 0.5  # Seconds of quiet before a burst of changes is reloaded once
+FILE_WATCH_POLL_INTERVAL = 1.0  # Seconds between scans when polling
+
+# Semantic retrieval: send the reference passages closest in meaning to the prompt instead of
+# the start of every file. Needs numpy. Backend "ollama" embeds with EMBEDDING_MODEL on the
+# Ollama hosts; "hash" is a deterministic, model-free stand-in for tests and offline runs.
+SEMANTIC_RETRIEVAL = False
+EMBEDDING_BACKEND = "ollama"
+EMBEDDING_MODEL = "nomic-embed-text"
+HASH_EMBEDDING_DIMENSIONS = 256
+RETRIEVAL_TOP_K = 4  # Passages added to each prompt
+REFERENCE_CHUNK_CHARS = 500  # Approximate passage length
+VECTOR_CACHE_DIR = ".reference_cache"  # Embeddings are stored here, keyed by passage hash
+
+# Extracted reference text is kept on disk (append-only blob + index, read through mmap)
+# so large libraries neither sit in memory nor get extracted again at every start
+REFERENCE_STORE_DIR = ".reference_cache"
+
+# Near-duplicate passages (drafts and versions of the same text) are sent only once.
+# Passages whose estimated word-shingle similarity reaches DEDUP_SIMILARITY are collapsed.
+DEDUP_REFERENCES = True
+DEDUP_SIMILARITY = 0.75
+
+# Parsed characters and elements files are compiled to a binary cache, so large
+# libraries are only parsed again when their content changes. Entries are decoded
+# when they are used, and the selection menus show MENU_PAGE_SIZE entries at a time.
+LIBRARY_CACHE = True
+LIBRARY_CACHE_DIR = ".reference_cache"
+MENU_PAGE_SIZE = 20
 
 # Try to load configuration from config.py
 try:
@@ -12,13 +164,9 @@ try:
     print("📁 Configuration loaded from config.py")
 except ImportError:
     print("📁 No config.py found, using default settings")
-    # Default configuration
-    OPENAI_API_KEY = ""
-    HUGGINGFACE_API_KEY = ""  # Add your Hugging Face API key here
-    OLLAMA_BASE_URL = "http://localhost:11434"  # Default Ollama URL
-    DEFAULT_MODEL = "neural-chat"
-    DEFAULT_STYLE = "sci-fi"
-    DEFAULT_CHARACTER = "cyra"
+
+if not OLLAMA_HOSTS:
+    OLLAMA_HOSTS = [OLLAMA_BASE_URL]
 
 # Reference materials configuration
 REFERENCE_FOLDER = "reference_materials"
@@ -28,6 +176,146 @@ SUPPORTED_FORMATS = ['.pdf', '.docx', '.doc', '.txt']
 CHARACTERS_FILE = "characters.txt"
 CUSTOM_ELEMENTS_FILE = "custom_elements.txt"
 
+class CompiledLibrary(Mapping):
+    """A parsed characters or elements file, read from its compiled cache.
+
+    <kind>-<version>.lib holds every entry's JSON-encoded value back to back
+    and <kind>-<version>.idx one (offset, length) record per entry, in file
+    order. <kind>.json names the current version and lists the entry keys and
+    display labels, with the modification time, size and hash of the source
+    file it was compiled from. Only the keys are loaded up front; an entry is
+    decoded from the mmap the first time it is looked up.
+    """
+
+    RECORD = struct.Struct("<QQ")
+
+    def __init__(self, names, labels, blob, records):
+        self.names = names
+        self.labels = labels
+        self.positions = {name: position for position, name in enumerate(names)}
+        self.blob = blob
+        self.records = records
+        self.decoded = {}
+
+    def __getitem__(self, name):
+        value = self.decoded.get(name)
+        if value is None:
+            offset, length = self.RECORD.unpack_from(self.records, self.positions[name] * self.RECORD.size)
+            value = freeze(json.loads(self.blob[offset:offset + length]))
+            self.decoded[name] = value
+        return value
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def read_meta(base):
+        try:
+            with open(base + ".json", "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def write_meta(base, meta):
+        temporary_path = base + ".json.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(temporary_path, base + ".json")
+
+    @classmethod
+    def open(cls, base, meta):
+        """The compiled library `meta` describes, or None if its files are missing or damaged"""
+        try:
+            with open(f"{base}-{meta['version']}.idx", "rb") as f:
+                records = f.read()
+            with open(f"{base}-{meta['version']}.lib", "rb") as f:
+                blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            names, labels = meta["names"], meta["labels"]
+        except (OSError, ValueError, KeyError):
+            return None
+        if len(records) != len(names) * cls.RECORD.size or len(labels) != len(names):
+            return None
+        return cls(names, labels, blob, records)
+
+    @classmethod
+    def compile(cls, base, entries, source):
+        """Write `entries` as a new version next to base and return its meta"""
+        version = source["hash"][:16]
+        data = bytearray()
+        records = bytearray()
+        for value in entries.values():
+            encoded = json.dumps(value, ensure_ascii=False).encode("utf-8")
+            records += cls.RECORD.pack(len(data), len(encoded))
+            data += encoded
+        # Versions are never rewritten in place: another process may still have the old one mapped
+        for suffix, content in ((".lib", data), (".idx", records)):
+            temporary_path = f"{base}-{version}{suffix}.tmp"
+            with open(temporary_path, "wb") as f:
+                f.write(content)
+            os.replace(temporary_path, f"{base}-{version}{suffix}")
+        meta = dict(source, version=version, names=list(entries),
+                    labels=[value.get("name", key) if isinstance(value, dict) else key for key, value in entries.items()])
+        cls.write_meta(base, meta)
+        for path in glob.glob(glob.escape(base) + "-*.*"):
+            if not os.path.basename(path).startswith(f"{os.path.basename(base)}-{version}."):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass  # Still mapped elsewhere (Windows); removed on a later compile
+        return meta
+
+def load_library(source_path, kind, parse):
+    """Parsed entries of a characters or elements file, through the compiled cache.
+
+    The cache is trusted while the file's modification time and size are
+    unchanged. Otherwise the file is hashed and only parsed and compiled again
+    if its content differs. Returns None for an empty file and an empty dict
+    if nothing could be parsed.
+    """
+    if not LIBRARY_CACHE:
+        with open(source_path, 'r', encoding='utf-8') as file:
+            content = file.read().strip()
+        return parse(content) if content else None
+
+    os.makedirs(LIBRARY_CACHE_DIR, exist_ok=True)
+    base = os.path.join(LIBRARY_CACHE_DIR, kind)
+    info = os.stat(source_path)
+    meta = CompiledLibrary.read_meta(base)
+    if meta and (meta.get("mtime_ns"), meta.get("size")) == (info.st_mtime_ns, info.st_size):
+        library = CompiledLibrary.open(base, meta)
+        if library is not None:
+            return library
+
+    with open(source_path, "rb") as file:
+        data = file.read()
+    source = {"mtime_ns": info.st_mtime_ns, "size": info.st_size, "hash": hashlib.sha256(data).hexdigest()}
+    if meta and meta.get("hash") == source["hash"]:
+        # Touched or copied but not edited
+        library = CompiledLibrary.open(base, meta)
+        if library is not None:
+            CompiledLibrary.write_meta(base, dict(meta, **source))
+            return library
+
+    content = data.decode("utf-8").strip()
+    if not content:
+        return None
+    entries = parse(content)
+    if not entries:
+        return entries
+    try:
+        library = CompiledLibrary.open(base, CompiledLibrary.compile(base, entries, source))
+    except OSError as e:
+        print(f"⚠️  Could not cache {source_path}: {e}")
+        library = None
+    return library if library is not None else entries
+
 def load_characters_from_file():
     """Load writer characters from external text file"""
     characters = {}
@@ -85,15 +373,12 @@ def load_characters_from_file():
             print(f"Created default characters file: {CHARACTERS_FILE}")
             return default_characters
         
-        with open(CHARACTERS_FILE, 'r', encoding='utf-8') as file:
-            content = file.read().strip()
-            
-        if not content:
+        # Parse the file content (or read it from the compiled cache)
+        characters = load_library(CHARACTERS_FILE, "characters", parse_characters_file)
+        
+        if characters is None:
             print(f"Characters file {CHARACTERS_FILE} is empty, using defaults")
             return default_characters
-            
-        # Parse the file content
-        characters = parse_characters_file(content)
         
         if not characters:
             print(f"Could not parse characters from {CHARACTERS_FILE}, using defaults")
@@ -185,9 +470,9 @@ def parse_characters_file(content):
         if line.startswith('[') and line.endswith(']'):
             # Save previous character if exists
             if current_character and current_data:
-                characters[current_character] = current_data.copy()
+                characters[current_character] = current_data
             
-            # Start new character
+            # Start new character (a fresh dict, so the saved one needs no copy)
             current_character = line[1:-1]  # Remove brackets
             current_data = {}
             
@@ -202,7 +487,7 @@ def parse_characters_file(content):
     
     # Don't forget the last character
     if current_character and current_data:
-        characters[current_character] = current_data.copy()
+        characters[current_character] = current_data
     
     return characters
 
@@ -231,15 +516,12 @@ def load_custom_elements_from_file():
             print(f"Created default custom elements file: {CUSTOM_ELEMENTS_FILE}")
             return default_elements
         
-        with open(CUSTOM_ELEMENTS_FILE, 'r', encoding='utf-8') as file:
-            content = file.read().strip()
-            
-        if not content:
+        # Parse the file content (or read it from the compiled cache)
+        elements = load_library(CUSTOM_ELEMENTS_FILE, "elements", parse_elements_file)
+        
+        if elements is None:
             print(f"Custom elements file {CUSTOM_ELEMENTS_FILE} is empty, using defaults")
             return default_elements
-            
-        # Parse the file content
-        elements = parse_elements_file(content)
         
         if not elements:
             print(f"Could not parse elements from {CUSTOM_ELEMENTS_FILE}, using defaults")
@@ -363,6 +645,61 @@ STYLES = {
     "journalistic": "Continue in a New York Times feature article style, maintaining the narrative direction.",
 }
 
+def freeze(value):
+    """Read-only copy of nested dicts and lists"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+class EngineState:
+    """One consistent, read-only view of the settings a request runs with.
+    
+    co_write captures ENGINE_STATE once and hands it down, so a reload or a
+    new API key arriving from another thread never mixes old and new settings
+    within one request. Changes build a new EngineState and rebind
+    ENGINE_STATE in a single assignment; readers never take a lock. Every
+    snapshot gets a new version number, which (unlike its id) is never reused.
+    """
+    
+    FIELDS = ("characters", "elements", "styles", "models", "openai_api_key")
+    __slots__ = FIELDS + ("version",)
+    _versions = itertools.count(1)
+    
+    def __init__(self, characters, elements, styles, models, openai_api_key):
+        for name, value in zip(self.FIELDS, (characters, elements, styles, models, openai_api_key)):
+            object.__setattr__(self, name, freeze(value))
+        object.__setattr__(self, "version", next(self._versions))
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("EngineState is immutable; use update_engine_state()")
+    
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self.FIELDS}
+        values.update(changes)
+        return EngineState(**values)
+    
+    def model_provider(self, model_name):
+        for models in self.models.values():
+            if model_name in models:
+                return models[model_name]["provider"]
+        return None
+
+ENGINE_STATE = EngineState(WRITER_CHARACTERS, CUSTOM_ELEMENTS, STYLES, MODELS, OPENAI_API_KEY)
+_engine_state_lock = threading.Lock()
+
+def update_engine_state(**changes):
+    """Make a new snapshot with `changes` current and return it"""
+    global ENGINE_STATE, WRITER_CHARACTERS, CUSTOM_ELEMENTS, OPENAI_API_KEY
+    # Only writers lock, so two reloads cannot lose each other's changes
+    with _engine_state_lock:
+        state = ENGINE_STATE.replace(**changes)
+        ENGINE_STATE = state
+        # The module-level names follow the snapshot for menus and scripts
+        WRITER_CHARACTERS, CUSTOM_ELEMENTS, OPENAI_API_KEY = state.characters, state.elements, state.openai_api_key
+    return state
+
 # Custom elements and world-building descriptions
 # CUSTOM_ELEMENTS = {
 #     "hybrid_plants": "Bio-mechanical plants that combine organic growth with technological components, capable of photosynthesis and data processing simultaneously.",
@@ -477,29 +814,468 @@ def load_reference_materials():
         return reference_texts
     
     # Get all supported files
-    for file_path in glob.glob(os.path.join(REFERENCE_FOLDER, "*.*")):
-        file_ext = os.path.splitext(file_path)[1].lower()
-        if file_ext in SUPPORTED_FORMATS:
-            print(f"Loading reference material: {os.path.basename(file_path)}")
+    file_paths = [file_path for file_path in sorted(glob.glob(os.path.join(REFERENCE_FOLDER, "*.*")))
+                  if os.path.splitext(file_path)[1].lower() in SUPPORTED_FORMATS]
+    
+    # Forget files that were deleted and reclaim space left by old versions
+    get_reference_store().prune({os.path.basename(file_path) for file_path in file_paths})
+    
+    for file_path in file_paths:
+        print(f"Loading reference material: {os.path.basename(file_path)}")
+        reference = load_reference_file(file_path)
+        if reference:
+            reference_texts.append(reference)
+    
+    if DEDUP_REFERENCES:
+        reference_texts = deduplicate_references(reference_texts)
+    return reference_texts
+
+def load_reference_file(file_path):
+    """Extract one reference file into the corpus store; returns None for unsupported or empty files.
+    
+    Files whose modification time and size match the store are not extracted again.
+    """
+    file_ext = os.path.splitext(file_path)[1].lower()
+    store = get_reference_store()
+    reference = store.lookup(file_path)
+    if reference:
+        return reference
+    
+    if file_ext == '.pdf':
+        text = extract_text_from_pdf(file_path)
+    elif file_ext in ['.docx', '.doc']:
+        text = extract_text_from_docx(file_path)
+    elif file_ext == '.txt':
+        text = extract_text_from_txt(file_path)
+    else:
+        return None
+    
+    if not text:
+        return None
+    return store.add(file_path, text)
+
+def chunk_spans(text, size=REFERENCE_CHUNK_CHARS):
+    """(start, end) positions of passages of about `size` characters, broken at paragraphs or spaces"""
+    spans = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + size)
+        if end < len(text):
+            cut = text.rfind("\n\n", start + size // 2, end)
+            if cut < 0:
+                cut = text.rfind(" ", start + size // 2, end)
+            if cut > 0:
+                end = cut
+        chunk_start, chunk_end = start, end
+        while chunk_start < chunk_end and text[chunk_start].isspace():
+            chunk_start += 1
+        while chunk_end > chunk_start and text[chunk_end - 1].isspace():
+            chunk_end -= 1
+        if chunk_start < chunk_end:
+            spans.append((chunk_start, chunk_end))
+        start = end
+    return spans
+
+def passage_hash(data):
+    """64-bit content hash of a passage's UTF-8 bytes"""
+    return int.from_bytes(hashlib.sha1(data).digest()[:8], "little")
+
+# MinHash: 64 hash permutations of 32-bit word-shingle hashes, split into 16 LSH bands of 4 rows,
+# so passages that are about 50% similar or more usually share at least one band
+MINHASH_PRIME = 4294967291
+# a and b come from one generator: Random(seed) and Random(-seed) give the same stream
+MINHASH_PARAMETERS = [(generator.randrange(1, MINHASH_PRIME), generator.randrange(MINHASH_PRIME))
+                      for generator in [random.Random(1)] for _ in range(64)]
+# Stored signatures made with other parameters are computed again
+MINHASH_FINGERPRINT = hashlib.sha1(repr(MINHASH_PARAMETERS).encode("utf-8")).hexdigest()[:16]
+MINHASH_BANDS = 16
+SIGNATURE_SIZE = 4 * len(MINHASH_PARAMETERS)
+
+def text_shingles(text, size=4):
+    """32-bit hashes of the overlapping `size`-word sequences of text"""
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        return {zlib.crc32(" ".join(words).encode("utf-8"))} if words else set()
+    return {zlib.crc32(" ".join(words[index:index + size]).encode("utf-8")) for index in range(len(words) - size + 1)}
+
+def minhash_signature(text):
+    """MinHash signature of a passage as SIGNATURE_SIZE bytes"""
+    shingles = text_shingles(text)
+    if not shingles:
+        return b"\xff" * SIGNATURE_SIZE
+    try:
+        import numpy as np
+    except ImportError:
+        return struct.pack(f"<{len(MINHASH_PARAMETERS)}I",
+                           *(min((a * shingle + b) % MINHASH_PRIME for shingle in shingles) for a, b in MINHASH_PARAMETERS))
+    values = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))
+    parameters = np.array(MINHASH_PARAMETERS, dtype=np.uint64)
+    hashed = (parameters[:, :1] * values + parameters[:, 1:]) % np.uint64(MINHASH_PRIME)
+    return hashed.min(axis=1).astype("<u4").tobytes()
+
+class CorpusStore:
+    """Extracted reference text on disk, read through mmap.
+    
+    corpus.txt is an append-only UTF-8 blob and corpus.idx holds one
+    (offset, length, hash) record per passage, with the passage's MinHash
+    signature at the same position in corpus.sig. corpus.json lists every source
+    file with the modification time and size it was extracted at, and the
+    byte range and passages it occupies. A reference is only a small dict of
+    offsets; its text is decoded when a passage is actually used, so memory
+    stays flat however large the library grows. compact() moves text, so each
+    reference records the compaction generation it was issued in and reads
+    through a reference follow its file to where the text is now.
+    """
+    
+    RECORD = struct.Struct("<QQQ")
+    
+    def __init__(self, directory=REFERENCE_STORE_DIR, chunk_chars=REFERENCE_CHUNK_CHARS):
+        os.makedirs(directory, exist_ok=True)
+        self.blob_path = os.path.join(directory, "corpus.txt")
+        self.index_path = os.path.join(directory, "corpus.idx")
+        self.meta_path = os.path.join(directory, "corpus.json")
+        self.signature_path = os.path.join(directory, "corpus.sig")
+        self.chunk_chars = chunk_chars
+        self.lock = threading.RLock()
+        self.files = {}
+        self.blob_size = 0
+        self.passage_count = 0
+        self.generation = 0  # Incremented by every compact()
+        self.maps = {}
+        signatures_current = False
+        
+        try:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("chunk_chars") == chunk_chars:
+                self.files = meta["files"]
+                self.blob_size = meta["blob_size"]
+                self.passage_count = meta["passage_count"]
+                signatures_current = meta.get("minhash") == MINHASH_FINGERPRINT
+        except (OSError, ValueError, KeyError):
+            pass
+        
+        # Data is appended before corpus.json is saved; cut off anything a crash left unindexed
+        for path, size in ((self.blob_path, self.blob_size), (self.index_path, self.passage_count * self.RECORD.size)):
+            actual_size = os.path.getsize(path) if os.path.exists(path) else 0
+            if actual_size < size:
+                self.files, self.blob_size, self.passage_count = {}, 0, 0
+                self.truncate_all()
+                break
+            if actual_size > size:
+                with open(path, "ab") as f:
+                    f.truncate(size)
+        
+        # Stores written before signatures existed (or with other MinHash parameters) get them computed on first use
+        signature_size = os.path.getsize(self.signature_path) if os.path.exists(self.signature_path) and signatures_current else 0
+        self.signed_passages = min(signature_size // SIGNATURE_SIZE, self.passage_count)
+        with open(self.signature_path, "ab") as f:
+            f.truncate(self.signed_passages * SIGNATURE_SIZE)
+    
+    def truncate_all(self):
+        self.close_maps()
+        for path in (self.blob_path, self.index_path, self.signature_path):
+            with open(path, "wb"):
+                pass
+    
+    def close_maps(self):
+        for mapped, file in self.maps.values():
+            mapped.close()
+            file.close()
+        self.maps = {}
+    
+    def mapped(self, path, size):
+        """Read-only mmap of path covering at least `size` bytes (remapped after appends)"""
+        current = self.maps.get(path)
+        if current and len(current[0]) >= size:
+            return current[0]
+        if current:
+            current[0].close()
+            current[1].close()
+        file = open(path, "rb")
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps[path] = (mapped, file)
+        return mapped
+    
+    def save(self):
+        temporary_path = self.meta_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump({"chunk_chars": self.chunk_chars, "minhash": MINHASH_FINGERPRINT, "blob_size": self.blob_size,
+                       "passage_count": self.passage_count, "files": self.files}, f)
+        os.replace(temporary_path, self.meta_path)
+    
+    @staticmethod
+    def source_signature(source_path):
+        info = os.stat(source_path)
+        return info.st_mtime_ns, info.st_size
+    
+    def lookup(self, source_path):
+        """The stored reference for source_path if the file is unchanged since extraction"""
+        filename = os.path.basename(source_path)
+        with self.lock:
+            entry = self.files.get(filename)
+            try:
+                if entry and (entry["mtime_ns"], entry["size"]) == self.source_signature(source_path):
+                    return dict(entry, filename=filename, generation=self.generation)
+            except OSError:
+                pass
+        return None
+    
+    def add(self, source_path, text):
+        """Append extracted text and its passages; returns the reference dict"""
+        filename = os.path.basename(source_path)
+        mtime_ns, size = self.source_signature(source_path)
+        with self.lock:
+            self.ensure_signatures()
+            data = bytearray()
+            records = bytearray()
+            signatures = bytearray()
+            position = 0
+            passages = 0
+            for start, end in chunk_spans(text, self.chunk_chars):
+                data += text[position:start].encode("utf-8")
+                chunk = text[start:end].encode("utf-8")
+                records += self.RECORD.pack(self.blob_size + len(data), len(chunk), passage_hash(chunk))
+                signatures += minhash_signature(text[start:end])
+                data += chunk
+                position = end
+                passages += 1
+            data += text[position:].encode("utf-8")
             
-            if file_ext == '.pdf':
-                text = extract_text_from_pdf(file_path)
-            elif file_ext in ['.docx', '.doc']:
-                text = extract_text_from_docx(file_path)
-            elif file_ext == '.txt':
-                text = extract_text_from_txt(file_path)
+            with open(self.blob_path, "ab") as f:
+                f.write(data)
+            with open(self.index_path, "ab") as f:
+                f.write(records)
+            with open(self.signature_path, "ab") as f:
+                f.write(signatures)
+            self.signed_passages += passages
+            entry = {"mtime_ns": mtime_ns, "size": size, "offset": self.blob_size, "length": len(data),
+                     "first_passage": self.passage_count, "passages": passages}
+            self.blob_size += len(data)
+            self.passage_count += passages
+            self.files[filename] = entry
+            self.save()
+            return dict(entry, filename=filename, generation=self.generation)
+    
+    def remove(self, filename):
+        with self.lock:
+            if self.files.pop(filename, None):
+                self.save()
+    
+    def read(self, offset, length):
+        """Decode length bytes of stored text starting at offset"""
+        if length <= 0:
+            return ""
+        with self.lock:
+            data = self.mapped(self.blob_path, offset + length)[offset:offset + length]
+        # A slice cut for a character limit may end inside a multi-byte character
+        return data.decode("utf-8", errors="ignore")
+    
+    def moved_by(self, reference):
+        """(byte shift, passage shift) from where reference says its text is to where it is now,
+        or None if compaction dropped it; call with the lock held"""
+        if reference.get("generation", self.generation) == self.generation:
+            return 0, 0
+        entry = self.files.get(reference["filename"])
+        if not entry or (entry["mtime_ns"], entry["size"]) != (reference["mtime_ns"], reference["size"]):
+            return None
+        return entry["offset"] - reference["offset"], entry["first_passage"] - reference["first_passage"]
+    
+    def read_reference(self, reference, offset, length):
+        """Decode length bytes of a reference's text at offset (as the reference gave it)"""
+        with self.lock:
+            moved = self.moved_by(reference)
+            return self.read(offset + moved[0], length) if moved else ""
+    
+    def passage_records(self, reference):
+        """(offset, length, hash) of each passage of a reference, with offsets as the reference gives them"""
+        if not reference["passages"]:
+            return []
+        with self.lock:
+            moved = self.moved_by(reference)
+            if not moved:
+                return []
+            start = (reference["first_passage"] + moved[1]) * self.RECORD.size
+            end = start + reference["passages"] * self.RECORD.size
+            data = self.mapped(self.index_path, end)[start:end]
+        return [(offset - moved[0], length, hash_value) for offset, length, hash_value in self.RECORD.iter_unpack(data)]
+    
+    def ensure_signatures(self):
+        """Compute signatures for passages stored without one"""
+        with self.lock:
+            if self.signed_passages >= self.passage_count:
+                return
+            print(f"Computing near-duplicate signatures for {self.passage_count - self.signed_passages} stored passage(s)...")
+            start = self.signed_passages * self.RECORD.size
+            end = self.passage_count * self.RECORD.size
+            records = self.mapped(self.index_path, end)[start:end]
+            with open(self.signature_path, "ab") as f:
+                for offset, length, _ in self.RECORD.iter_unpack(records):
+                    f.write(minhash_signature(self.read(offset, length)))
+            self.signed_passages = self.passage_count
+            self.save()  # Records the parameters the signatures were made with
+    
+    def passage_signatures(self, reference):
+        """MinHash signature of each passage of a reference"""
+        if not reference["passages"]:
+            return []
+        with self.lock:
+            self.ensure_signatures()
+            moved = self.moved_by(reference)
+            if not moved:
+                return []
+            start = (reference["first_passage"] + moved[1]) * SIGNATURE_SIZE
+            end = start + reference["passages"] * SIGNATURE_SIZE
+            data = self.mapped(self.signature_path, end)[start:end]
+        return [data[index:index + SIGNATURE_SIZE] for index in range(0, len(data), SIGNATURE_SIZE)]
+    
+    def prune(self, filenames, min_waste=1 << 20):
+        """Drop files not in filenames; rewrite the store once most of it is unused"""
+        with self.lock:
+            removed = [filename for filename in self.files if filename not in filenames]
+            for filename in removed:
+                del self.files[filename]
+            live_size = sum(entry["length"] for entry in self.files.values())
+            if self.blob_size - live_size >= max(min_waste, live_size):
+                self.compact()
+            elif removed:
+                self.save()
+    
+    def compact(self):
+        """Rewrite the blob and passage index with only the current version of each file"""
+        with self.lock:
+            self.ensure_signatures()
+            self.close_maps()
+            blob_size = passage_count = 0
+            with open(self.blob_path, "rb") as old_blob, open(self.index_path, "rb") as old_index, \
+                 open(self.signature_path, "rb") as old_signatures, open(self.blob_path + ".tmp", "wb") as new_blob, \
+                 open(self.index_path + ".tmp", "wb") as new_index, open(self.signature_path + ".tmp", "wb") as new_signatures:
+                for entry in sorted(self.files.values(), key=lambda entry: entry["offset"]):
+                    old_blob.seek(entry["offset"])
+                    new_blob.write(old_blob.read(entry["length"]))
+                    old_index.seek(entry["first_passage"] * self.RECORD.size)
+                    shift = blob_size - entry["offset"]
+                    for offset, length, hash_value in self.RECORD.iter_unpack(old_index.read(entry["passages"] * self.RECORD.size)):
+                        new_index.write(self.RECORD.pack(offset + shift, length, hash_value))
+                    old_signatures.seek(entry["first_passage"] * SIGNATURE_SIZE)
+                    new_signatures.write(old_signatures.read(entry["passages"] * SIGNATURE_SIZE))
+                    entry["offset"] = blob_size
+                    entry["first_passage"] = passage_count
+                    blob_size += entry["length"]
+                    passage_count += entry["passages"]
+            for path in (self.blob_path, self.index_path, self.signature_path):
+                os.replace(path + ".tmp", path)
+            self.blob_size = blob_size
+            self.passage_count = passage_count
+            self.signed_passages = passage_count
+            self.generation += 1
+            self.save()
+
+_reference_store = None
+
+def get_reference_store():
+    global _reference_store
+    if _reference_store is None:
+        _reference_store = CorpusStore(REFERENCE_STORE_DIR)
+    return _reference_store
+
+def reference_text(reference, limit=None):
+    """Text of a reference, or its first `limit` characters"""
+    if 'content' in reference:
+        return reference['content'][:limit] if limit else reference['content']
+    # At most 4 UTF-8 bytes per character, so this is enough for `limit` characters
+    length = reference['length'] if limit is None else min(reference['length'], limit * 4)
+    text = get_reference_store().read_reference(reference, reference['offset'], length).strip()
+    return text[:limit] if limit else text
+
+def iter_reference_passages(reference):
+    """(start, length, hash) of each passage that is not a near-duplicate; positions are
+    store offsets, or character positions for references that carry their own 'content'"""
+    if 'content' in reference:
+        content = reference['content']
+        passages = [(start, end - start, passage_hash(content[start:end].encode("utf-8"))) for start, end in chunk_spans(content)]
+    else:
+        passages = get_reference_store().passage_records(reference)
+    duplicates = reference.get('duplicates', ())
+    for position, passage in enumerate(passages):
+        if position not in duplicates:
+            yield passage
+
+def reference_signatures(reference):
+    if 'content' in reference:
+        content = reference['content']
+        return [minhash_signature(content[start:end]) for start, end in chunk_spans(content)]
+    return get_reference_store().passage_signatures(reference)
+
+def deduplicate_references(reference_materials, similarity=DEDUP_SIMILARITY):
+    """Mark passages that nearly duplicate a passage earlier in the list.
+    
+    Passages sharing an LSH band of their MinHash signatures are candidates;
+    each is compared with at most 8 earlier, mutually distinct passages of the
+    bucket (a passage that matches none of them joins the bucket while it has
+    room), so the work stays close to linear even when many drafts collide.
+    Returns new reference dicts with a 'duplicates' set of passage positions
+    to leave out.
+    """
+    passages = []  # (reference number, position, signature, signature values)
+    for number, reference in enumerate(reference_materials):
+        for position, signature in enumerate(reference_signatures(reference)):
+            passages.append((number, position, signature, struct.unpack(f"<{len(MINHASH_PARAMETERS)}I", signature)))
+    
+    parent = list(range(len(passages)))
+    
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+    
+    band_size = SIGNATURE_SIZE // MINHASH_BANDS
+    required_matches = similarity * len(MINHASH_PARAMETERS)
+    buckets = {}
+    for index, (_, _, signature, values) in enumerate(passages):
+        if signature == b"\xff" * SIGNATURE_SIZE:
+            continue  # No words to compare
+        for band in range(MINHASH_BANDS):
+            members = buckets.setdefault((band, signature[band * band_size:(band + 1) * band_size]), [])
+            # Compare with the bucket's earlier, mutually distinct passages (at most 8)
+            for member in members:
+                if find(member) == find(index):
+                    break
+                matches = sum(1 for value, other in zip(values, passages[member][3]) if value == other)
+                if matches >= required_matches:
+                    # The earlier passage stays the representative
+                    root, member_root = find(index), find(member)
+                    parent[max(root, member_root)] = min(root, member_root)
+                    break
             else:
-                continue
-            
-            if text:
-                reference_texts.append({
-                    'filename': os.path.basename(file_path),
-                    'content': text[:2000]  # Limit to first 2000 characters per file
-                })
+                if len(members) < 8:
+                    members.append(index)
     
-    return reference_texts
+    duplicates = [set() for _ in reference_materials]
+    collapsed = {}
+    for index, (number, position, _, _) in enumerate(passages):
+        root = find(index)
+        if root != index:
+            duplicates[number].add(position)
+            pair = (reference_materials[number]['filename'], reference_materials[passages[root][0]]['filename'])
+            collapsed[pair] = collapsed.get(pair, 0) + 1
+    
+    if collapsed:
+        print(f"🧹 Collapsed {sum(collapsed.values())} near-duplicate reference passage(s):")
+        for (filename, original), count in sorted(collapsed.items(), key=lambda item: -item[1])[:10]:
+            where = "elsewhere in the same file" if filename == original else f"from {original}"
+            print(f"   {filename}: {count} passage(s) repeat text {where}")
+        if len(collapsed) > 10:
+            print(f"   ... and {len(collapsed) - 10} more file pair(s)")
+    return [dict(reference, duplicates=frozenset(found)) for reference, found in zip(reference_materials, duplicates)]
+
+def read_reference_passage(reference, start, length):
+    if 'content' in reference:
+        return reference['content'][start:start + length]
+    return get_reference_store().read_reference(reference, start, length)
 
-def create_reference_context(reference_materials):
+def create_reference_context(reference_materials, prompt=None):
     """Create context from reference materials"""
     if not reference_materials:
         return ""
@@ -510,226 +1286,2157 @@ def create_reference_context(reference_materials):
     context += "Do NOT copy, paraphrase, or directly reference any content from these materials.\n"
     context += "Create your own original continuation based on the user's prompt.\n\n"
     
-    for ref in reference_materials:
-        context += f"\n--- Style reference from {ref['filename']} ---\n"
-        context += f"Writing approach: {ref['content'][:500]}...\n"
+    passages = select_reference_passages(prompt, reference_materials) if SEMANTIC_RETRIEVAL and prompt else None
+    if passages is not None:
+        for filename, text in passages:
+            context += f"\n--- Style reference from {filename} ---\n"
+            context += f"Writing approach: {text}...\n"
+    else:
+        for ref in reference_materials:
+            if 0 in ref.get('duplicates', ()):
+                continue  # The opening repeats another reference
+            context += f"\n--- Style reference from {ref['filename']} ---\n"
+            context += f"Writing approach: {reference_text(ref, 500)}...\n"
     
     context += "\nUse the above styles as inspiration for your own original writing.\n"
     return context
 
-def call_openai_model(prompt, model_name, max_tokens=300, temperature=0.3):
-    """Call OpenAI models with proper API key handling"""
-    try:
-        # Check if we have a valid API key
-        if not OPENAI_API_KEY or OPENAI_API_KEY == "" or OPENAI_API_KEY == "your-openai-api-key-here":
-            raise Exception("OpenAI API key not configured. Please set your API key in config.py or use 'new model' to configure it.")
-        
-        # Create client with API key
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        
-        # Use the correct API call for the model
-        if model_name in ["gpt-4"]:
-            # For chat models, use chat completions
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=[
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_p=0.9,
-                frequency_penalty=0.1,
-                presence_penalty=0.0
-            )
-            return response.choices[0].message.content.strip()
-        else:
-            # For completion models (gpt-3.5-turbo-instruct and others), use completions
-            response = client.completions.create(
-                model=model_name,
-                prompt=prompt,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_p=0.9,
-                frequency_penalty=0.1,
-                presence_penalty=0.0
-            )
-            return response.choices[0].text.strip()
-            
-    except Exception as e:
-        raise Exception(f"OpenAI API error: {e}")
+def embed_with_ollama(texts):
+    """Embed texts with EMBEDDING_MODEL on the Ollama hosts"""
+    vectors = []
+    
+    def attempt(timeout, batch):
+        host = OLLAMA_ROUTER.acquire(EMBEDDING_MODEL)
+        failed = True
+        try:
+            response = http_request("POST", f"{host}/api/embed", json_body={"model": EMBEDDING_MODEL, "input": batch}, timeout=timeout)
+            if response.status_code == 404 and "model" not in response.text.lower():
+                # Ollama before 0.3 only has the one-text-per-request endpoint
+                embeddings = []
+                for text in batch:
+                    single = http_request("POST", f"{host}/api/embeddings", json_body={"model": EMBEDDING_MODEL, "prompt": text}, timeout=timeout)
+                    single.raise_for_status()
+                    embeddings.append(single.json()["embedding"])
+            else:
+                response.raise_for_status()
+                embeddings = response.json()["embeddings"]
+            failed = False
+            return embeddings
+        finally:
+            OLLAMA_ROUTER.release(host, success=not failed, model_name=EMBEDDING_MODEL)
+    
+    for start in range(0, len(texts), 64):
+        batch = texts[start:start + 64]
+        vectors.extend(call_with_retry(lambda timeout: attempt(timeout, batch), "Ollama embeddings"))
+    return vectors
 
-def call_ollama_model(prompt, model_name, max_tokens=300, temperature=0.3):
-    """Call Ollama models"""
-    try:
-        url = f"{OLLAMA_BASE_URL}/api/generate"
-        payload = {
-            "model": model_name,
-            "prompt": prompt,
-            "stream": False,
-            "options": {
-                "num_predict": max_tokens,
-                "temperature": temperature,
-                "top_p": 0.9,
-                "repeat_penalty": 1.1
-            }
-        }
-        
-        response = requests.post(url, json=payload, timeout=60)
-        #print(response)
-        response.raise_for_status()
-        
-        result = response.json()
-        return result.get("response", "").strip()
-    except Exception as e:
-        raise Exception(f"Ollama API error: {e}")
+def embed_with_hashing(texts):
+    """Deterministic stand-in embedder: hashed bag of words and word pairs, no model needed"""
+    import numpy as np
+    vectors = np.zeros((len(texts), HASH_EMBEDDING_DIMENSIONS), dtype=np.float32)
+    for row, text in enumerate(texts):
+        words = re.findall(r"\w+", text.lower())
+        for feature in words + [f"{first} {second}" for first, second in zip(words, words[1:])]:
+            digest = hashlib.md5(feature.encode("utf-8")).digest()
+            vectors[row, int.from_bytes(digest[:4], "little") % HASH_EMBEDDING_DIMENSIONS] += 1.0 if digest[4] & 1 else -1.0
+    return vectors
 
-def call_huggingface_model(prompt, model_name, max_tokens=300, temperature=0.3):
-    """Call Hugging Face models"""
-    try:
-        url = f"https://api-inference.huggingface.co/models/{model_name}"
-        headers = {"Authorization": f"Bearer {HUGGINGFACE_API_KEY}"}
-        payload = {
-            "inputs": prompt,
-            "parameters": {
-                "max_new_tokens": max_tokens,
-                "temperature": temperature,
-                "top_p": 0.9,
-                "do_sample": True
-            }
-        }
-        
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
-        response.raise_for_status()
-        
-        result = response.json()
-        if isinstance(result, list) and len(result) > 0:
-            return result[0].get("generated_text", "").strip()
-        else:
-            return str(result).strip()
-    except Exception as e:
-        raise Exception(f"Hugging Face API error: {e}")
+EMBEDDERS = {
+    "ollama": (embed_with_ollama, lambda: EMBEDDING_MODEL),
+    "hash": (embed_with_hashing, lambda: f"{HASH_EMBEDDING_DIMENSIONS}d")
+}
+
+def normalize_rows(vectors):
+    import numpy as np
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
 
-def co_write(prompt, style, custom_elements=None, writer_character=None, model_name=DEFAULT_MODEL, reference_materials=None):
-    instruction = STYLES.get(style.lower(), STYLES["essay"])
+class VectorCache:
+    """Append-only matrix of normalized passage embeddings on disk.
     
-    # Build writer character description if provided - but don't mention the character name
-    character_description = ""
-    if writer_character and writer_character in WRITER_CHARACTERS:
-        char = WRITER_CHARACTERS[writer_character]
-        character_description = f"\n\nWrite with this voice and style:\n"
-        character_description += f"Core essence: {char['personality']}\n"
-        character_description += f"Areas of fascination: {char['interests']}\n"
-        character_description += f"Writing approach: {char['style']}\n"
-        character_description += f"Intellectual lineage: {char['influences']}\n"
-        character_description += f"\nCREATIVE EXPRESSION GUIDE:\n"
-        character_description += f"- Express these interests through story, metaphor, and imagery - not direct statements\n"
-        character_description += f"- Let the character's worldview emerge through how they see and describe the world\n"
-        character_description += f"- Use the character's unique perspective to color the narrative, not to describe themselves\n"
-        character_description += f"\nCRITICAL STYLE INSTRUCTIONS:\n"
-        character_description += f"- Express the character's essence through creative, varied language - avoid repeating the exact words from the description\n"
-        character_description += f"- Use synonyms, metaphors, and different phrasings to convey the same concepts\n"
-        character_description += f"- Be experimental and inventive in how you express the character's worldview\n"
-        character_description += f"- Draw from the influences creatively rather than mentioning them directly\n"
-        character_description += f"- Vary your vocabulary and sentence structures to avoid repetition\n"
-        character_description += f"- Avoid listing interests or traits - embody them through the narrative instead\n"
-        character_description += f"- Don't repeat character description keywords - find fresh ways to express the same ideas\n"
-        character_description += f"- Instead of saying 'cyborg theory' or 'multispecies storytelling', explore these concepts through narrative and metaphor\n"
-        character_description += f"- Transform abstract interests into concrete, vivid imagery and experiences\n"
-        character_description += f"- IMPORTANT: Use this voice/style to continue the user's narrative, NOT to describe the character or their interests\n"
-        character_description += f"- DO NOT start sentences with 'As a...' or 'The philosopher-scientist...' or similar character descriptions\n"
-        character_description += f"- DO NOT list character traits or interests - embody them through the narrative continuation\n"
-        character_description += f"- AVOID DIRECT REPETITION: Never use exact phrases from character interests like 'ancestral technologies,' 'ceremonial time,' 'land-body reciprocity,' 'resistance of stories,' etc.\n"
-        character_description += f"- FIND CREATIVE ALTERNATIVES: Instead of 'ancestral technologies' say 'old ways of knowing' or 'ancient wisdom'\n"
-        character_description += f"- USE METAPHORS: Transform concepts into images, not direct statements\n"
-        character_description += f"- Continue the narrative flow naturally. Do not include any titles, character names, or meta-references in your response. Write directly in this voice without mentioning who is writing."
+    `<name>.f32` holds float32 rows and is read through np.memmap;
+    `<name>.json` maps passage hashes to row numbers. Vectors are written
+    before the index, so an interrupted write leaves at most some unused
+    rows, which are cut off on the next load.
+    """
     
-    # Build custom elements description if provided
-    elements_description = ""
-    if custom_elements:
-        elements_description = "\n\nIncorporate these elements naturally:\n"
-        for element in custom_elements:
-            if element in CUSTOM_ELEMENTS:
-                elements_description += f"- {element}: {CUSTOM_ELEMENTS[element]}\n"
+    def __init__(self, directory, name):
+        self.matrix_path = os.path.join(directory, f"{name}.f32")
+        self.index_path = os.path.join(directory, f"{name}.json")
+        self.rows = {}
+        self.dimensions = None
+        self.matrix = None
+        os.makedirs(directory, exist_ok=True)
+        
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            self.rows = index["rows"]
+            self.dimensions = index["dimensions"]
+        except (OSError, ValueError, KeyError):
+            self.rows = {}
+        
+        expected_size = len(self.rows) * (self.dimensions or 0) * 4
+        actual_size = os.path.getsize(self.matrix_path) if os.path.exists(self.matrix_path) else 0
+        if actual_size < expected_size:
+            self.rows, self.dimensions = {}, None  # Index and matrix disagree; start over
+            expected_size = 0
+        if actual_size != expected_size:
+            with open(self.matrix_path, "ab") as f:
+                f.truncate(expected_size)
+        self.open()
     
-    # Build reference materials context if provided
-    reference_context = ""
-    if reference_materials:
-        reference_context = create_reference_context(reference_materials)
+    def open(self):
+        import numpy as np
+        self.matrix = None
+        if self.rows:
+            self.matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r", shape=(len(self.rows), self.dimensions))
     
-    # Create a continuation-focused prompt
-    continuation_instruction = "\n\nCRITICAL NARRATIVE CONTINUATION RULES:\n"
-    continuation_instruction += "- The user's prompt IS the story to continue - do NOT ignore it\n"
-    continuation_instruction += "- Continue directly from the user's text, not from character descriptions\n"
-    continuation_instruction += "- Do NOT start new stories or describe character traits\n"
-    continuation_instruction += "- Do NOT use phrases like 'As a...' or 'The philosopher-scientist...'\n"
-    continuation_instruction += "- Simply continue the narrative thread the user provided\n"
-    continuation_instruction += "- The character voice should be used to CONTINUE the user's story, not to describe the character\n"
+    def add(self, hashes, vectors):
+        vectors = normalize_rows(vectors)
+        if self.dimensions is None:
+            self.dimensions = int(vectors.shape[1])
+        elif vectors.shape[1] != self.dimensions:
+            raise ValueError(f"Embedding size changed from {self.dimensions} to {vectors.shape[1]}; delete {self.matrix_path}")
+        
+        with open(self.matrix_path, "ab") as f:
+            f.write(vectors.tobytes())
+        for passage_hash in hashes:
+            self.rows[passage_hash] = len(self.rows)
     
-    # Add instruction to avoid copying reference material
-    originality_instruction = "\n\nCRITICAL: Write completely original content. Do not copy, paraphrase, or directly reference any content from reference materials. Use reference materials only for style inspiration. Create your own unique continuation based on the user's prompt."
+    def save(self):
+        """Write the index for rows added since the last save and remap the matrix"""
+        temporary_path = self.index_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            json.dump({"dimensions": self.dimensions, "rows": self.rows}, f)
+        os.replace(temporary_path, self.index_path)
+        self.open()
+
+class ReferenceRetriever:
+    """Top-k reference passages for a prompt by cosine similarity.
     
-    # Make the prompt focus on continuation rather than complete story creation
-    # Put the user's prompt FIRST to prioritize it
-    full_prompt = f"{instruction}{continuation_instruction}{originality_instruction}\n\nUSER'S NARRATIVE TO CONTINUE: {prompt}\n\n{character_description}{elements_description}{reference_context}\n\nFINAL INSTRUCTION: Continue the user's narrative above. Do NOT write about the character - write the continuation of the user's story using the character's voice and style."
+    index() splits the references into passages and embeds only those whose
+    hash is not in the vector cache yet; the passage vectors are then one
+    matrix, so each prompt costs a single embedding plus one matrix-vector
+    product and a partial sort.
+    """
     
-    # Find the model provider
-    model_provider = None
-    for provider, models in MODELS.items():
-        if model_name in models:
-            model_provider = models[model_name]["provider"]
-            break
+    def __init__(self, backend=EMBEDDING_BACKEND, cache_dir=VECTOR_CACHE_DIR):
+        if backend not in EMBEDDERS:
+            raise ValueError(f"Unknown embedding backend: {backend}")
+        self.embed, cache_name = EMBEDDERS[backend]
+        self.cache = VectorCache(cache_dir, re.sub(r"[^\w.-]+", "_", f"{backend}-{cache_name()}"))
+        self.lock = threading.Lock()
+        self.references = []
+        self.key = None
+        self.matrix = None
+        self.last_query = (None, None)
     
-    if not model_provider:
-        raise Exception(f"Model {model_name} not found")
+    def index(self, reference_materials):
+        import numpy as np
+        owners, starts, lengths, keys = [], [], [], []
+        for number, ref in enumerate(reference_materials):
+            for start, length, hash_value in iter_reference_passages(ref):
+                owners.append(number)
+                starts.append(start)
+                lengths.append(length)
+                keys.append(f"{hash_value:016x}")
+        
+        missing = {}
+        for position, key in enumerate(keys):
+            if key not in self.cache.rows and key not in missing:
+                missing[key] = position
+        if missing:
+            print(f"Embedding {len(missing)} new reference passage(s)...")
+            pending = list(missing.items())
+            for start in range(0, len(pending), 256):
+                batch = pending[start:start + 256]
+                texts = [read_reference_passage(reference_materials[owners[position]], starts[position], lengths[position])
+                         for _, position in batch]
+                self.cache.add([key for key, _ in batch], self.embed(texts))
+                if start % 4096 == 4096 - 256:
+                    self.cache.save()  # Keep progress if a long embedding run is interrupted
+            self.cache.save()
+        
+        self.matrix = None
+        if keys:
+            rows = np.fromiter((self.cache.rows[key] for key in keys), dtype=np.int64, count=len(keys))
+            if len(rows) == len(self.cache.matrix) and np.array_equal(rows, np.arange(len(rows))):
+                self.matrix = self.cache.matrix  # Every cached row is in use, in order: no copy needed
+            else:
+                self.matrix = np.ascontiguousarray(self.cache.matrix[rows])
+        # Passages are kept as positions; their text is read only when selected
+        self.owners = np.array(owners, dtype=np.int32)
+        self.starts = np.array(starts, dtype=np.int64)
+        self.lengths = np.array(lengths, dtype=np.int64)
+        # Holding the reference dicts keeps their ids from being reused while the key is live
+        self.references = list(reference_materials)
+        self.key = tuple(map(id, reference_materials))
     
-    # Call the appropriate API based on provider
-    if model_provider == "openai":
-        return call_openai_model(full_prompt, model_name)
-    elif model_provider == "ollama":
-        return call_ollama_model(full_prompt, model_name)
-    elif model_provider == "huggingface":
-        return call_huggingface_model(full_prompt, model_name)
-    else:
-        raise Exception(f"Unknown provider: {model_provider}")
+    def select(self, prompt, reference_materials, k=RETRIEVAL_TOP_K):
+        import numpy as np
+        with self.lock:
+            if self.key != tuple(map(id, reference_materials)):
+                self.index(reference_materials)
+            if self.matrix is None:
+                return []
+            
+            # Best-of and speculative calls ask for the same prompt more than once
+            if self.last_query[0] != prompt:
+                self.last_query = (prompt, normalize_rows(self.embed([prompt]))[0])
+            scores = self.matrix @ self.last_query[1]
+            k = min(k, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            selected = []
+            for index in top:
+                reference = self.references[self.owners[index]]
+                selected.append((reference['filename'], read_reference_passage(reference, int(self.starts[index]), int(self.lengths[index]))))
+            return selected
 
-def get_available_ollama_models():
-    """Get list of actually installed Ollama models"""
+_reference_retriever = None
+_semantic_retrieval_failed = False
+
+def get_reference_retriever():
+    """The session's ReferenceRetriever, or None if semantic retrieval cannot run"""
+    global _reference_retriever, _semantic_retrieval_failed
+    if _semantic_retrieval_failed:
+        return None
+    if _reference_retriever is None:
+        try:
+            _reference_retriever = ReferenceRetriever()
+        except ImportError:
+            print("numpy not installed. Install with: pip install numpy (semantic retrieval disabled)")
+            _semantic_retrieval_failed = True
+    return _reference_retriever
+
+def select_reference_passages(prompt, reference_materials):
+    """Closest passages as (filename, text) pairs, or None to fall back to file openings"""
+    retriever = get_reference_retriever()
+    if retriever is None:
+        return None
     try:
-        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            return [model["name"].split(":")[0] for model in data.get("models", [])]
-        else:
-            print(f"Warning: Could not fetch Ollama models (status {response.status_code})")
-            return []
+        return retriever.select(prompt, reference_materials)
     except Exception as e:
-        print(f"Warning: Could not connect to Ollama: {e}")
-        return []
+        # Don't pay for the failing embedding calls again on every prompt
+        global _semantic_retrieval_failed
+        _semantic_retrieval_failed = True
+        print(f"⚠️  Semantic retrieval failed ({e}); using the start of each reference until they are reloaded")
+        return None
 
-def list_available_models():
-    """List all available models grouped by provider with numbers"""
-    print("\n" + "="*60)
-    print("AVAILABLE MODELS")
-    print("="*60)
-    
-    all_models = {}
-    model_counter = 1
-    
-    # Get actually installed Ollama models
-    installed_ollama_models = get_available_ollama_models()
+def index_reference_materials(reference_materials):
+    """Embed new reference passages now rather than during the next prompt"""
+    global _semantic_retrieval_failed
+    if _reference_retriever is not None:
+        # A reload gives a retriever whose embedding calls failed another chance
+        # (without numpy there is no retriever, and the failure stays)
+        _semantic_retrieval_failed = False
+    retriever = get_reference_retriever() if SEMANTIC_RETRIEVAL and reference_materials else None
+    if retriever is None:
+        return
+    try:
+        with retriever.lock:
+            retriever.index(reference_materials)
+    except Exception as e:
+        print(f"⚠️  Could not index reference materials: {e}")
+
+class Cassette:
+    """Recorded HTTP exchanges, one JSON object per line.
     
-    for provider, models in MODELS.items():
-        print(f"\n{provider.upper()} MODELS:")
-        print("-" * 30)
-        for model_name, model_info in models.items():
-            # For Ollama models, only show if actually installed
-            if provider == "ollama" and model_name not in installed_ollama_models:
-                continue
-                
-            key_required = "🔑" if model_info["requires_key"] else "✅"
-            print(f"{model_counter:2d}. {key_required} {model_name}")
-            print(f"     {model_info['description']}")
-            all_models[model_counter] = model_name
+    Requests are matched on method, URL path and JSON body, ignoring the host,
+    random seeds and host-dependent runtime options, so a recording made against
+    one server can be replayed whatever OLLAMA_HOSTS or base URLs are configured. Identical requests are
+    served in recording order. Streamed chunks are stored with their offset
+    from the start of the request so replays can reproduce the timing.
+    Request headers (and so API keys) are never written to the file.
+    """
+
+    def __init__(self, path, time_scale=0.0):
+        self.path = path
+        self.time_scale = time_scale
+        self._entries = None
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    IGNORED_FIELDS = ("seed", "num_ctx", "num_thread", "stream_options")
+
+    @staticmethod
+    def key(method, url, body):
+        def without_seeds(value):
+            if isinstance(value, dict):
+                return {name: without_seeds(item) for name, item in value.items() if name not in Cassette.IGNORED_FIELDS}
+            return value
+        return json.dumps([method.upper(), urlsplit(url).path, without_seeds(body)], sort_keys=True)
+
+    def record(self, method, url, body, status_code, headers, chunks):
+        entry = {
+            "request": {"method": method.upper(), "url": url, "body": body},
+            "status": status_code,
+            "headers": {name: value for name, value in headers.items()
+                        if name.lower() not in ("content-encoding", "content-length", "transfer-encoding", "connection")},
+            "chunks": chunks
+        }
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(json.dumps(entry) + "\n")
+            if self._entries is not None:
+                self._entries.setdefault(self.key(method, url, body), []).append(entry)
+
+    def find(self, method, url, body):
+        with self._lock:
+            if self._entries is None:
+                self._entries = {}
+                if os.path.exists(self.path):
+                    with open(self.path, "r", encoding="utf-8") as file:
+                        for line in file:
+                            if line.strip():
+                                entry = json.loads(line)
+                                request = entry["request"]
+                                self._entries.setdefault(self.key(request["method"], request["url"], request["body"]), []).append(entry)
+            
+            key = self.key(method, url, body)
+            entries = self._entries.get(key)
+            if not entries:
+                raise ProviderError(f"No recorded response in {self.path} for {method.upper()} {urlsplit(url).path}")
+            # Serve repeats in order, then keep returning the last one
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+            return entries[min(position, len(entries) - 1)]
+
+    def replay_chunks(self, entry):
+        """Yield the recorded chunks, sleeping between them according to time_scale"""
+        previous_offset = 0.0
+        for offset, chunk in entry["chunks"]:
+            if self.time_scale > 0 and offset > previous_offset:
+                time.sleep((offset - previous_offset) * self.time_scale)
+            previous_offset = offset
+            yield chunk
+
+def record_chunks(chunks, start_time, recorded):
+    """Pass byte chunks through while appending them to recorded as (offset, text) pairs"""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    for chunk in chunks:
+        recorded.append([round(time.monotonic() - start_time, 4), decoder.decode(chunk)])
+        yield chunk
+    recorded.append([round(time.monotonic() - start_time, 4), decoder.decode(b"", final=True)])
+
+class TransportResponse:
+    """Minimal stand-in for requests.Response, built from an iterator of byte chunks"""
+
+    def __init__(self, url, status_code, headers, chunks, on_close=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = requests.structures.CaseInsensitiveDict(headers)
+        self._chunks = iter(chunks)
+        self._content = None
+        self._on_close = on_close
+
+    def iter_content(self, chunk_size=None, decode_unicode=False):
+        if self._content is not None:
+            yield self._content
+            return
+        for chunk in self._chunks:
+            yield chunk.decode("utf-8", errors="replace") if decode_unicode else chunk
+
+    def iter_lines(self, decode_unicode=False):
+        pending = ""
+        for chunk in self.iter_content():
+            pending += chunk.decode("utf-8", errors="replace") if isinstance(chunk, bytes) else chunk
+            *lines, pending = pending.split("\n")
+            for line in lines:
+                line = line.rstrip("\r")
+                yield line if decode_unicode else line.encode("utf-8")
+        if pending:
+            yield pending if decode_unicode else pending.encode("utf-8")
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b"".join(self._chunks)
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+    def close(self):
+        if hasattr(self._chunks, "close"):
+            self._chunks.close()
+        if self._on_close:
+            self._on_close()
+            self._on_close = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+_cassette = None
+
+def get_cassette():
+    global _cassette
+    if _cassette is None:
+        _cassette = Cassette(CASSETTE_FILE, REPLAY_TIME_SCALE)
+    return _cassette
+
+def http_request(method, url, json_body=None, headers=None, timeout=None, stream=False):
+    """Send a model API request through the configured transport (passthrough, record or replay)"""
+    if HTTP_TRANSPORT_MODE == "replay":
+        cassette = get_cassette()
+        entry = cassette.find(method, url, json_body)
+        return TransportResponse(url, entry["status"], entry["headers"],
+                                 (chunk.encode("utf-8") for chunk in cassette.replay_chunks(entry)))
+    
+    start_time = time.monotonic()
+    response = requests.request(method, url, json=json_body, headers=headers, timeout=timeout, stream=stream)
+    if HTTP_TRANSPORT_MODE != "record":
+        return response
+    
+    if not stream:
+        # The body has already been read, so record it now whether or not the caller reads it
+        body = [[round(time.monotonic() - start_time, 4), response.content.decode("utf-8", errors="replace")]]
+        get_cassette().record(method, url, json_body, response.status_code, response.headers, body)
+        return response
+    
+    # Closing the response saves whatever was received, even if nobody read the stream
+    recorded = []
+    
+    def save():
+        response.close()
+        get_cassette().record(method, url, json_body, response.status_code, response.headers, recorded)
+    
+    chunks = record_chunks(response.iter_content(chunk_size=None), start_time, recorded)
+    return TransportResponse(url, response.status_code, response.headers, chunks, on_close=save)
+
+# Error classes used by the retry policy
+ERROR_TRANSIENT = "transient"
+ERROR_RATE_LIMITED = "rate_limited"
+ERROR_FATAL = "fatal"
+
+class ProviderError(Exception):
+    """Model API failure, classified so callers know whether a retry can help"""
+
+    def __init__(self, message, kind=ERROR_FATAL, retry_after=None):
+        super().__init__(message)
+        self.kind = kind
+        self.retry_after = retry_after
+
+class StopGeneration(Exception):
+    """Raised from a token callback to end a stream early; carries the text to keep"""
+
+    def __init__(self, reason, text):
+        super().__init__(reason)
+        self.reason = reason
+        self.text = text
+
+class Continuation(str):
+    """Generated text that also records why generation stopped (None when it ran normally)"""
+
+    def __new__(cls, text, stop_reason=None):
+        continuation = super().__new__(cls, text)
+        continuation.stop_reason = stop_reason
+        return continuation
+
+class GenerationCancelled(Exception):
+    """Raised when the user interrupts a generation; carries the text received so far"""
+
+    def __init__(self, partial_text=""):
+        super().__init__("Generation cancelled")
+        self.partial_text = partial_text
+
+class CancelRequested(KeyboardInterrupt):
+    """Raised from a token callback to cancel a background generation; handled exactly like Ctrl-C"""
+
+def parse_retry_after(headers):
+    """Return the server-requested wait in seconds from response headers, or None"""
+    if not headers:
+        return None
+    
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(value)
+                return max(0.0, retry_at.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    
+    # OpenAI also reports when its rate limit windows reset, e.g. "1s", "6m0s" or "250ms"
+    for header in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens"):
+        value = headers.get(header)
+        if value:
+            seconds = parse_duration(value)
+            if seconds is not None:
+                return seconds
+    return None
+
+def parse_duration(value):
+    """Parse durations such as '20s', '1m30s' or '250ms' into seconds"""
+    multipliers = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value)
+    if not parts:
+        return None
+    return sum(float(number) * multipliers[unit] for number, unit in parts)
+
+def classify_error(error):
+    """Sort an exception into transient, rate-limited or fatal, with any server-suggested wait"""
+    if isinstance(error, ProviderError):
+        return error.kind, error.retry_after
+    
+    # HTTP errors from model APIs
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        response = error.response
+        retry_after = parse_retry_after(response.headers)
+        if response.status_code == 429:
+            # OpenAI uses 429 for an exhausted quota too, which waiting won't fix
+            try:
+                error_body = response.json().get("error")
+            except (ValueError, AttributeError):
+                error_body = None
+            if isinstance(error_body, dict) and error_body.get("code") == "insufficient_quota":
+                return ERROR_FATAL, None
+            return ERROR_RATE_LIMITED, retry_after
+        if response.status_code in (408, 409) or response.status_code >= 500:
+            # Hugging Face answers 503 with an estimated_time while a cold model loads
+            try:
+                estimated_time = response.json().get("estimated_time")
+            except (ValueError, AttributeError):
+                estimated_time = None
+            if estimated_time is not None and retry_after is None:
+                retry_after = float(estimated_time)
+            return ERROR_TRANSIENT, retry_after
+        return ERROR_FATAL, None
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return ERROR_TRANSIENT, None
+    
+    return ERROR_FATAL, None
+
+def get_deadline(deadline=None):
+    """Return an absolute time.monotonic() deadline, defaulting to REQUEST_DEADLINE from now"""
+    if deadline is None:
+        return time.monotonic() + REQUEST_DEADLINE
+    return deadline
+
+class ThroughputTracker:
+    """Moving averages of time to first token and tokens per second per model and host.
+    
+    Tokens are always counted the same way, whatever the provider and
+    whether the reply was streamed: the completion token count the server
+    reports (usage, eval_count, generated_tokens), or else count_reply_tokens'
+    estimate of four characters a token. Streamed deltas are not counted, as
+    one delta can hold several tokens or part of one.
+    
+    Streams measure both directly. A non-streamed reply only gives the total
+    time, so the expected time to first token is taken off before computing
+    the rate. Each sample also updates the model's estimate under host None,
+    used to size max_tokens before the router has chosen a host.
+    """
+
+    MIN_SAMPLE_TOKENS = 8  # Shorter replies say more about overhead than speed
+
+    def __init__(self, smoothing=0.3):
+        self.smoothing = smoothing
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_name, host, tokens, seconds, first_token_seconds=None):
+        if tokens < self.MIN_SAMPLE_TOKENS or seconds <= 0:
+            return
+        with self._lock:
+            for key in ((model_name, host), (model_name, None)):
+                stats = self._stats.get(key)
+                first_token = first_token_seconds
+                if first_token is None:
+                    first_token = min(stats["first_token"] if stats else 0.0, seconds * 0.9)
+                rate = tokens / max(seconds - first_token, 1e-3)
+                if stats is None:
+                    self._stats[key] = {"first_token": first_token, "rate": rate, "samples": 1}
+                    continue
+                if first_token_seconds is not None:
+                    stats["first_token"] += self.smoothing * (first_token - stats["first_token"])
+                stats["rate"] += self.smoothing * (rate - stats["rate"])
+                stats["samples"] += 1
+
+    def estimate(self, model_name, host=None):
+        """(seconds to first token, tokens per second), or None before the first measurement"""
+        with self._lock:
+            stats = self._stats.get((model_name, host)) or self._stats.get((model_name, None))
+            return (stats["first_token"], stats["rate"]) if stats else None
+
+    def measure(self, deltas, model_name, host, start, usage):
+        """Pass streamed deltas through, recording their speed when the stream ends.
+        
+        The stream reader puts the token count the server reports, if any,
+        in usage["tokens"].
+        """
+        first_token = None
+        parts = []
+        try:
+            for delta in deltas:
+                if delta:
+                    if first_token is None:
+                        first_token = time.monotonic() - start
+                    parts.append(delta)
+                yield delta
+        finally:
+            self.record(model_name, host, count_reply_tokens("".join(parts), usage.get("tokens")),
+                        time.monotonic() - start, first_token)
+
+    def read_timeout(self, model_name, host, max_tokens, streaming, default, deadline):
+        """Seconds to wait for data from the server, at most until the deadline.
+        
+        A stream's read timeout bounds the wait for the first token and every
+        gap after it, so it detects stalls; a plain request has to wait for
+        the whole reply. Unmeasured models keep the default.
+        """
+        estimate = self.estimate(model_name, host)
+        if not ADAPTIVE_TIMEOUTS or estimate is None:
+            return default
+        first_token, rate = estimate
+        expected = first_token if streaming else first_token + max_tokens / rate
+        timeout = max(ADAPTIVE_MIN_TIMEOUT, expected * ADAPTIVE_TIMEOUT_FACTOR)
+        return max(0.1, min(timeout, deadline - time.monotonic()))
+
+    def max_tokens_for(self, model_name, max_tokens, latency_target):
+        """Shrink max_tokens so the reply should arrive within latency_target seconds"""
+        estimate = self.estimate(model_name)
+        if latency_target is None or estimate is None:
+            return max_tokens
+        first_token, rate = estimate
+        budget = int((latency_target - first_token) * rate)
+        return max(min(max_tokens, LATENCY_TARGET_MIN_TOKENS), min(max_tokens, budget))
+
+    def summary(self):
+        with self._lock:
+            return {key: dict(stats) for key, stats in self._stats.items()}
+
+THROUGHPUT = ThroughputTracker()
+
+def count_reply_tokens(text, reported=None):
+    """Token count the server reported, or an estimate of about four characters a token"""
+    return reported if isinstance(reported, int) and reported > 0 else len(text) // 4
+
+def call_with_retry(attempt, provider_label, deadline=None):
+    """Run attempt(timeout) until it succeeds, a fatal error occurs, or the deadline is reached.
+    
+    Waits use exponential backoff with full jitter, unless the server asked for
+    a specific delay (Retry-After, rate limit reset, Hugging Face estimated_time).
+    """
+    deadline = get_deadline(deadline)
+    attempt_number = 0
+    
+    while True:
+        attempt_number += 1
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise ProviderError(f"{provider_label} API error: request deadline exceeded", ERROR_TRANSIENT)
+        
+        try:
+            return attempt(min(REQUEST_TIMEOUT, remaining))
+        except GenerationCancelled:
+            raise
+        except KeyboardInterrupt:
+            raise GenerationCancelled() from None
+        except Exception as e:
+            kind, retry_after = classify_error(e)
+            message = str(e) if isinstance(e, ProviderError) else f"{provider_label} API error: {e}"
+            if kind == ERROR_FATAL or attempt_number >= RETRY_MAX_ATTEMPTS:
+                raise ProviderError(message, kind, retry_after) from e
+            
+            if retry_after is not None:
+                delay = retry_after + random.uniform(0, RETRY_BASE_DELAY)
+            else:
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt_number - 1)))
+            
+            if time.monotonic() + delay >= deadline:
+                raise ProviderError(f"{message} (no time left to retry)", kind, retry_after) from e
+            
+            reason = "rate limited" if kind == ERROR_RATE_LIMITED else "temporarily unavailable"
+            print(f"⏳ {provider_label} {reason}, retrying in {delay:.1f}s (attempt {attempt_number + 1}/{RETRY_MAX_ATTEMPTS})")
+            try:
+                time.sleep(delay)
+            except KeyboardInterrupt:
+                raise GenerationCancelled() from None
+
+def iter_sse_events(response):
+    """Yield the decoded JSON payload of each server-sent event data line"""
+    for line in response.iter_lines(decode_unicode=True):
+        if not line or not line.startswith("data:"):
+            continue
+        data = line[len("data:"):].strip()
+        if data == "[DONE]":
+            break
+        try:
+            yield json.loads(data)
+        except ValueError:
+            continue
+
+def collect_stream(deltas, on_token, provider_label):
+    """Join streamed text deltas, passing each to on_token as it arrives.
+    
+    Once text has been shown to the user a retry would repeat it, so failures
+    after the first delta are reported as fatal instead of retried. Ctrl-C stops
+    reading and raises GenerationCancelled with the text received so far; the
+    caller closes the underlying stream so the server stops generating.
+    on_token may raise StopGeneration to end the stream with a chosen text.
+    """
+    parts = []
+    try:
+        for delta in deltas:
+            if delta:
+                parts.append(delta)
+                on_token(delta)
+    except StopGeneration as e:
+        return Continuation(e.text.strip(), e.reason)
+    except KeyboardInterrupt:
+        raise GenerationCancelled("".join(parts).strip()) from None
+    except Exception as e:
+        if parts and not isinstance(e, ProviderError):
+            raise ProviderError(f"{provider_label} API error: stream interrupted: {e}") from e
+        raise
+    return "".join(parts).strip()
+
+def call_openai_compatible(base_url, headers, provider_label, chat, prompt, model_name, max_tokens, temperature,
+                           deadline, on_token, stop, seed, max_stop_sequences=None, slots=None):
+    """Completion from any server speaking the OpenAI API, streamed when on_token is given.
+    
+    With a semaphore as `slots`, each attempt holds one slot while it talks to
+    the server; backoff waits between attempts leave it free for other requests.
+    """
+    deadline = get_deadline(deadline)
+    payload = {
+        "model": model_name,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "top_p": 0.9,
+        "frequency_penalty": 0.1,
+        "presence_penalty": 0.0,
+        "stream": on_token is not None
+    }
+    if stop:
+        payload["stop"] = list(stop)[:max_stop_sequences]
+    if seed is not None:
+        payload["seed"] = seed
+    if on_token is not None:
+        # A final chunk with the token count, so speeds are measured in real tokens
+        payload["stream_options"] = {"include_usage": True}
+    
+    # Use the correct API for the model
+    if chat:
+        # For chat models, use chat completions
+        url = f"{base_url.rstrip('/')}/chat/completions"
+        payload["messages"] = [{"role": "user", "content": prompt}]
+    else:
+        # For completion models (gpt-3.5-turbo-instruct and others), use completions
+        url = f"{base_url.rstrip('/')}/completions"
+        payload["prompt"] = prompt
+    
+    def read_stream(response, usage):
+        for event in iter_sse_events(response):
+            if "error" in event:
+                raise ProviderError(f"{provider_label} API error: {event['error']}")
+            if event.get("usage"):
+                usage["tokens"] = event["usage"].get("completion_tokens")
+            if not event.get("choices"):
+                continue
+            choice = event["choices"][0]
+            if chat:
+                yield (choice.get("delta") or {}).get("content") or ""
+            else:
+                yield choice.get("text") or ""
+    
+    def send(timeout):
+        timeout = THROUGHPUT.read_timeout(model_name, base_url, max_tokens, on_token is not None, timeout, deadline)
+        start = time.monotonic()
+        response = http_request("POST", url, json_body=payload, headers=headers, timeout=timeout, stream=on_token is not None)
+        # Closing the stream (also on Ctrl-C) drops the connection so billing stops
+        with response:
+            response.raise_for_status()
+            
+            if on_token is not None:
+                usage = {}
+                return collect_stream(THROUGHPUT.measure(read_stream(response, usage), model_name, base_url, start, usage),
+                                      on_token, provider_label)
+            
+            result = response.json()
+        choice = result["choices"][0]
+        text = (choice["message"]["content"] or "") if chat else choice["text"]
+        THROUGHPUT.record(model_name, base_url, count_reply_tokens(text, (result.get("usage") or {}).get("completion_tokens")),
+                          time.monotonic() - start)
+        return text.strip()
+    
+    def attempt(timeout):
+        if slots is None:
+            return send(timeout)
+        with slots:
+            return send(timeout)
+    
+    return call_with_retry(attempt, provider_label, deadline)
+
+def call_openai_model(prompt, model_name, max_tokens=300, temperature=0.3, deadline=None, on_token=None, stop=None, seed=None,
+                      api_key=None):
+    """Call OpenAI models with proper API key handling"""
+    if api_key is None:
+        api_key = ENGINE_STATE.openai_api_key
+    # Check if we have a valid API key
+    if not api_key or api_key == "your-openai-api-key-here":
+        raise ProviderError("OpenAI API key not configured. Please set your API key in config.py or use 'new model' to configure it.")
+    
+    headers = {"Authorization": f"Bearer {api_key}"}
+    # OpenAI accepts at most four stop sequences
+    return call_openai_compatible(OPENAI_BASE_URL, headers, "OpenAI", model_name in ["gpt-4"], prompt, model_name, max_tokens,
+                                  temperature, deadline, on_token, stop, seed, max_stop_sequences=4)
+
+_local_server_slots = None
+_local_server_concurrency = None
+_local_server_slots_lock = threading.Lock()
+
+def get_local_server_concurrency():
+    """How many requests to keep in flight on the local server.
+    
+    Continuous-batching servers decode a fixed number of sequences together
+    (llama.cpp's --parallel slots, vLLM's batch); sending more only queues
+    them on the server, sending fewer leaves batch capacity unused.
+    """
+    if LOCAL_OPENAI_MAX_CONCURRENCY > 0:
+        return LOCAL_OPENAI_MAX_CONCURRENCY
+    root_url = re.sub(r"/v1/?$", "", LOCAL_OPENAI_BASE_URL.rstrip("/"))
+    try:
+        response = http_request("GET", f"{root_url}/props", timeout=5)
+        if response.status_code == 200:
+            slots = response.json().get("total_slots")
+            if isinstance(slots, int) and slots > 0:
+                return slots
+    except (requests.RequestException, ProviderError, ValueError):
+        pass
+    return 4
+
+def get_local_server_slots():
+    """Semaphore sized to the local server's concurrency, created on first use"""
+    global _local_server_slots, _local_server_concurrency
+    with _local_server_slots_lock:
+        if _local_server_slots is None:
+            _local_server_concurrency = get_local_server_concurrency()
+            _local_server_slots = threading.BoundedSemaphore(_local_server_concurrency)
+        return _local_server_slots
+
+def call_local_model(prompt, model_name, max_tokens=300, temperature=0.3, deadline=None, on_token=None, stop=None, seed=None):
+    """Call a local OpenAI-compatible server (llama.cpp server, vLLM, LocalAI)"""
+    if not LOCAL_OPENAI_BASE_URL:
+        raise ProviderError("LOCAL_OPENAI_BASE_URL is not set in config.py")
+    headers = {"Authorization": f"Bearer {LOCAL_OPENAI_API_KEY}"} if LOCAL_OPENAI_API_KEY else {}
+    return call_openai_compatible(LOCAL_OPENAI_BASE_URL, headers, "Local server", LOCAL_OPENAI_CHAT, prompt, model_name,
+                                  max_tokens, temperature, deadline, on_token, stop, seed, slots=get_local_server_slots())
+
+def get_local_server_models():
+    """Model ids served by the local OpenAI-compatible server ([] if none is configured or reachable)"""
+    if not LOCAL_OPENAI_BASE_URL:
+        return []
+    headers = {"Authorization": f"Bearer {LOCAL_OPENAI_API_KEY}"} if LOCAL_OPENAI_API_KEY else {}
+    try:
+        response = http_request("GET", f"{LOCAL_OPENAI_BASE_URL.rstrip('/')}/models", headers=headers, timeout=5)
+        response.raise_for_status()
+        return [model["id"] for model in response.json().get("data", []) if model.get("id")]
+    except (requests.RequestException, ProviderError, ValueError, KeyError) as e:
+        print(f"Warning: Could not fetch models from {LOCAL_OPENAI_BASE_URL}: {e}")
+        return []
+
+_local_models_registered = False
+_local_models_lock = threading.Lock()
+
+def register_local_server_models():
+    """Add the local server's models to the engine state so co_write can route to them"""
+    global _local_models_registered
+    model_ids = get_local_server_models()
+    models = dict(ENGINE_STATE.models)
+    models["local"] = {
+        model_id: {"provider": "local", "description": f"Served by {LOCAL_OPENAI_BASE_URL}", "requires_key": False}
+        for model_id in model_ids
+    }
+    update_engine_state(models=models)
+    _local_models_registered = True
+    return model_ids
+
+def get_model_provider(model_name, state=None):
+    """Provider of model_name, or None; an unknown name first makes the local server's models known.
+    
+    Every entry point (the model menu, --resume, sweeps, load tests, direct
+    co_write calls) can then use a local server model by name. The server is
+    asked once per session; the model menu asks again.
+    """
+    state = state or ENGINE_STATE
+    provider = state.model_provider(model_name)
+    if provider is None and LOCAL_OPENAI_BASE_URL:
+        with _local_models_lock:
+            if not _local_models_registered:
+                register_local_server_models()
+        provider = ENGINE_STATE.model_provider(model_name)
+    return provider
+
+def recommended_concurrency(model_name, requested):
+    """Parallel requests worth sending for model_name, at most `requested`"""
+    if get_model_provider(model_name) == "local":
+        get_local_server_slots()
+        return max(1, min(requested, _local_server_concurrency))
+    return requested
+
+class OllamaRouter:
+    """Spread Ollama requests over several hosts.
+    
+    A background thread probes each host's /api/tags (installed models) and
+    /api/ps (models loaded in memory). acquire() prefers healthy hosts that
+    already have the model loaded and have the fewest requests in flight,
+    weighing a cold model as a few extra queued requests. Hosts that fail
+    repeatedly are ejected for a while; a successful probe brings them back.
+    """
+
+    cold_model_penalty = 2
+
+    def __init__(self, hosts, probe_interval=15, failure_threshold=3, ejection_seconds=30):
+        self.probe_interval = probe_interval
+        self.failure_threshold = failure_threshold
+        self.ejection_seconds = ejection_seconds
+        self.hosts = {}
+        for host in hosts:
+            self.hosts[host.rstrip("/")] = {
+                "outstanding": 0,
+                "failures": 0,
+                "ejected_until": 0.0,
+                "installed": set(),
+                "loaded": set(),
+                "probed": False,
+                "contexts": {}  # num_ctx each model was last loaded with
+            }
+        self._lock = threading.Lock()
+        self._probe_thread = None
+
+    @staticmethod
+    def _model_names(entries):
+        # Ollama reports "mistral:latest"; the rest of the program uses "mistral"
+        names = set()
+        for entry in entries:
+            name = entry.get("name") or entry.get("model") or ""
+            names.add(name)
+            names.add(name.split(":")[0])
+        return names
+
+    def probe(self, host):
+        """Refresh one host's installed and loaded models; return True if it answered"""
+        try:
+            tags = http_request("GET", f"{host}/api/tags", timeout=5)
+            tags.raise_for_status()
+            installed = self._model_names(tags.json().get("models", []))
+            try:
+                running = http_request("GET", f"{host}/api/ps", timeout=5)
+                running.raise_for_status()
+                loaded = self._model_names(running.json().get("models", []))
+            except (requests.RequestException, ProviderError, ValueError):
+                loaded = set()  # Older Ollama versions have no /api/ps
+        except (requests.RequestException, ProviderError, ValueError):
+            self.report(host, success=False)
+            return False
+        
+        with self._lock:
+            state = self.hosts[host]
+            state["installed"] = installed
+            state["loaded"] = loaded
+            state["probed"] = True
+            state["failures"] = 0
+            state["ejected_until"] = 0.0
+        return True
+
+    def probe_all(self):
+        for host in list(self.hosts):
+            self.probe(host)
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            self.probe_all()
+
+    def start(self):
+        """Start background probing (only useful with more than one host)"""
+        if self._probe_thread is None and len(self.hosts) > 1:
+            self._probe_thread = threading.Thread(target=self._probe_loop, daemon=True)
+            self._probe_thread.start()
+
+    def acquire(self, model_name=None, preferred_host=None):
+        """Pick a host for model_name and count the request as in flight"""
+        self.start()
+        now = time.monotonic()
+        with self._lock:
+            candidates = [host for host, state in self.hosts.items() if state["ejected_until"] <= now]
+            if not candidates:
+                # Everything is ejected: try the host that comes back soonest rather than failing outright
+                candidates = [min(self.hosts, key=lambda host: self.hosts[host]["ejected_until"])]
+            
+            def rank(host):
+                # Loading a model costs about as much as a couple of queued requests,
+                # and a host without the model installed is a last resort
+                state = self.hosts[host]
+                load = state["outstanding"]
+                if model_name not in state["loaded"]:
+                    load += self.cold_model_penalty
+                if state["probed"] and model_name not in state["installed"]:
+                    load += 1000
+                return (host != preferred_host, load)
+            
+            host = min(candidates, key=rank)
+            self.hosts[host]["outstanding"] += 1
+            return host
+
+    def release(self, host, success=True, model_name=None):
+        """Mark a request on host as finished"""
+        with self._lock:
+            state = self.hosts[host]
+            state["outstanding"] = max(0, state["outstanding"] - 1)
+            if success and model_name:
+                state["loaded"].add(model_name)  # Ollama keeps a model in memory after serving it
+        self.report(host, success)
+
+    def context_size(self, host, model_name, needed):
+        """num_ctx for a request on host: at least `needed`, and never below what the model is loaded with"""
+        with self._lock:
+            contexts = self.hosts[host]["contexts"] if host in self.hosts else {}
+            size = max(needed, contexts.get(model_name, 0))
+            contexts[model_name] = size
+            return size
+
+    def report(self, host, success):
+        with self._lock:
+            state = self.hosts[host]
+            if success:
+                state["failures"] = 0
+                return
+            state["failures"] += 1
+            if state["failures"] >= self.failure_threshold:
+                state["ejected_until"] = time.monotonic() + self.ejection_seconds
+                print(f"⚠️  Ollama host {host} is failing; taking it out of rotation for {self.ejection_seconds}s")
+
+    def available_models(self):
+        """Models installed on any host that is currently in rotation"""
+        if not any(state["probed"] for state in self.hosts.values()):
+            self.probe_all()
+        now = time.monotonic()
+        with self._lock:
+            models = set()
+            for state in self.hosts.values():
+                if state["ejected_until"] <= now:
+                    models |= state["installed"]
+            return models
+
+OLLAMA_ROUTER = OllamaRouter(OLLAMA_HOSTS, OLLAMA_PROBE_INTERVAL, OLLAMA_FAILURE_THRESHOLD, OLLAMA_EJECTION_SECONDS)
+
+def get_ollama_model_profile(model_name):
+    """Options from OLLAMA_MODEL_PROFILES for a model ("mistral" also covers "mistral:7b")"""
+    return OLLAMA_MODEL_PROFILES.get(model_name) or OLLAMA_MODEL_PROFILES.get(model_name.split(":")[0]) or {}
+
+def estimate_tokens(text):
+    """Rough token count; English averages about four characters a token, three keeps the estimate on the safe side"""
+    return len(text) // 3 + 1
+
+def get_context_bucket(tokens):
+    """Smallest OLLAMA_CONTEXT_BUCKETS size that holds `tokens` (the largest if none does)"""
+    for size in sorted(OLLAMA_CONTEXT_BUCKETS):
+        if size >= tokens:
+            return size
+    return max(OLLAMA_CONTEXT_BUCKETS)
+
+def get_ollama_options(host, model_name, prompt, max_tokens, temperature, stop=None, seed=None):
+    """Runtime options for one request: defaults, then the model's profile, then the host's threads.
+    
+    num_ctx follows the prompt size in buckets. Ollama reloads a model whenever
+    num_ctx changes, so a host keeps the largest size it has loaded the model
+    with instead of shrinking for shorter prompts.
+    """
+    options = dict(OLLAMA_DEFAULT_OPTIONS)
+    options.update(get_ollama_model_profile(model_name))
+    options["num_predict"] = max_tokens
+    options["temperature"] = temperature
+    if stop:
+        options["stop"] = list(stop)
+    if seed is not None:
+        options["seed"] = seed
+    if host in OLLAMA_HOST_THREADS:
+        options["num_thread"] = OLLAMA_HOST_THREADS[host]
+    if OLLAMA_AUTO_CONTEXT and "num_ctx" not in options:
+        options["num_ctx"] = OLLAMA_ROUTER.context_size(host, model_name, get_context_bucket(estimate_tokens(prompt) + max_tokens))
+    return options
+
+def call_ollama_model(prompt, model_name, max_tokens=300, temperature=0.3, deadline=None, on_token=None, stop=None, seed=None,
+                      preferred_host=None):
+    """Call Ollama models on the least-loaded suitable host (preferred_host first while it is in rotation)"""
+    deadline = get_deadline(deadline)
+    
+    def read_stream(response, usage):
+        # Ollama streams one JSON object per line
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if "error" in chunk:
+                raise ProviderError(f"Ollama API error: {chunk['error']}")
+            yield chunk.get("response", "")
+            if chunk.get("done"):
+                usage["tokens"] = chunk.get("eval_count")
+                break
+    
+    def attempt(timeout):
+        # Each attempt picks a host again, so a retry can move to a healthier one
+        host = OLLAMA_ROUTER.acquire(model_name, preferred_host)
+        failed = False
+        payload = {
+            "model": model_name,
+            "prompt": prompt,
+            "stream": on_token is not None,
+            "options": get_ollama_options(host, model_name, prompt, max_tokens, temperature, stop, seed)
+        }
+        try:
+            timeout = THROUGHPUT.read_timeout(model_name, host, max_tokens, on_token is not None, timeout, deadline)
+            start = time.monotonic()
+            response = http_request("POST", f"{host}/api/generate", json_body=payload, timeout=timeout, stream=on_token is not None)
+            with response:
+                response.raise_for_status()
+                
+                if on_token is not None:
+                    usage = {}
+                    return collect_stream(THROUGHPUT.measure(read_stream(response, usage), model_name, host, start, usage),
+                                          on_token, "Ollama")
+                result = response.json()
+            text = result.get("response", "")
+            THROUGHPUT.record(model_name, host, count_reply_tokens(text, result.get("eval_count")), time.monotonic() - start)
+            return text.strip()
+        except Exception as e:
+            # Bad requests are not the host's fault; only connection trouble and server errors count
+            failed = classify_error(e)[0] != ERROR_FATAL
+            raise
+        finally:
+            OLLAMA_ROUTER.release(host, success=not failed, model_name=model_name)
+    
+    return call_with_retry(attempt, "Ollama", deadline)
+
+def get_huggingface_url(model_name):
+    """Build the Hugging Face endpoint URL for a model.
+    
+    HUGGINGFACE_BASE_URL may contain a {model} placeholder (hosted Inference API)
+    or point straight at a text-generation-inference server that serves one model.
+    """
+    base_url = HUGGINGFACE_BASE_URL.rstrip("/")
+    if "{model}" in base_url:
+        return base_url.format(model=model_name)
+    return base_url
+
+def call_huggingface_model(prompt, model_name, max_tokens=300, temperature=0.3, deadline=None, on_token=None, stop=None, seed=None):
+    """Call Hugging Face models (hosted Inference API or text-generation-inference)"""
+    deadline = get_deadline(deadline)
+    url = get_huggingface_url(model_name)
+    headers = {}
+    if HUGGINGFACE_API_KEY and HUGGINGFACE_API_KEY != "your-huggingface-api-key-here":
+        headers["Authorization"] = f"Bearer {HUGGINGFACE_API_KEY}"
+    payload = {
+        "inputs": prompt,
+        "parameters": {
+            "max_new_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": 0.9,
+            "do_sample": True,
+            "return_full_text": False  # Don't echo the prompt back in the response
+        },
+        "options": {
+            "wait_for_model": False  # Set for the retry once the model is known to be loading
+        },
+        "stream": on_token is not None
+    }
+    if stop:
+        payload["parameters"]["stop"] = list(stop)
+    if seed is not None:
+        payload["parameters"]["seed"] = seed
+    
+    def read_stream(response, usage):
+        for event in iter_sse_events(response):
+            if "error" in event:
+                raise ProviderError(f"Hugging Face API error: {event['error']}")
+            if event.get("details"):
+                # text-generation-inference puts the totals on the last token
+                usage["tokens"] = event["details"].get("generated_tokens")
+            token = event.get("token") or {}
+            if not token.get("special"):
+                yield token.get("text", "")
+    
+    def attempt(timeout):
+        if payload["options"]["wait_for_model"]:
+            # The server holds the connection while the cold model loads, so this one request gets the full budget
+            timeout = max(timeout, deadline - time.monotonic())
+        else:
+            # A warm model keeps the per-read timeout, so stalls are still caught
+            timeout = THROUGHPUT.read_timeout(model_name, url, max_tokens, on_token is not None, timeout, deadline)
+        start = time.monotonic()
+        response = http_request("POST", url, json_body=payload, headers=headers, timeout=timeout, stream=on_token is not None)
+        with response:
+            if response.status_code == 503 and HUGGINGFACE_WAIT_FOR_MODEL and not payload["options"]["wait_for_model"]:
+                payload["options"]["wait_for_model"] = True
+                raise ProviderError("Hugging Face model is loading; waiting for it", ERROR_TRANSIENT, retry_after=0.0)
+            response.raise_for_status()
+            
+            if on_token is not None:
+                usage = {}
+                return collect_stream(THROUGHPUT.measure(read_stream(response, usage), model_name, url, start, usage),
+                                      on_token, "Hugging Face")
+            
+            result = response.json()
+        # The Inference API returns a list, text-generation-inference a single object
+        if isinstance(result, list) and len(result) > 0:
+            result = result[0]
+        if isinstance(result, dict) and "generated_text" in result:
+            THROUGHPUT.record(model_name, url, count_reply_tokens(result["generated_text"], (result.get("details") or {}).get("generated_tokens")),
+                              time.monotonic() - start)
+            return result["generated_text"].strip()
+        if isinstance(result, dict) and "error" in result:
+            raise ProviderError(f"Hugging Face API error: {result['error']}")
+        raise ProviderError(f"Hugging Face API error: unexpected response: {str(result)[:200]}")
+    
+    return call_with_retry(attempt, "Hugging Face", deadline)
+
+class OutputMonitor:
+    """Watch streamed output and decide when generation should stop early.
+    
+    Checks, as each delta arrives, for configured stop sequences (for providers
+    that don't apply them natively), banned meta-text patterns such as titles or
+    "As a philosopher..." openings, and word n-gram repetition loops. Text is
+    only shown once no later check can cut before it, so what the user saw is
+    always a prefix of the text that is kept.
+    """
+
+    PATTERN_RESCAN = 80  # Characters re-scanned for banned patterns that span deltas
+
+    def __init__(self, stop_sequences=(), banned_patterns=(), ngram_size=6, max_repeats=3):
+        self.stop_sequences = [sequence for sequence in stop_sequences if sequence]
+        self.banned_patterns = [re.compile(pattern) for pattern in banned_patterns]
+        self.ngram_size = ngram_size
+        self.max_repeats = max_repeats
+        self.text = ""
+        self.stop_reason = None
+        self._emitted = 0
+        self._pattern_scan_start = 0
+        self._word_scan_start = 0
+        self._words = []  # (normalised word, start offset) for every complete word so far
+        self._ngram_counts = {}
+
+    def feed(self, delta):
+        """Add a delta; return the text that can now be shown to the user.
+        
+        Text that might be the start of a stop sequence, or that a banned pattern
+        or repetition loop could still start in, is held back until it is known
+        to be safe. After a stop is detected, stop_reason is set and
+        text holds the output to keep.
+        """
+        previous_length = len(self.text)
+        self.text += delta
+        
+        cut = self._find_stop_sequence(previous_length)
+        if cut is None:
+            cut = self._find_banned_pattern()
+        if cut is None:
+            cut = self._find_repetition()
+        
+        if cut is not None:
+            self.text = self.text[:cut]
+            safe_end = cut
+        else:
+            safe_end = min(len(self.text) - self._stop_sequence_overlap(), self._earliest_later_cut())
+        
+        visible = self.text[self._emitted:safe_end]
+        self._emitted = max(self._emitted, safe_end)
+        return visible
+
+    def flush(self):
+        """Return any held-back text once the stream has ended"""
+        visible = self.text[self._emitted:]
+        self._emitted = len(self.text)
+        return visible
+
+    def _stop_sequence_overlap(self):
+        """Length of the longest text suffix that is a prefix of a stop sequence"""
+        overlap = 0
+        for sequence in self.stop_sequences:
+            for length in range(min(len(sequence) - 1, len(self.text)), overlap, -1):
+                if self.text.endswith(sequence[:length]):
+                    overlap = length
+                    break
+        return overlap
+
+    def _earliest_later_cut(self):
+        """Smallest offset a banned pattern or repetition found by a later feed could cut at"""
+        earliest = len(self.text)
+        if self.banned_patterns:
+            earliest = min(earliest, len(self.text) - self.PATTERN_RESCAN)
+        # A later n-gram ends at a new word, so it starts at one of the last ngram_size - 1 words
+        if self.ngram_size <= 1:
+            earliest = min(earliest, self._word_scan_start)
+        elif len(self._words) >= self.ngram_size - 1:
+            earliest = min(earliest, self._words[-(self.ngram_size - 1)][1])
+        else:
+            earliest = 0
+        return max(0, earliest)
+
+    def _find_stop_sequence(self, previous_length):
+        longest = max((len(sequence) for sequence in self.stop_sequences), default=0)
+        search_from = max(0, previous_length - longest)
+        for sequence in self.stop_sequences:
+            position = self.text.find(sequence, search_from)
+            if position != -1:
+                self.stop_reason = f"stop sequence {sequence!r}"
+                return position
+        return None
+
+    def _find_banned_pattern(self):
+        # Re-scan a little before the new text so matches spanning deltas are caught
+        search_from = max(0, self._pattern_scan_start - self.PATTERN_RESCAN)
+        self._pattern_scan_start = len(self.text)
+        for pattern in self.banned_patterns:
+            match = pattern.search(self.text, search_from)
+            if match:
+                self.stop_reason = f"meta text {match.group(0).strip()!r}"
+                return match.start()
+        return None
+
+    def _find_repetition(self):
+        # Only words followed by whitespace are complete; the last one may still grow
+        scan_start = self._word_scan_start
+        for match in re.finditer(r"\S+(?=\s)", self.text[scan_start:]):
+            start = scan_start + match.start()
+            # Any whitespace ends a word (tabs too), so the next scan starts after it
+            self._word_scan_start = scan_start + match.end()
+            word = re.sub(r"\W+", "", match.group(0).lower())
+            self._words.append((word, start))
+            if len(self._words) < self.ngram_size:
+                continue
+            
+            ngram = tuple(word for word, _ in self._words[-self.ngram_size:])
+            count = self._ngram_counts.get(ngram, 0) + 1
+            self._ngram_counts[ngram] = count
+            if count >= self.max_repeats:
+                self.stop_reason = f"repetition loop ({' '.join(ngram)!r} repeated {count} times)"
+                return self._words[-self.ngram_size][1]
+        return None
+
+def create_output_monitor(writer_character=None, state=None):
+    """Build an OutputMonitor from the configured stop sequences and banned patterns"""
+    characters = (state or ENGINE_STATE).characters
+    banned_patterns = list(BANNED_OUTPUT_PATTERNS)
+    if writer_character and writer_character in characters:
+        # The character's name must not appear as a title or speaker label
+        name = re.escape(characters[writer_character]["name"])
+        banned_patterns.append(rf"(?m)^\W*{name}\W*(?::|$)")
+    return OutputMonitor(STOP_SEQUENCES, banned_patterns, REPETITION_NGRAM_SIZE, REPETITION_MAX_REPEATS)
+
+def build_prompt(prompt, style, custom_elements=None, writer_character=None, reference_materials=None, state=None):
+    """Assemble the full model prompt from the user's text and the session settings"""
+    state = state or ENGINE_STATE
+    instruction = state.styles.get(style.lower(), state.styles["essay"])
+    
+    # Build writer character description if provided - but don't mention the character name
+    character_description = ""
+    if writer_character and writer_character in state.characters:
+        char = state.characters[writer_character]
+        character_description = f"\n\nWrite with this voice and style:\n"
+        character_description += f"Core essence: {char['personality']}\n"
+        character_description += f"Areas of fascination: {char['interests']}\n"
+        character_description += f"Writing approach: {char['style']}\n"
+        character_description += f"Intellectual lineage: {char['influences']}\n"
+        character_description += f"\nCREATIVE EXPRESSION GUIDE:\n"
+        character_description += f"- Express these interests through story, metaphor, and imagery - not direct statements\n"
+        character_description += f"- Let the character's worldview emerge through how they see and describe the world\n"
+        character_description += f"- Use the character's unique perspective to color the narrative, not to describe themselves\n"
+        character_description += f"\nCRITICAL STYLE INSTRUCTIONS:\n"
+        character_description += f"- Express the character's essence through creative, varied language - avoid repeating the exact words from the description\n"
+        character_description += f"- Use synonyms, metaphors, and different phrasings to convey the same concepts\n"
+        character_description += f"- Be experimental and inventive in how you express the character's worldview\n"
+        character_description += f"- Draw from the influences creatively rather than mentioning them directly\n"
+        character_description += f"- Vary your vocabulary and sentence structures to avoid repetition\n"
+        character_description += f"- Avoid listing interests or traits - embody them through the narrative instead\n"
+        character_description += f"- Don't repeat character description keywords - find fresh ways to express the same ideas\n"
+        character_description += f"- Instead of saying 'cyborg theory' or 'multispecies storytelling', explore these concepts through narrative and metaphor\n"
+        character_description += f"- Transform abstract interests into concrete, vivid imagery and experiences\n"
+        character_description += f"- IMPORTANT: Use this voice/style to continue the user's narrative, NOT to describe the character or their interests\n"
+        character_description += f"- DO NOT start sentences with 'As a...' or 'The philosopher-scientist...' or similar character descriptions\n"
+        character_description += f"- DO NOT list character traits or interests - embody them through the narrative continuation\n"
+        character_description += f"- AVOID DIRECT REPETITION: Never use exact phrases from character interests like 'ancestral technologies,' 'ceremonial time,' 'land-body reciprocity,' 'resistance of stories,' etc.\n"
+        character_description += f"- FIND CREATIVE ALTERNATIVES: Instead of 'ancestral technologies' say 'old ways of knowing' or 'ancient wisdom'\n"
+        character_description += f"- USE METAPHORS: Transform concepts into images, not direct statements\n"
+        character_description += f"- Continue the narrative flow naturally. Do not include any titles, character names, or meta-references in your response. Write directly in this voice without mentioning who is writing."
+    
+    # Build custom elements description if provided
+    elements_description = ""
+    if custom_elements:
+        elements_description = "\n\nIncorporate these elements naturally:\n"
+        for element in custom_elements:
+            if element in state.elements:
+                elements_description += f"- {element}: {state.elements[element]}\n"
+    
+    # Build reference materials context if provided
+    reference_context = ""
+    if reference_materials:
+        reference_context = create_reference_context(reference_materials, prompt)
+    
+    # Create a continuation-focused prompt
+    continuation_instruction = "\n\nCRITICAL NARRATIVE CONTINUATION RULES:\n"
+    continuation_instruction += "- The user's prompt IS the story to continue - do NOT ignore it\n"
+    continuation_instruction += "- Continue directly from the user's text, not from character descriptions\n"
+    continuation_instruction += "- Do NOT start new stories or describe character traits\n"
+    continuation_instruction += "- Do NOT use phrases like 'As a...' or 'The philosopher-scientist...'\n"
+    continuation_instruction += "- Simply continue the narrative thread the user provided\n"
+    continuation_instruction += "- The character voice should be used to CONTINUE the user's story, not to describe the character\n"
+    
+    # Add instruction to avoid copying reference material
+    originality_instruction = "\n\nCRITICAL: Write completely original content. Do not copy, paraphrase, or directly reference any content from reference materials. Use reference materials only for style inspiration. Create your own unique continuation based on the user's prompt."
+    
+    # Make the prompt focus on continuation rather than complete story creation
+    # Put the user's prompt FIRST to prioritize it
+    return f"{instruction}{continuation_instruction}{originality_instruction}\n\nUSER'S NARRATIVE TO CONTINUE: {prompt}\n\n{character_description}{elements_description}{reference_context}\n\nFINAL INSTRUCTION: Continue the user's narrative above. Do NOT write about the character - write the continuation of the user's story using the character's voice and style."
+
+class Flight:
+    """One generation shared by every request with the same key"""
+
+    def __init__(self):
+        self.deltas = []
+        self.result = None
+        self.error = None
+        self.finished = False
+        self.subscribers = 0
+        self.condition = threading.Condition()
+
+    def emit(self, delta):
+        with self.condition:
+            if not self.subscribers:
+                raise StopGeneration("cancelled", "")  # Everyone has stopped listening
+            self.deltas.append(delta)
+            self.condition.notify_all()
+
+    def finish(self, result=None, error=None):
+        with self.condition:
+            self.result = result
+            self.error = error
+            self.finished = True
+            self.condition.notify_all()
+
+    def leave(self):
+        with self.condition:
+            self.subscribers -= 1
+
+    def follow(self, on_token=None):
+        """Deliver streamed and live deltas to on_token, then return a copy of the shared result"""
+        delivered = 0
+        try:
+            while True:
+                with self.condition:
+                    while delivered == len(self.deltas) and not self.finished:
+                        self.condition.wait(0.1)
+                    new_deltas = self.deltas[delivered:]
+                    done = self.finished
+                for delta in new_deltas:
+                    if on_token:
+                        on_token(delta)
+                    delivered += 1
+                if done and delivered == len(self.deltas):
+                    break
+        except StopGeneration as e:
+            self.leave()
+            return Continuation(e.text.strip(), e.reason)
+        except KeyboardInterrupt:
+            self.leave()
+            raise GenerationCancelled("".join(self.deltas[:delivered]).strip()) from None
+        except BaseException:
+            self.leave()
+            raise
+        
+        if self.error:
+            # Each subscriber raises its own exception object, so tracebacks from different threads don't pile up on one
+            try:
+                error = copy.copy(self.error)
+            except Exception:
+                error = ProviderError(str(self.error), *classify_error(self.error))
+            raise error.with_traceback(None) from self.error
+        return Continuation(self.result, getattr(self.result, "stop_reason", None))
+
+class SingleFlight:
+    """Coalesce identical requests that are in flight at the same time.
+    
+    The first request for a key starts the generation in a worker thread and
+    later ones with the same key subscribe to it until it finishes. Each
+    subscriber gets the text streamed so far, then the rest live, and the same
+    result or error. A subscriber that stops (Ctrl-C, or its on_token raising
+    StopGeneration) only detaches; the model call is cancelled once nobody is
+    listening.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def run(self, key, generate, on_token=None):
+        """Return generate(emit)'s result, sharing it with concurrent calls for the same key"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+            else:
+                self.coalesced += 1
+            with flight.condition:
+                flight.subscribers += 1
+        if leader:
+            threading.Thread(target=self._fly, args=(key, flight, generate), daemon=True).start()
+        return flight.follow(on_token)
+
+    def _fly(self, key, flight, generate):
+        result = error = None
+        try:
+            result = generate(flight.emit)
+        except Exception as e:
+            error = e
+        finally:
+            # Requests arriving from now on start a new generation
+            with self._lock:
+                del self._flights[key]
+            flight.finish(result, error)
+
+SINGLE_FLIGHT_GROUP = SingleFlight()
+
+def co_write(prompt, style, custom_elements=None, writer_character=None, model_name=DEFAULT_MODEL, reference_materials=None,
+             deadline=None, on_token=None, max_tokens=300, temperature=0.3, seed=None, state=None, preferred_host=None):
+    # Every setting this request uses comes from one snapshot, even if a reload happens meanwhile
+    state = state or ENGINE_STATE
+    full_prompt = build_prompt(prompt, style, custom_elements, writer_character, reference_materials, state)
+    
+    # Find the model provider
+    model_provider = get_model_provider(model_name, state)
+    if not model_provider:
+        raise Exception(f"Model {model_name} not found")
+    
+    call_model = {
+        "openai": call_openai_model,
+        "ollama": call_ollama_model,
+        "huggingface": call_huggingface_model,
+        "local": call_local_model
+    }.get(model_provider)
+    if not call_model:
+        raise Exception(f"Unknown provider: {model_provider}")
+    provider_options = {}
+    if model_provider == "openai":
+        provider_options["api_key"] = state.openai_api_key
+    elif model_provider == "ollama" and preferred_host:
+        provider_options["preferred_host"] = preferred_host
+    
+    # Call the appropriate API based on provider; deadline bounds all retries
+    deadline = get_deadline(deadline)
+    max_tokens = THROUGHPUT.max_tokens_for(model_name, max_tokens, LATENCY_TARGET)
+    
+    def generate(on_token):
+        # Early stopping needs the output as it is generated, so stream even without on_token
+        monitor = create_output_monitor(writer_character, state) if EARLY_STOP else None
+        stream_callback = on_token
+        if monitor:
+            def stream_callback(delta):
+                visible = monitor.feed(delta)
+                if visible and on_token:
+                    on_token(visible)
+                if monitor.stop_reason:
+                    raise StopGeneration(monitor.stop_reason, monitor.text)
+        
+        continuation = call_model(full_prompt, model_name, max_tokens=max_tokens, temperature=temperature, deadline=deadline,
+                                  on_token=stream_callback, stop=STOP_SEQUENCES, seed=seed, **provider_options)
+        if isinstance(continuation, Continuation):
+            return continuation
+        if monitor and on_token:
+            remaining_text = monitor.flush()
+            if remaining_text:
+                on_token(remaining_text)
+        return Continuation(continuation)
+    
+    # Only deterministic requests are shared: unseeded sampling must give each caller its own sample
+    if not SINGLE_FLIGHT or (seed is None and temperature != 0):
+        return generate(on_token)
+    # The key covers everything that shapes the output; the settings snapshot stands in for characters and the API key
+    key = hashlib.sha256(json.dumps([model_provider, model_name, full_prompt, max_tokens, temperature, seed,
+                                     STOP_SEQUENCES, EARLY_STOP, state.version]).encode("utf-8")).hexdigest()
+    return SINGLE_FLIGHT_GROUP.run(key, generate, on_token)
+
+def word_ngrams(text, size=3):
+    """Return the list of lowercase word n-grams in text"""
+    words = re.findall(r"[\w'-]+", text.lower())
+    return [tuple(words[i:i + size]) for i in range(len(words) - size + 1)]
+
+def score_continuation(continuation, writer_character=None, max_tokens=300, state=None):
+    """Cheap local quality score for ranking samples; higher is better.
+    
+    Rewards reaching a reasonable length and penalises repeated phrases, reuse
+    of the character description wording co_write asks the model to avoid,
+    and generations that were stopped early for meta text or loops.
+    """
+    text = str(continuation)
+    if not text.strip():
+        return float("-inf")
+    
+    # Roughly 0.75 words per token; half the token budget is a full-length answer
+    word_count = len(text.split())
+    length_score = min(1.0, word_count / max(1.0, max_tokens * 0.75 * 0.5))
+    
+    ngrams = word_ngrams(text)
+    repetition = 1 - len(set(ngrams)) / len(ngrams) if ngrams else 0.0
+    
+    description_overlap = 0.0
+    characters = (state or ENGINE_STATE).characters
+    if writer_character and writer_character in characters and ngrams:
+        char = characters[writer_character]
+        description = " ".join(char.get(field, "") for field in ("personality", "interests", "style", "influences"))
+        description_ngrams = set(word_ngrams(description))
+        description_overlap = sum(1 for ngram in ngrams if ngram in description_ngrams) / len(ngrams)
+    
+    stop_penalty = 1.0 if getattr(continuation, "stop_reason", None) else 0.0
+    return length_score - 1.5 * repetition - 3.0 * description_overlap - stop_penalty
+
+def co_write_best_of(n, prompt, style, custom_elements=None, writer_character=None, model_name=DEFAULT_MODEL,
+                     reference_materials=None, deadline=None, max_tokens=300, temperature=0.3, cancel_event=None):
+    """Generate n samples concurrently and return the best one by score_continuation.
+    
+    Samples use different seeds and slightly spread temperatures. The returned
+    Continuation has an `alternatives` list of all successful samples, best first.
+    Ctrl-C, or setting cancel_event from another thread, stops every in-flight sample.
+    """
+    deadline = get_deadline(deadline)
+    state = ENGINE_STATE  # All samples and their scoring use the same settings
+    cancelled = cancel_event or threading.Event()
+    
+    def check_cancelled(delta):
+        if cancelled.is_set():
+            raise StopGeneration("cancelled", "")
+    
+    def sample(index):
+        sample_temperature = min(1.2, temperature + 0.15 * index)
+        return co_write(prompt, style, custom_elements, writer_character, model_name, reference_materials,
+                        deadline=deadline, on_token=check_cancelled, max_tokens=max_tokens,
+                        temperature=sample_temperature, seed=random.randrange(2 ** 31), state=state)
+    
+    # A local batching server gets no more samples at once than it decodes together
+    executor = ThreadPoolExecutor(max_workers=recommended_concurrency(model_name, n))
+    futures = [executor.submit(sample, index) for index in range(n)]
+    try:
+        samples = []
+        errors = []
+        for future in futures:
+            try:
+                samples.append(future.result())
+            except Exception as e:
+                errors.append(e)
+    except KeyboardInterrupt:
+        cancelled.set()
+        raise GenerationCancelled() from None
+    finally:
+        executor.shutdown(wait=False)
+    
+    if cancelled.is_set():
+        raise GenerationCancelled()
+    if not samples:
+        raise errors[0]
+    
+    ranked = sorted(samples, key=lambda text: score_continuation(text, writer_character, max_tokens, state), reverse=True)
+    best = ranked[0]
+    best.alternatives = ranked
+    return best
+
+def build_continue_prompt(previous_output):
+    """Prompt that asks for the next passage after previous_output, using only its tail"""
+    tail = str(previous_output)[-CONTINUE_TAIL_CHARS:]
+    return tail.strip()
+
+class SpeculativePrefetch:
+    """Run a likely next generation in the background so it is ready when asked for.
+    
+    generate(on_token) starts the generation; tokens are buffered as they arrive.
+    attach() replays the buffer and follows the rest live, while cancel() stops
+    the request and reports roughly how many tokens were wasted.
+    """
+
+    def __init__(self, key, generate):
+        self.key = key
+        self.tokens = []
+        self.result = None
+        self.error = None
+        self.finished = False
+        self._cancelled = threading.Event()
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, args=(generate,), daemon=True)
+        self._thread.start()
+
+    def _run(self, generate):
+        try:
+            self.result = generate(self._on_token)
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._condition:
+                self.finished = True
+                self._condition.notify_all()
+
+    def _on_token(self, delta):
+        if self._cancelled.is_set():
+            raise StopGeneration("speculation cancelled", "")
+        with self._condition:
+            self.tokens.append(delta)
+            self._condition.notify_all()
+
+    def attach(self, on_token=None):
+        """Deliver buffered and live tokens to on_token, then return the finished continuation"""
+        delivered = 0
+        try:
+            while True:
+                with self._condition:
+                    while delivered == len(self.tokens) and not self.finished:
+                        self._condition.wait(0.1)
+                    new_tokens = self.tokens[delivered:]
+                    done = self.finished
+                delivered += len(new_tokens)
+                if on_token:
+                    for delta in new_tokens:
+                        on_token(delta)
+                if done and delivered == len(self.tokens):
+                    break
+        except KeyboardInterrupt:
+            self.cancel()
+            raise GenerationCancelled("".join(self.tokens[:delivered]).strip()) from None
+        
+        if self.error:
+            raise self.error
+        return self.result
+
+    def cancel(self):
+        """Stop the speculative request; return the estimated number of tokens generated for nothing"""
+        self._cancelled.set()
+        return count_reply_tokens("".join(self.tokens))
+
+class BackgroundGenerator:
+    """Run queued generation jobs one after another on a worker thread.
+    
+    submit() returns at once, so the console keeps reading commands while the
+    model works, and jobs run in the order they were submitted. A job is a dict
+    of the settings it was submitted with; cancel() sets the running job's
+    "cancelled" event, which its token callback turns into CancelRequested.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.pending = []
+        self.current = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def busy(self):
+        return self.current is not None or bool(self.pending)
+
+    def submit(self, job):
+        """Queue a job; return how many jobs are ahead of it"""
+        job["cancelled"] = threading.Event()
+        with self._condition:
+            ahead = len(self.pending) + (self.current is not None)
+            self.pending.append(job)
+            self._condition.notify_all()
+        return ahead
+
+    def cancel(self, drop_pending=False):
+        """Stop the running job (and with drop_pending the queued ones); return (running job, jobs dropped)"""
+        with self._condition:
+            dropped = len(self.pending) if drop_pending else 0
+            if drop_pending:
+                self.pending.clear()
+            current = self.current
+        if current:
+            current["cancelled"].set()
+        return current, dropped
+
+    def close(self, timeout=5):
+        """Cancel everything and wait up to `timeout` seconds; returns False if a job is still running"""
+        self.cancel(drop_pending=True)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+        return not self._thread.is_alive()
+
+    @staticmethod
+    def check_cancelled(job):
+        if job["cancelled"].is_set():
+            raise CancelRequested()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self.pending and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                self.current = self.pending.pop(0)
+            try:
+                self.handler(self.current)
+            except CancelRequested:
+                print("\n⏹ Generation cancelled.")
+            except Exception as e:
+                print(f"\n❌ Error: {e}")
+            finally:
+                with self._condition:
+                    self.current = None
+
+class SessionJournal:
+    """Append-only log of a session's settings and outputs, one compact JSON object per line.
+    
+    Each record is flushed to the operating system as it is written, so
+    quitting or crashing loses nothing. fsync runs on a background thread at
+    most every fsync_interval seconds, so a burst of records shares one disk
+    sync. replay() rebuilds the session from the file.
+    """
+
+    def __init__(self, path, fsync_interval=JOURNAL_FSYNC_INTERVAL):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.file = open(path, "a", encoding="utf-8")
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._sync_loop, daemon=True)
+        self._thread.start()
+
+    def append(self, record_type, **fields):
+        fields["type"] = record_type
+        fields["time"] = round(time.time(), 3)
+        line = json.dumps(fields, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            if self.file.closed:
+                return  # A generation still finishing after quit
+            self.file.write(line + "\n")
+            self.file.flush()
+            self._dirty = True
+
+    def sync(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            file_descriptor = self.file.fileno()
+        # Appends carry on while the disk catches up
+        os.fsync(file_descriptor)
+
+    def _sync_loop(self):
+        while not self._closed.wait(self.fsync_interval):
+            self.sync()
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.sync()
+        with self._lock:
+            self.file.close()
+
+    @staticmethod
+    def replay(path):
+        """Latest settings, last output and turn count recorded in a journal (None if there is none)"""
+        if not os.path.exists(path):
+            return None
+        session = {"settings": {}, "last_continuation": "", "turns": 0}
+        with open(path, "r", encoding="utf-8") as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # A record torn by a crash
+                if record["type"] == "settings":
+                    session["settings"] = record["settings"]
+                elif record["type"] == "turn":
+                    session["turns"] += 1
+                    session["last_continuation"] = record["text"]
+                elif record["type"] == "selected":
+                    session["last_continuation"] = record["text"]
+        return session
+
+def open_session_journal(resume=False):
+    """Journal for this session; a new session keeps the previous journal as <file>.1"""
+    if not resume and os.path.exists(SESSION_JOURNAL_FILE):
+        os.replace(SESSION_JOURNAL_FILE, SESSION_JOURNAL_FILE + ".1")
+    return SessionJournal(SESSION_JOURNAL_FILE)
+
+def count_words_in_file(path, block_size=65536):
+    """Count whitespace-separated words in a file without loading it into memory"""
+    words = 0
+    previous_ended_in_word = False
+    with open(path, 'r', encoding='utf-8', errors='ignore') as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                break
+            words += len(block.split())
+            # A word split across two blocks was counted twice
+            if previous_ended_in_word and not block[0].isspace():
+                words -= 1
+            previous_ended_in_word = not block[-1].isspace()
+    return words
+
+def read_file_tail(path, chars):
+    """Return roughly the last `chars` characters of a text file"""
+    with open(path, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        size = file.tell()
+        file.seek(max(0, size - chars * 4))  # UTF-8 uses at most 4 bytes per character
+        return file.read().decode('utf-8', errors='ignore')[-chars:]
+
+def write_long_form(seed_prompt, target_words, output_path, style, custom_elements=None, writer_character=None,
+                    model_name=DEFAULT_MODEL, reference_materials=None, on_token=None):
+    """Generate a long piece by repeatedly continuing its own tail, appending each chunk to output_path.
+    
+    Only the word count and a bounded tail of the text are kept in memory. If
+    output_path already has text the run resumes from it and seed_prompt is
+    only used for an empty file. Returns the total number of words written.
+    """
+    words_written = 0
+    tail = ""
+    if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
+        words_written = count_words_in_file(output_path)
+        tail = read_file_tail(output_path, CONTINUE_TAIL_CHARS)
+        print(f"Resuming {output_path} at {words_written:,} words")
+    
+    empty_chunks = 0
+    separator_pending = False
+    with open(output_path, 'a', encoding='utf-8') as output_file:
+        def show_token(delta):
+            nonlocal separator_pending
+            if separator_pending:
+                delta = "\n\n" + delta.lstrip()
+                separator_pending = False
+            on_token(delta)
+        
+        while words_written < target_words:
+            prompt = build_continue_prompt(tail) if tail else seed_prompt
+            separator_pending = bool(tail)
+            
+            chunk = co_write(prompt, style, custom_elements, writer_character, model_name, reference_materials,
+                             on_token=show_token if on_token else None, max_tokens=LONG_FORM_CHUNK_TOKENS)
+            
+            chunk_words = len(chunk.split())
+            if chunk_words == 0:
+                empty_chunks += 1
+                if empty_chunks >= 2:
+                    print("\nThe model stopped producing text; ending the long-form run early.")
+                    break
+                continue
+            empty_chunks = 0
+            
+            # The file gets the chunk co_write kept, not the streamed deltas, which can include text it cut
+            output_file.write(("\n\n" if tail else "") + str(chunk))
+            output_file.flush()
+            words_written += chunk_words
+            tail = (tail + "\n\n" + chunk)[-CONTINUE_TAIL_CHARS:]
+            print(f"\n[{words_written:,}/{target_words:,} words]")
+    
+    return words_written
+
+class SessionProfiler:
+    """cProfile and tracemalloc around the expensive entry points of a session.
+    
+    While enabled, the module-level functions listed in PROFILED_FUNCTIONS are
+    replaced by wrappers; disabling puts the originals back, so there is no
+    overhead at all when profiling is off. Every wrapped call is timed. One
+    outermost call at a time also runs under cProfile and has its memory peak
+    measured: Python 3.12+ allows only one active profiler per process, and
+    the tracemalloc peak is process-wide, so calls that overlap it (best-of
+    and speculative workers) are timed only.
+    """
+    
+    PROFILED_FUNCTIONS = ["load_reference_materials", "build_prompt", "co_write",
+                          "call_openai_model", "call_ollama_model", "call_huggingface_model", "call_local_model"]
+    
+    def __init__(self, report_dir=PROFILE_REPORT_DIR):
+        self.report_dir = report_dir
+        self.originals = {}
+        self.lock = threading.Lock()
+        self.measuring = threading.Lock()  # Held by the one call being profiled
+        self.local = threading.local()
+        self.stats = None
+        self.calls = {}  # Function name -> [calls, total seconds, largest peak bytes]
+        self.session_peak = 0  # Traced memory peak before the last reset_peak()
+        self.started_at = None
+        self.started_tracemalloc = False
+    
+    @property
+    def enabled(self):
+        return bool(self.originals)
+    
+    def enable(self):
+        if self.enabled:
+            return
+        self.stats = None
+        self.calls = {}
+        self.session_peak = 0
+        self.started_at = time.time()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+            self.started_tracemalloc = True
+        module_globals = globals()
+        for name in self.PROFILED_FUNCTIONS:
+            self.originals[name] = module_globals[name]
+            module_globals[name] = self.wrap(name, module_globals[name])
+    
+    def disable(self):
+        """Restore the original functions and return the path of the session report"""
+        if not self.enabled:
+            return None
+        module_globals = globals()
+        for name, function in self.originals.items():
+            module_globals[name] = function
+        self.originals = {}
+        report_path = self.write_report()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+            self.started_tracemalloc = False
+        return report_path
+    
+    def wrap(self, name, function):
+        def profiled(*args, **kwargs):
+            # The first outermost call to take self.measuring is profiled, with its nested wrapped calls
+            owner = False
+            profile = None
+            if not getattr(self.local, "measuring", False) and self.measuring.acquire(blocking=False):
+                owner = True
+                self.local.measuring = True
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError:
+                    profile = None  # Another profiling tool (such as a debugger) is active
+                if hasattr(tracemalloc, "reset_peak"):  # Python 3.9+; older versions get no peaks
+                    with self.lock:
+                        self.session_peak = max(self.session_peak, tracemalloc.get_traced_memory()[1])
+                    tracemalloc.reset_peak()
+            measured = getattr(self.local, "measuring", False) and hasattr(tracemalloc, "reset_peak")
+            start_memory = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                peak = max(0, tracemalloc.get_traced_memory()[1] - start_memory) if measured else 0
+                if owner:
+                    if profile:
+                        profile.disable()
+                    self.local.measuring = False
+                    self.measuring.release()
+                with self.lock:
+                    calls = self.calls.setdefault(name, [0, 0.0, 0])
+                    calls[0] += 1
+                    calls[1] += elapsed
+                    calls[2] = max(calls[2], peak)
+                    if profile:
+                        if self.stats is None:
+                            self.stats = pstats.Stats(profile)
+                        else:
+                            self.stats.add(profile)
+        profiled.__name__ = function.__name__
+        profiled.__doc__ = function.__doc__
+        return profiled
+    
+    def write_report(self):
+        os.makedirs(self.report_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started_at))
+        report_path = os.path.join(self.report_dir, f"profile-{stamp}.txt")
+        
+        lines = [f"Profile of session started {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started_at))}",
+                 f"Duration: {time.time() - self.started_at:.1f}s", "",
+                 "WRAPPED CALLS", f"{'function':<28}{'calls':>7}{'total s':>10}{'mean s':>10}{'peak KiB':>11}"]
+        for name in self.PROFILED_FUNCTIONS:
+            if name in self.calls:
+                count, total, peak = self.calls[name]
+                lines.append(f"{name:<28}{count:>7}{total:>10.3f}{total / count:>10.3f}{peak / 1024:>11.1f}")
+        
+        if self.calls:
+            lines.append("(peak KiB covers profiled calls only; overlapping calls are timed but not measured)")
+        session_peak = max(self.session_peak, tracemalloc.get_traced_memory()[1])
+        lines += ["", f"PEAK TRACED MEMORY: {session_peak / 1024:.1f} KiB", "",
+                  f"TOP {PROFILE_TOP_ALLOCATIONS} ALLOCATION SITES STILL HELD WHEN PROFILING STOPPED (not at the peak)"]
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, pstats.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")
+        ])
+        for statistic in snapshot.statistics("lineno")[:PROFILE_TOP_ALLOCATIONS]:
+            frame = statistic.traceback[0]
+            lines.append(f"{statistic.size / 1024:>10.1f} KiB {statistic.count:>7} blocks  {frame.filename}:{frame.lineno}")
+        
+        lines += ["", f"TOP {PROFILE_TOP_FUNCTIONS} FUNCTIONS BY CUMULATIVE TIME"]
+        if self.stats is not None:
+            output = io.StringIO()
+            self.stats.stream = output
+            self.stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+            lines.append(output.getvalue())
+            # Raw stats for snakeviz, gprof2dot or pstats
+            self.stats.dump_stats(report_path[:-len(".txt")] + ".prof")
+        else:
+            lines.append("(no profiled calls)")
+        
+        with open(report_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        return report_path
+
+PROFILER = SessionProfiler()
+
+def get_available_ollama_models():
+    """Get list of models installed on any reachable Ollama host"""
+    models = OLLAMA_ROUTER.available_models()
+    if not models:
+        print(f"Warning: Could not fetch Ollama models from {', '.join(OLLAMA_ROUTER.hosts)}")
+    return sorted(model for model in models if ":" not in model)
+
+def list_available_models():
+    """List all available models grouped by provider with numbers"""
+    print("\n" + "="*60)
+    print("AVAILABLE MODELS")
+    print("="*60)
+    
+    all_models = {}
+    model_counter = 1
+    
+    # Get actually installed Ollama models
+    installed_ollama_models = get_available_ollama_models()
+    if LOCAL_OPENAI_BASE_URL:
+        register_local_server_models()
+    
+    for provider, models in ENGINE_STATE.models.items():
+        if not models:
+            continue
+        print(f"\n{provider.upper()} MODELS:")
+        print("-" * 30)
+        for model_name, model_info in models.items():
+            # For Ollama models, only show if actually installed
+            if provider == "ollama" and model_name not in installed_ollama_models:
+                continue
+                
+            key_required = "🔑" if model_info["requires_key"] else "✅"
+            print(f"{model_counter:2d}. {key_required} {model_name}")
+            print(f"     {model_info['description']}")
+            all_models[model_counter] = model_name
             model_counter += 1
         print()
     
@@ -763,20 +3470,97 @@ def get_character_by_number(all_characters, user_input):
         # If not a number, treat as character name/key
         return user_input
 
+class LibraryMenu:
+    """Numbered, paginated listing of a character or element library.
+    
+    Numbers follow the file order and are resolved by position, so picking an
+    entry never walks the library, and only the entries on screen are
+    decoded. Searches go through a sorted index of lowercased keys and display
+    names, built on the first search.
+    """
+    
+    def __init__(self, library, describe):
+        self.library = library
+        self.describe = describe
+        if isinstance(library, CompiledLibrary):
+            self.keys, self.labels = library.names, library.labels
+        else:
+            self.keys = list(library)
+            self.labels = [value.get("name", key) if isinstance(value, Mapping) else key for key, value in library.items()]
+        self.next_position = 0
+        self.prefix_index = None
+    
+    def __contains__(self, number):
+        return isinstance(number, int) and 1 <= number <= len(self.keys)
+    
+    def __getitem__(self, number):
+        if number not in self:
+            raise KeyError(number)
+        return self.keys[number - 1]
+    
+    def show(self, positions):
+        for position in positions:
+            print(f"{position + 1:2d}. {self.labels[position]}")
+            print(f"     {self.describe(self.library[self.keys[position]])}")
+    
+    def show_page(self):
+        """Print the next MENU_PAGE_SIZE entries; returns False once everything was shown"""
+        if self.next_position >= len(self.keys):
+            return False
+        end = min(self.next_position + MENU_PAGE_SIZE, len(self.keys))
+        self.show(range(self.next_position, end))
+        self.next_position = end
+        if end < len(self.keys):
+            print(f"   ... {len(self.keys) - end:,} more of {len(self.keys):,}. "
+                  "Type 'more' for the next page or '/text' to search by name.")
+        return True
+    
+    def search(self, text):
+        """Positions of entries whose key or display name starts with text, or failing that contains it"""
+        text = text.lower()
+        if self.prefix_index is None:
+            self.prefix_index = sorted({(name.lower(), position)
+                                        for position, names in enumerate(zip(self.keys, self.labels)) for name in names})
+        matches = set()
+        start = bisect_left(self.prefix_index, (text, -1))
+        for name, position in self.prefix_index[start:]:
+            if not name.startswith(text):
+                break
+            matches.add(position)
+        if not matches:
+            matches = {position for position, (key, label) in enumerate(zip(self.keys, self.labels))
+                       if text in key.lower() or text in label.lower()}
+        return sorted(matches)
+    
+    def show_search(self, text):
+        matches = self.search(text)
+        if not matches:
+            print(f"Nothing matches '{text}'.")
+            return
+        self.show(matches[:MENU_PAGE_SIZE])
+        if len(matches) > MENU_PAGE_SIZE:
+            print(f"   ... {len(matches) - MENU_PAGE_SIZE:,} more matches; type a longer search.")
+
+def read_menu_choice(menu):
+    """Read a menu answer, handling 'more' and '/text' searches in between"""
+    while True:
+        choice = input().strip()
+        if choice.lower() == "more":
+            if not menu.show_page():
+                print("That is the whole list.")
+        elif choice.startswith("/") and choice[1:].strip():
+            menu.show_search(choice[1:].strip())
+        else:
+            return choice
+
 def list_available_characters():
-    """List all available characters with numbers"""
+    """List available characters with numbers, one page at a time"""
     print("\n" + "="*60)
     print("AVAILABLE WRITER CHARACTERS")
     print("="*60)
     
-    all_characters = {}
-    character_counter = 1
-    
-    for key, char in WRITER_CHARACTERS.items():
-        print(f"{character_counter:2d}. {char['name']}")
-        print(f"     {char['personality'][:80]}...")
-        all_characters[character_counter] = key
-        character_counter += 1
+    all_characters = LibraryMenu(WRITER_CHARACTERS, lambda char: f"{char.get('personality', '')[:80]}...")
+    all_characters.show_page()
     
     print()
     return all_characters
@@ -826,21 +3610,15 @@ def list_available_styles():
     return all_styles
 
 def list_available_custom_elements():
-    """List all available custom elements with numbers"""
+    """List available custom elements with numbers, one page at a time"""
     print("\n" + "="*60)
     print("AVAILABLE CUSTOM ELEMENTS")
     print("="*60)
     print("Add these to your world-building (comma-separated):")
     print()
     
-    all_elements = {}
-    element_counter = 1
-    
-    for key, description in CUSTOM_ELEMENTS.items():
-        print(f"{element_counter:2d}. {key}")
-        print(f"     {description}")
-        all_elements[element_counter] = key
-        element_counter += 1
+    all_elements = LibraryMenu(CUSTOM_ELEMENTS, lambda description: description)
+    all_elements.show_page()
     
     print()
     return all_elements
@@ -913,13 +3691,12 @@ def get_openai_api_key():
         # Test the API key
         print("Testing API key...")
         try:
-            test_client = openai.OpenAI(api_key=api_key)
-            # Try a simple test call
-            test_response = test_client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[{"role": "user", "content": "Hello"}],
-                max_tokens=5
-            )
+            # Listing models costs nothing and goes through the same transport (and base URL) as generation
+            response = http_request("GET", f"{OPENAI_BASE_URL.rstrip('/')}/models",
+                                    headers={"Authorization": f"Bearer {api_key}"}, timeout=10)
+            if response.status_code in (401, 403):
+                raise ProviderError(f"the key was rejected (HTTP {response.status_code})")
+            response.raise_for_status()
             print("✅ API key is valid!")
             
             # Save to config.py
@@ -952,7 +3729,16 @@ DEFAULT_CHARACTER = "cyra"
 # PREFERRED_MODELS = ["neural-chat", "mistral", "llama2"]  # Order of preference for local models
 """
         
-        with open("config.py", "w") as f:
+        # Keep the rest of an existing config.py (host lists, tuning) and only replace the key
+        if os.path.exists("config.py"):
+            with open("config.py", "r", encoding="utf-8") as f:
+                existing_content = f.read()
+            key_line = f'OPENAI_API_KEY = "{api_key}"  # Get from https://platform.openai.com/api-keys'
+            updated_content, replaced = re.subn(r"(?m)^OPENAI_API_KEY\s*=.*$", lambda match: key_line, existing_content)
+            if replaced:
+                config_content = updated_content
+        
+        with open("config.py", "w", encoding="utf-8") as f:
             f.write(config_content)
         
         print("✅ API key saved to config.py")
@@ -963,42 +3749,280 @@ DEFAULT_CHARACTER = "cyra"
 
 def configure_openai_model():
     """Configure OpenAI API key when user selects an OpenAI model"""
-    global OPENAI_API_KEY
-    
     api_key = get_openai_api_key()
     if api_key:
-        OPENAI_API_KEY = api_key
+        update_engine_state(openai_api_key=api_key)
         return True
     else:
         return False
 
 def reload_characters_and_elements():
     """Reload characters and custom elements from external files"""
-    global WRITER_CHARACTERS, CUSTOM_ELEMENTS
-    
     print("\n" + "="*30)
     print("RELOADING CHARACTERS AND ELEMENTS")
     print("="*30)
     
+    changes = {}
+    
     # Reload characters
     new_characters = load_characters_from_file()
     if new_characters:
-        WRITER_CHARACTERS = new_characters
-        print(f"✅ Reloaded {len(WRITER_CHARACTERS)} characters from {CHARACTERS_FILE}")
+        changes["characters"] = new_characters
+        print(f"✅ Reloaded {len(new_characters)} characters from {CHARACTERS_FILE}")
     else:
         print("❌ Failed to reload characters")
     
     # Reload custom elements
     new_elements = load_custom_elements_from_file()
     if new_elements:
-        CUSTOM_ELEMENTS = new_elements
-        print(f"✅ Reloaded {len(CUSTOM_ELEMENTS)} custom elements from {CUSTOM_ELEMENTS_FILE}")
+        changes["elements"] = new_elements
+        print(f"✅ Reloaded {len(new_elements)} custom elements from {CUSTOM_ELEMENTS_FILE}")
     else:
         print("❌ Failed to reload custom elements")
     
+    # Both files are swapped in together
+    if changes:
+        update_engine_state(**changes)
+    
     print("="*30)
 
+class InotifyBackend:
+    """Directory change events from Linux inotify, called through ctypes"""
+    
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT_HEADER = struct.Struct("iIII")
+    
+    def __init__(self, directories):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {}
+        for directory in directories:
+            self.add_watch(directory)
+    
+    def add_watch(self, directory):
+        if directory in self.directories.values() or not os.path.isdir(directory):
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+        self.directories[wd] = directory
+    
+    def wait(self, timeout):
+        """Paths changed within `timeout` seconds (empty set if none)"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+        changed = set()
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode("utf-8", "replace")
+            offset += length
+            if wd in self.directories and name:
+                changed.add(os.path.join(self.directories[wd], name))
+        return changed
+    
+    def close(self):
+        os.close(self.fd)
+
+class PollingBackend:
+    """Directory change detection by comparing modification times and sizes"""
+    
+    def __init__(self, directories, interval=FILE_WATCH_POLL_INTERVAL):
+        self.directories = list(directories)
+        self.interval = interval
+        self.signatures = self.scan()
+    
+    def add_watch(self, directory):
+        if directory not in self.directories:
+            self.directories.append(directory)
+    
+    def scan(self):
+        signatures = {}
+        for directory in self.directories:
+            try:
+                entries = os.scandir(directory)
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    try:
+                        if not entry.is_file():
+                            continue
+                        info = entry.stat()
+                    except OSError:
+                        continue
+                    signatures[os.path.join(directory, entry.name)] = (info.st_mtime_ns, info.st_size)
+        return signatures
+    
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        signatures = self.scan()
+        changed = {path for path in signatures.keys() | self.signatures.keys()
+                   if signatures.get(path) != self.signatures.get(path)}
+        self.signatures = signatures
+        return changed
+    
+    def close(self):
+        pass
+
+class FileWatcher:
+    """Background reload of characters, custom elements and reference materials.
+    
+    Change events are collected until the files have been quiet for
+    FILE_WATCH_DEBOUNCE seconds, so copying a batch of references causes a
+    single reload. Only the changed files are re-read and re-parsed, in the
+    watcher thread; the results wait in `take_updates()` until the session
+    applies them between requests.
+    """
+    
+    def __init__(self, backend=FILE_WATCH_BACKEND, debounce=FILE_WATCH_DEBOUNCE):
+        self.debounce = debounce
+        self.config_directory = os.path.dirname(os.path.abspath(CHARACTERS_FILE))
+        self.reference_directory = os.path.abspath(REFERENCE_FOLDER)
+        self.characters_path = os.path.abspath(CHARACTERS_FILE)
+        self.elements_path = os.path.abspath(CUSTOM_ELEMENTS_FILE)
+        directories = {self.config_directory, os.path.dirname(self.elements_path), self.reference_directory}
+        
+        self.backend = None
+        if backend in ("auto", "inotify") and hasattr(select, "select"):
+            try:
+                self.backend = InotifyBackend(directories)
+            except (OSError, AttributeError) as e:
+                if backend == "inotify":
+                    print(f"⚠️  inotify unavailable ({e}), polling for changes instead")
+        if self.backend is None:
+            self.backend = PollingBackend(directories)
+        
+        self.lock = threading.Lock()
+        self.updates = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+    
+    @property
+    def backend_name(self):
+        return "inotify" if isinstance(self.backend, InotifyBackend) else "polling"
+    
+    def run(self):
+        pending = set()
+        last_change = 0.0
+        while not self.stop_event.is_set():
+            try:
+                changed = self.backend.wait(self.debounce / 2 if pending else 1.0)
+            except OSError:
+                break
+            relevant = {path for path in changed if self.is_watched(path)}
+            if relevant:
+                pending |= relevant
+                last_change = time.monotonic()
+            elif pending and time.monotonic() - last_change >= self.debounce:
+                self.reload(pending)
+                pending = set()
+        self.backend.close()
+    
+    def is_watched(self, path):
+        if path in (self.characters_path, self.elements_path):
+            return True
+        if path == self.reference_directory:
+            # The folder was created or replaced after the watcher started
+            self.backend.add_watch(path)
+            return True
+        return (os.path.dirname(path) == self.reference_directory
+                and os.path.splitext(path)[1].lower() in SUPPORTED_FORMATS)
+    
+    def reload(self, paths):
+        updates = {}
+        if self.characters_path in paths:
+            characters = self.parse_file(self.characters_path, "characters", parse_characters_file)
+            if characters:
+                updates["characters"] = characters
+        if self.elements_path in paths:
+            elements = self.parse_file(self.elements_path, "elements", parse_elements_file)
+            if elements:
+                updates["elements"] = elements
+        
+        reference_paths = {path for path in paths if os.path.dirname(path) == self.reference_directory}
+        if self.reference_directory in paths:
+            # The whole folder appeared or was replaced: rescan it
+            reference_paths |= {os.path.abspath(path) for path in glob.glob(os.path.join(REFERENCE_FOLDER, "*.*"))
+                                if os.path.splitext(path)[1].lower() in SUPPORTED_FORMATS}
+        for path in sorted(reference_paths):
+            # None marks a reference that was deleted or no longer has any text
+            reference = load_reference_file(path) if os.path.isfile(path) else None
+            if reference is None:
+                get_reference_store().remove(os.path.basename(path))
+            updates.setdefault("references", {})[os.path.basename(path)] = reference
+        
+        if updates:
+            with self.lock:
+                for key, value in updates.items():
+                    if key == "references":
+                        self.updates.setdefault("references", {}).update(value)
+                    else:
+                        self.updates[key] = value
+    
+    def parse_file(self, path, kind, parse):
+        # Through the compiled cache, which is rewritten for the new content.
+        # A half-written or emptied file keeps the current settings instead of the defaults
+        try:
+            return load_library(path, kind, parse) or {}
+        except (OSError, UnicodeDecodeError):
+            return {}
+    
+    def take_updates(self):
+        """Reloaded data waiting to be applied ({} if nothing changed)"""
+        with self.lock:
+            updates, self.updates = self.updates, {}
+        return updates
+    
+    def stop(self):
+        self.stop_event.set()
+
+def apply_file_updates(updates, reference_materials):
+    """Swap reloaded characters/elements into place; returns the updated reference list"""
+    changes = {key: updates[key] for key in ("characters", "elements") if key in updates}
+    if changes:
+        update_engine_state(**changes)
+    if "characters" in updates:
+        print(f"🔄 Reloaded {len(updates['characters'])} characters from {CHARACTERS_FILE}")
+    if "elements" in updates:
+        print(f"🔄 Reloaded {len(updates['elements'])} custom elements from {CUSTOM_ELEMENTS_FILE}")
+    if "references" in updates:
+        changed = updates["references"]
+        reference_materials = [reference for reference in reference_materials if reference['filename'] not in changed]
+        reference_materials += [reference for reference in changed.values() if reference]
+        print(f"🔄 Reference materials updated ({', '.join(sorted(changed))}); {len(reference_materials)} loaded")
+        if DEDUP_REFERENCES:
+            reference_materials = deduplicate_references(reference_materials)
+    return reference_materials
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GPT Neo-Style Text Co-Writer")
+    parser.add_argument("--profile", action="store_true",
+                        help=f"Profile CPU time and memory and write a report to {PROFILE_REPORT_DIR}/ at exit")
+    parser.add_argument("--resume", action="store_true",
+                        help=f"Continue the last session from {SESSION_JOURNAL_FILE} instead of choosing settings again")
+    args = parser.parse_args()
+    if args.profile:
+        PROFILER.enable()
+    
     print("🎛 GPT Neo-Style Text Co-Writer")
     print("="*60)
     
@@ -1007,70 +4031,208 @@ if __name__ == "__main__":
     
     # Load reference materials
     reference_materials = load_reference_materials()
+    index_reference_materials(reference_materials)
     
-    # Get initial configuration
-    print(f"\nChoose a style (enter number or name, default: {DEFAULT_STYLE}):")
-    all_styles = list_available_styles()
-    style_input = input().strip()
-    if not style_input:  # If empty, use default
-        style = DEFAULT_STYLE
-        print(f"Using default style: {DEFAULT_STYLE}")
+    # Replaying the journal replaces the four setup menus
+    resumed = SessionJournal.replay(SESSION_JOURNAL_FILE) if args.resume else None
+    if args.resume and not (resumed and resumed["settings"]):
+        print(f"No session to resume in {SESSION_JOURNAL_FILE}; starting a new one")
+        resumed = None
+    
+    if resumed:
+        settings = resumed["settings"]
+        style = settings["style"] if settings["style"] in STYLES else DEFAULT_STYLE
+        # Registers the local server's models first, so a resumed local model is found
+        model_name = settings["model"] if get_model_provider(settings["model"]) else DEFAULT_MODEL
+        if model_name != settings["model"]:
+            print(f"Model {settings['model']} is no longer available; using {DEFAULT_MODEL}")
+        writer_character = settings["character"] if settings["character"] in WRITER_CHARACTERS else DEFAULT_CHARACTER
+        custom_elements = [element for element in settings["elements"] if element in CUSTOM_ELEMENTS]
+        print(f"\n↩️  Resumed session: {style}, {model_name}, {WRITER_CHARACTERS[writer_character]['name']}"
+              + (f", elements: {', '.join(custom_elements)}" if custom_elements else "")
+              + f" ({resumed['turns']} earlier continuation(s))")
     else:
-        style = get_style_by_number(all_styles, style_input)
-        if not style:
+        # Get initial configuration
+        print(f"\nChoose a style (enter number or name, default: {DEFAULT_STYLE}):")
+        all_styles = list_available_styles()
+        style_input = input().strip()
+        if not style_input:  # If empty, use default
             style = DEFAULT_STYLE
-            print(f"Invalid selection, using default style: {DEFAULT_STYLE}")
+            print(f"Using default style: {DEFAULT_STYLE}")
         else:
-            print(f"Selected style: {style}")
-    
-    # Get model selection
-    print(f"\nChoose a model (enter number or name, default: {DEFAULT_MODEL}):")
-    all_models = list_available_models()
-    model_input = input().strip()
-    if not model_input:  # If empty, use default
-        model_name = DEFAULT_MODEL
-        print(f"Using default model: {DEFAULT_MODEL}")
-    else:
-        model_name = get_model_by_number(all_models, model_input)
-        if not model_name:
+            style = get_style_by_number(all_styles, style_input)
+            if not style:
+                style = DEFAULT_STYLE
+                print(f"Invalid selection, using default style: {DEFAULT_STYLE}")
+            else:
+                print(f"Selected style: {style}")
+    
+        # Get model selection
+        print(f"\nChoose a model (enter number or name, default: {DEFAULT_MODEL}):")
+        all_models = list_available_models()
+        model_input = input().strip()
+        if not model_input:  # If empty, use default
             model_name = DEFAULT_MODEL
-            print(f"Invalid selection, using default model: {DEFAULT_MODEL}")
+            print(f"Using default model: {DEFAULT_MODEL}")
         else:
-            print(f"Selected model: {model_name}")
+            model_name = get_model_by_number(all_models, model_input)
+            if not model_name:
+                model_name = DEFAULT_MODEL
+                print(f"Invalid selection, using default model: {DEFAULT_MODEL}")
+            else:
+                print(f"Selected model: {model_name}")
             
-            # Check if this is an OpenAI model and configure API key if needed
-            if model_name in ["gpt-3.5-turbo-instruct", "gpt-4"]:
-                if not OPENAI_API_KEY or OPENAI_API_KEY == "" or OPENAI_API_KEY == "your-openai-api-key-here":
-                    print(f"\n⚠️  OpenAI API key required for {model_name}")
-                    if not configure_openai_model():
-                        print("Switching back to default model: neural-chat")
-                        model_name = "neural-chat"
-    
-    # Get writer character
-    print(f"\nChoose a writer character (enter number or name, default: {DEFAULT_CHARACTER}):")
-    all_characters = list_available_characters()
-    character_input = input().strip()
-    if not character_input:  # If empty, use default
-        writer_character = DEFAULT_CHARACTER
-        print(f"Using default character: {DEFAULT_CHARACTER}")
-    else:
-        writer_character = get_character_by_number(all_characters, character_input)
-        if not writer_character:
+                # Check if this is an OpenAI model and configure API key if needed
+                if model_name in ["gpt-3.5-turbo-instruct", "gpt-4"]:
+                    if not OPENAI_API_KEY or OPENAI_API_KEY == "" or OPENAI_API_KEY == "your-openai-api-key-here":
+                        print(f"\n⚠️  OpenAI API key required for {model_name}")
+                        if not configure_openai_model():
+                            print("Switching back to default model: neural-chat")
+                            model_name = "neural-chat"
+    
+        # Get writer character
+        print(f"\nChoose a writer character (enter number or name, default: {DEFAULT_CHARACTER}):")
+        all_characters = list_available_characters()
+        character_input = read_menu_choice(all_characters)
+        if not character_input:  # If empty, use default
             writer_character = DEFAULT_CHARACTER
-            print(f"Invalid selection, using default character: {DEFAULT_CHARACTER}")
+            print(f"Using default character: {DEFAULT_CHARACTER}")
         else:
-            char = WRITER_CHARACTERS[writer_character]
-            print(f"Selected: {char['name']}")
-    
-    # Get custom elements
-    print("\nEnter custom elements to include (enter numbers or names, comma-separated, or press Enter for none):")
-    all_custom_elements = list_available_custom_elements()
-    elements_input = input().strip()
-    custom_elements = get_custom_elements_by_numbers(all_custom_elements, elements_input)
-    if custom_elements:
-        print(f"Selected elements: {', '.join(custom_elements)}")
-    else:
-        print("No custom elements selected.")
+            writer_character = get_character_by_number(all_characters, character_input)
+            if not writer_character:
+                writer_character = DEFAULT_CHARACTER
+                print(f"Invalid selection, using default character: {DEFAULT_CHARACTER}")
+            else:
+                char = WRITER_CHARACTERS[writer_character]
+                print(f"Selected: {char['name']}")
+    
+        # Get custom elements
+        print("\nEnter custom elements to include (enter numbers or names, comma-separated, or press Enter for none):")
+        all_custom_elements = list_available_custom_elements()
+        elements_input = read_menu_choice(all_custom_elements)
+        custom_elements = get_custom_elements_by_numbers(all_custom_elements, elements_input)
+        if custom_elements:
+            print(f"Selected elements: {', '.join(custom_elements)}")
+        else:
+            print("No custom elements selected.")
+    
+    last_continuation = ""
+    best_of_n = BEST_OF_N
+    speculative_prefetch = SPECULATIVE_PREFETCH
+    speculation = None
+    speculation_wasted = 0
+    if resumed:
+        last_continuation = resumed["last_continuation"]
+        best_of_n = settings.get("best_of", best_of_n)
+        LATENCY_TARGET = settings.get("latency_target", LATENCY_TARGET)
+        if last_continuation:
+            print(f"Last output ('continue' picks up from here): ...{last_continuation[-200:]}")
+    journal = open_session_journal(resume=bool(resumed))
+    journaled_settings = None
+    session_lock = threading.Lock()  # Guards last_continuation and speculation, which the worker also uses
+    
+    file_watcher = FileWatcher() if FILE_WATCH else None
+    
+    def run_job(job):
+        """Generate one queued request on the worker thread, streaming it to the console"""
+        global last_continuation, speculation, speculation_wasted, speculative_prefetch
+        streamed = []
+        
+        def print_token(delta):
+            BackgroundGenerator.check_cancelled(job)
+            streamed.append(delta)
+            if STREAM_RESPONSES:
+                print(delta, end="", flush=True)
+        
+        if job["kind"] == "long form":
+            print(f"\n📜 Long-form run into {job['output_path']} (type 'cancel' to pause; run 'long form' on the same file later to resume)\n")
+            try:
+                total_words = write_long_form(job["prompt"], job["target_words"], job["output_path"], job["style"],
+                                              job["custom_elements"], job["writer_character"], job["model_name"],
+                                              job["reference_materials"], on_token=print_token)
+                print(f"\n✅ {job['output_path']} now has {total_words:,} words")
+                journal.append("long_form", output_path=job["output_path"], words=total_words)
+            except GenerationCancelled:
+                print(f"\n⏸ Long-form run paused. Text so far is saved in {job['output_path']}")
+            except Exception as e:
+                print(f"\n❌ Error: {e}")
+                print(f"Text so far is saved in {job['output_path']}; run 'long form' again to resume.")
+            return
+        
+        prompt = job["prompt"]
+        with session_lock:
+            # A queued 'continue' follows whatever the request before it produced
+            if prompt.lower() == 'continue':
+                if not last_continuation:
+                    print("\nNothing to continue yet. Enter a prompt first.")
+                    return
+                prompt = build_continue_prompt(last_continuation)
+            
+            # Use the prefetched continuation only if it was made for exactly this request
+            request_key = (prompt, job["style"], tuple(job["custom_elements"]), job["writer_character"], job["model_name"])
+            prefetched = None
+            if speculation:
+                if speculation.key == request_key and not (speculation.finished and speculation.error):
+                    prefetched = speculation
+                else:
+                    speculation_wasted += speculation.cancel()
+                speculation = None
+        
+        print("\n📝 AI Continuation:\n")
+        try:
+            if prefetched:
+                print("(prefetched)")
+                continuation = prefetched.attach(print_token)
+            elif job["best_of_n"] > 1:
+                print(f"(generating {job['best_of_n']} samples...)")
+                continuation = co_write_best_of(job["best_of_n"], prompt, job["style"], job["custom_elements"],
+                                                job["writer_character"], job["model_name"], job["reference_materials"],
+                                                cancel_event=job["cancelled"])
+            else:
+                continuation = co_write(prompt, job["style"], job["custom_elements"], job["writer_character"], job["model_name"],
+                                        job["reference_materials"], on_token=print_token)
+            if streamed and STREAM_RESPONSES:
+                print()
+            else:
+                print(continuation)
+            if continuation.stop_reason:
+                print(f"\n✂️  Stopped early: {continuation.stop_reason}")
+            
+            journal.append("turn", prompt=job["prompt"], text=str(continuation), stop=continuation.stop_reason)
+            with session_lock:
+                last_continuation = continuation
+                # Best-of already multiplies the compute per prompt, so only single samples are speculated,
+                # and only when no queued request is about to use the model
+                if speculative_prefetch and job["best_of_n"] == 1 and not generator.pending:
+                    if speculation_wasted < SPECULATIVE_MAX_WASTED_TOKENS:
+                        next_prompt = build_continue_prompt(continuation)
+                        speculation = SpeculativePrefetch(
+                            (next_prompt, job["style"], tuple(job["custom_elements"]), job["writer_character"], job["model_name"]),
+                            lambda on_token, next_prompt=next_prompt: co_write(
+                                next_prompt, job["style"], job["custom_elements"], job["writer_character"], job["model_name"],
+                                job["reference_materials"], on_token=on_token)
+                        )
+                    else:
+                        speculative_prefetch = False
+                        print(f"\nSpeculative prefetch paused: {speculation_wasted} tokens were generated but not used")
+        except GenerationCancelled as e:
+            # Keep what arrived before the cancel and stay in the session
+            if streamed and STREAM_RESPONSES:
+                print()
+            print("\n⏹ Generation cancelled.")
+            if e.partial_text:
+                journal.append("turn", prompt=job["prompt"], text=e.partial_text, stop="cancelled")
+                with session_lock:
+                    last_continuation = e.partial_text
+        except Exception as e:
+            print(f"\n❌ Error: {e}")
+            print("Please try again.")
+        
+        if generator.pending:
+            print(f"\n⏳ {len(generator.pending)} queued request(s) left")
+    
+    # Generation runs on a worker thread so commands and new prompts are accepted while the model writes
+    generator = BackgroundGenerator(run_job)
     
     print("\n" + "="*50)
     print(f"Ready for prompts! Using model: {model_name}")
@@ -1079,101 +4241,240 @@ if __name__ == "__main__":
     print("Type 'quit' to exit, 'new style' to change style/elements, 'new character' to change character, 'new model' to change model")
     print("Type 'reload refs' to reload reference materials, 'reload config' to reload characters/elements")
     print("Type 'status' to show current settings, 'help' for all commands")
+    print("Prompts typed during a generation are queued; settings changes apply to prompts entered after them")
+    print("Type 'cancel' or press Ctrl-C during a generation to stop it and keep the text so far")
     print("="*50)
     
     while True:
+        # Settings changes are journaled once, whichever command made them
+        current_settings = {"style": style, "model": model_name, "character": writer_character, "elements": list(custom_elements),
+                            "best_of": best_of_n, "latency_target": LATENCY_TARGET}
+        if current_settings != journaled_settings:
+            journal.append("settings", settings=current_settings)
+            journaled_settings = current_settings
+        
         print("\n" + "-"*30)
-        prompt = input("Enter your prompt: ").strip()
+        try:
+            prompt = input("Enter your prompt: ").strip()
+        except KeyboardInterrupt:
+            # Ctrl-C stops the running generation; with nothing running it ends the session
+            print()
+            prompt = 'cancel' if generator.busy else 'quit'
+        except EOFError:
+            prompt = 'quit'
+        
+        # Files changed on disk are swapped in between commands; running requests keep the snapshot they started with
+        file_updates = file_watcher.take_updates() if file_watcher else None
+        if file_updates:
+            reference_materials = apply_file_updates(file_updates, reference_materials)
+            if "references" in file_updates:
+                index_reference_materials(reference_materials)
+            if writer_character not in WRITER_CHARACTERS:
+                writer_character = DEFAULT_CHARACTER if DEFAULT_CHARACTER in WRITER_CHARACTERS else next(iter(WRITER_CHARACTERS))
+                print(f"Current character was removed; using {WRITER_CHARACTERS[writer_character]['name']}")
+            custom_elements = [element for element in custom_elements if element in CUSTOM_ELEMENTS]
+            with session_lock:
+                if speculation:
+                    speculation_wasted += speculation.cancel()
+                    speculation = None
+        
+        # Anything but 'continue' (or a read-only command) makes the prefetched text useless
+        if prompt.lower() not in ('continue', 'status', 'help', ''):
+            with session_lock:
+                if speculation:
+                    speculation_wasted += speculation.cancel()
+                    speculation = None
         
         if prompt.lower() == 'quit':
+            if not generator.close():
+                print("⚠️  The running generation did not stop in time; its output will not be journaled")
+            journal.close()
+            if file_watcher:
+                file_watcher.stop()
+            if PROFILER.enabled:
+                print(f"📊 Profile written to {PROFILER.disable()}")
             print("Goodbye! 👋")
             break
+        elif prompt.lower() in ('cancel', 'cancel all'):
+            current, dropped = generator.cancel(drop_pending=prompt.lower() == 'cancel all')
+            if current:
+                print("⏹ Stopping the running generation...")
+            if dropped:
+                print(f"Dropped {dropped} queued request(s)")
+            if not current and not dropped:
+                print("Nothing is being generated.")
+            continue
         elif prompt.lower() == 'new style':
             print("\n" + "="*30)
             print("CHANGING STYLE AND ELEMENTS")
             print("="*30)
-            
-            # Show available styles
-            all_styles = list_available_styles()
-            print("Choose a new style (enter number or name):")
-            style_input = input().strip()
-            if not style_input:  # If empty, keep current style
-                print("No input provided. Keeping current style.")
-            else:
-                new_style = get_style_by_number(all_styles, style_input)
-                if new_style:
-                    style = new_style
-                    print(f"Style updated to: {style}")
+            try:
+                # Show available styles
+                all_styles = list_available_styles()
+                print("Choose a new style (enter number or name):")
+                style_input = input().strip()
+                if not style_input:  # If empty, keep current style
+                    print("No input provided. Keeping current style.")
                 else:
-                    print("Invalid style selection. Keeping current style.")
-            
-            # Show available custom elements
-            all_custom_elements = list_available_custom_elements()
-            print("\nEnter custom elements to include (enter numbers or names, comma-separated, or press Enter for none):")
-            elements_input = input().strip()
-            new_elements = get_custom_elements_by_numbers(all_custom_elements, elements_input)
-            if new_elements:
-                custom_elements = new_elements
-                print(f"Elements updated to: {', '.join(custom_elements)}")
-            else:
-                custom_elements = []
-                print("No custom elements selected.")
-            
-            print("Style and elements updated!")
-            continue
+                    new_style = get_style_by_number(all_styles, style_input)
+                    if new_style:
+                        style = new_style
+                        print(f"Style updated to: {style}")
+                    else:
+                        print("Invalid style selection. Keeping current style.")
+                
+                # Show available custom elements
+                all_custom_elements = list_available_custom_elements()
+                print("\nEnter custom elements to include (enter numbers or names, comma-separated, or press Enter for none):")
+                elements_input = read_menu_choice(all_custom_elements)
+                new_elements = get_custom_elements_by_numbers(all_custom_elements, elements_input)
+                if new_elements:
+                    custom_elements = new_elements
+                    print(f"Elements updated to: {', '.join(custom_elements)}")
+                else:
+                    custom_elements = []
+                    print("No custom elements selected.")
+                
+                print("Style and elements updated!")
+                continue
+            except KeyboardInterrupt:
+                # Ctrl-C leaves the menu, not the session
+                print("\n↩️  Back to the prompt.")
+                continue
         elif prompt.lower() == 'new character':
             print("\n" + "="*30)
             print("CHANGING WRITER CHARACTER")
             print("="*30)
-            all_characters = list_available_characters()
-            print("Choose a writer character (enter number or name):")
-            character_input = input().strip()
-            if not character_input:  # If empty, keep current character
-                print("No input provided. Keeping current character.")
-            else:
-                new_character = get_character_by_number(all_characters, character_input)
-                if new_character:
-                    writer_character = new_character
-                    char = WRITER_CHARACTERS[writer_character]
-                    print(f"Character updated to: {char['name']}")
+            try:
+                all_characters = list_available_characters()
+                print("Choose a writer character (enter number or name):")
+                character_input = read_menu_choice(all_characters)
+                if not character_input:  # If empty, keep current character
+                    print("No input provided. Keeping current character.")
                 else:
-                    print("Invalid character selection. Keeping current character.")
-            continue
+                    new_character = get_character_by_number(all_characters, character_input)
+                    if new_character:
+                        writer_character = new_character
+                        char = WRITER_CHARACTERS[writer_character]
+                        print(f"Character updated to: {char['name']}")
+                    else:
+                        print("Invalid character selection. Keeping current character.")
+                continue
+            except KeyboardInterrupt:
+                # Ctrl-C leaves the menu, not the session
+                print("\n↩️  Back to the prompt.")
+                continue
         elif prompt.lower() == 'new model':
             print("\n" + "="*30)
             print("CHANGING MODEL")
             print("="*30)
-            all_models = list_available_models()
-            print("Choose a new model (enter number or name):")
-            model_input = input().strip()
-            if not model_input:  # If empty, keep current model
-                print("No input provided. Keeping current model.")
-            else:
-                new_model = get_model_by_number(all_models, model_input)
-                if new_model:
-                    # Check if this is an OpenAI model and configure API key if needed
-                    if new_model in ["gpt-3.5-turbo-instruct", "gpt-4"]:
-                        if not OPENAI_API_KEY or OPENAI_API_KEY == "" or OPENAI_API_KEY == "your-openai-api-key-here":
-                            print(f"\n⚠️  OpenAI API key required for {new_model}")
-                            if not configure_openai_model():
-                                print("Keeping current model.")
-                                continue
-                    
-                    model_name = new_model
-                    print(f"Model updated to: {model_name}")
+            try:
+                all_models = list_available_models()
+                print("Choose a new model (enter number or name):")
+                model_input = input().strip()
+                if not model_input:  # If empty, keep current model
+                    print("No input provided. Keeping current model.")
                 else:
-                    print("Invalid model selection. Keeping current model.")
-            continue
+                    new_model = get_model_by_number(all_models, model_input)
+                    if new_model:
+                        # Check if this is an OpenAI model and configure API key if needed
+                        if new_model in ["gpt-3.5-turbo-instruct", "gpt-4"]:
+                            if not OPENAI_API_KEY or OPENAI_API_KEY == "" or OPENAI_API_KEY == "your-openai-api-key-here":
+                                print(f"\n⚠️  OpenAI API key required for {new_model}")
+                                if not configure_openai_model():
+                                    print("Keeping current model.")
+                                    continue
+                        
+                        model_name = new_model
+                        print(f"Model updated to: {model_name}")
+                    else:
+                        print("Invalid model selection. Keeping current model.")
+                continue
+            except KeyboardInterrupt:
+                # Ctrl-C leaves the menu, not the session
+                print("\n↩️  Back to the prompt.")
+                continue
         elif prompt.lower() == 'reload refs':
             print("\n" + "="*30)
             print("RELOADING REFERENCE MATERIALS")
             print("="*30)
             reference_materials = load_reference_materials()
+            index_reference_materials(reference_materials)
             print(f"Reloaded {len(reference_materials)} reference material(s)")
             continue
         elif prompt.lower() == 'reload config':
             reload_characters_and_elements()
             continue
+        elif re.fullmatch(r"best of \d+", prompt.lower()):
+            best_of_n = max(1, int(prompt[len('best of'):]))
+            print(f"Generating {best_of_n} sample(s) per prompt" + (" and keeping the best" if best_of_n > 1 else ""))
+            continue
+        elif re.fullmatch(r"alt( \d+)?", prompt.lower()):
+            alternatives = getattr(last_continuation, 'alternatives', None)
+            if not alternatives or len(alternatives) < 2:
+                print("No alternative samples for the last prompt. Use 'best of N' to generate several.")
+                continue
+            choice = prompt[len('alt'):].strip()
+            if choice.isdigit() and 1 <= int(choice) <= len(alternatives):
+                chosen = alternatives[int(choice) - 1]
+                chosen.alternatives = alternatives
+                with session_lock:
+                    last_continuation = chosen
+                journal.append("selected", text=str(chosen))
+                print(f"\n📝 Sample {choice}:\n")
+                print(chosen)
+            else:
+                for number, alternative in enumerate(alternatives, 1):
+                    marker = "*" if alternative is last_continuation else " "
+                    print(f"{marker}{number:2d}. {alternative[:100]}...")
+                print("Type 'alt <number>' to show and use a sample")
+            continue
+        elif prompt.lower() == 'long form':
+            print("\n" + "="*30)
+            print("LONG-FORM GENERATION")
+            print("="*30)
+            try:
+                output_path = input(f"Output file (default: {LONG_FORM_OUTPUT_FILE}): ").strip() or LONG_FORM_OUTPUT_FILE
+                target_input = input("Target length in words (default: 5000): ").strip()
+                target_words = int(target_input) if target_input.isdigit() else 5000
+                seed_prompt = ""
+                if not (os.path.exists(output_path) and os.path.getsize(output_path) > 0):
+                    seed_prompt = input("Opening prompt: ").strip()
+                    if not seed_prompt:
+                        print("An opening prompt is required to start a new piece.")
+                        continue
+                ahead = generator.submit({"kind": "long form", "prompt": seed_prompt, "target_words": target_words,
+                                          "output_path": output_path, "style": style, "custom_elements": list(custom_elements),
+                                          "writer_character": writer_character, "model_name": model_name,
+                                          "reference_materials": reference_materials})
+                if ahead:
+                    print(f"⏳ Queued behind {ahead} request(s)")
+                continue
+            except KeyboardInterrupt:
+                # Ctrl-C leaves the menu, not the session
+                print("\n↩️  Back to the prompt.")
+                continue
+        elif prompt.lower() in ('speculate on', 'speculate off'):
+            speculative_prefetch = prompt.lower() == 'speculate on'
+            print(f"Speculative prefetch {'enabled' if speculative_prefetch else 'disabled'}")
+            continue
+        elif prompt.lower() in ('profile on', 'profile off'):
+            if prompt.lower() == 'profile on':
+                PROFILER.enable()
+                print(f"📊 Profiling enabled; 'profile off' writes the report to {PROFILE_REPORT_DIR}/")
+            elif PROFILER.enabled:
+                print(f"📊 Profile written to {PROFILER.disable()}")
+            else:
+                print("Profiling is not enabled.")
+            continue
+        elif re.fullmatch(r"latency (\d+(\.\d+)?|off)", prompt.lower()):
+            setting = prompt.lower().split()[1]
+            LATENCY_TARGET = None if setting == 'off' else float(setting)
+            if LATENCY_TARGET is None:
+                print("Latency target disabled; replies use the full length")
+            else:
+                print(f"⏱ Aiming for replies within {LATENCY_TARGET:g}s; max_tokens shrinks on slow models")
+            continue
         elif prompt.lower() == 'status':
             print("\n" + "="*30)
             print("CURRENT SETTINGS")
@@ -1182,6 +4483,18 @@ if __name__ == "__main__":
             print(f"Model: {model_name}")
             print(f"Writer Character: {WRITER_CHARACTERS[writer_character]['name']}")
             print(f"Custom Elements: {', '.join(custom_elements)}")
+            print(f"Samples per prompt: {best_of_n}")
+            print(f"Speculative prefetch: {'on' if speculative_prefetch else 'off'} ({speculation_wasted}/{SPECULATIVE_MAX_WASTED_TOKENS} tokens wasted)")
+            print(f"Latency target: {f'{LATENCY_TARGET:g}s' if LATENCY_TARGET else 'off'}")
+            speed = THROUGHPUT.estimate(model_name)
+            if speed:
+                print(f"Measured speed: {speed[1]:.1f} tokens/s, first token after {speed[0]:.1f}s")
+            print(f"Profiling: {'on' if PROFILER.enabled else 'off'}")
+            print(f"File watching: {file_watcher.backend_name if file_watcher else 'off'}")
+            current = generator.current
+            if current:
+                print(f"Generating: {current['kind']} '{current['prompt'][:40]}'")
+            print(f"Queued requests: {len(generator.pending)}")
             print("="*30)
             continue
         elif prompt.lower() == 'help':
@@ -1194,6 +4507,14 @@ if __name__ == "__main__":
             print("new model - Change the AI model")
             print("reload refs - Reload reference materials")
             print("reload config - Reload characters and custom elements from files")
+            print("best of N - Generate N samples in parallel and show the best one")
+            print("continue - Continue from the last output")
+            print("long form - Write a long piece to a file, continuing automatically")
+            print("speculate on/off - Prepare the next 'continue' in the background")
+            print("profile on/off - Profile CPU time and memory; 'off' writes the report")
+            print("latency N/off - Aim for replies within N seconds by shortening them on slow models")
+            print("alt - List the other samples of the last prompt ('alt 2' to use one)")
+            print("cancel - Stop the running generation ('cancel all' also drops queued prompts)")
             print("status - Show current settings")
             print("help - Show this help message")
             print("="*30)
@@ -1202,10 +4523,13 @@ if __name__ == "__main__":
             print("Please enter a prompt or type 'quit' to exit.")
             continue
         
-        try:
-            continuation = co_write(prompt, style, custom_elements, writer_character, model_name, reference_materials)
-            print("\n📝 AI Continuation:\n")
-            print(continuation)
-        except Exception as e:
-            print(f"\n❌ Error: {e}")
-            print("Please try again.")
\ No newline at end of file
+        if prompt.lower() == 'continue' and not last_continuation and not generator.busy:
+            print("Nothing to continue yet. Enter a prompt first.")
+            continue
+        
+        # Settings are captured now, so commands typed while this waits in the queue only affect later prompts
+        ahead = generator.submit({"kind": "prompt", "prompt": prompt, "style": style, "custom_elements": list(custom_elements),
+                                  "writer_character": writer_character, "model_name": model_name, "best_of_n": best_of_n,
+                                  "reference_materials": reference_materials})
+        if ahead:
+            print(f"⏳ Queued behind {ahead} request(s)")